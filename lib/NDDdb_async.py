@@ -0,0 +1,114 @@
+import asyncio
+import threading
+from urllib.parse import urlparse
+import pandas as pd
+
+import NDDdb_py_modules as NDDdb
+
+# asyncio layer over the REDCap & LabKey helpers, so a DET handler can run independent calls
+# at the same time: e.g. fetch both data dictionaries, or write the same new ID to REDCap and
+# LabKey, at once instead of one after the other. Writes that depend on each other stay in order:
+# a record is only referred to once it exists, and the value a retried job checks to see whether a
+# step is done (dataproj_id, labkey_subjid, fnum) is written last. The calls themselves still go through the pooled
+# pycurl client (NDDdb_redcap.py) and the LabKey API; each runs in a worker thread via
+# asyncio.to_thread. At most hostlimit calls per host are in flight at once across the whole
+# process (setHostLimit to change it), so a burst of handlers can't flood either server.
+# From synchronous code, run a coroutine with asyncio.run(...).
+
+DEFAULT_HOSTLIMIT = 4
+
+_limits = {}
+_limitslock = threading.Lock()
+
+def setHostLimit(host, n):
+  with _limitslock:
+    _limits[host] = threading.BoundedSemaphore(n)
+
+def _limit(host):
+  with _limitslock:
+    if host not in _limits:
+      _limits[host] = threading.BoundedSemaphore(DEFAULT_HOSTLIMIT)
+    return _limits[host]
+
+def redcapHost(api_url):
+  return urlparse(api_url).netloc
+
+def labkeyHost(server_context):
+  return 'labkey:' + str(getattr(server_context, '_domain', ''))
+
+# Run func(*args, **kwargs) in a thread, holding one of host's slots while it runs
+async def _call(host, func, *args, **kwargs):
+  def run():
+    with _limit(host):
+      return func(*args, **kwargs)
+  return await asyncio.to_thread(run)
+
+async def pullRCRecordsAsync(api_url, api_token, forms, records, fields, ctx=None):
+  pull = NDDdb.rcIO(ctx)[0]
+  return await _call(redcapHost(api_url), pull, api_url, api_token, forms, records, fields)
+
+async def pushRCRecordAsync(api_url, api_token, form, df, ctx=None):
+  push = NDDdb.rcIO(ctx)[1]
+  return await _call(redcapHost(api_url), push, api_url, api_token, form, df)
+
+async def getMetaDataAsync(api_url, api_token, forms):
+  return await _call(redcapHost(api_url), NDDdb.metadata.get, api_url, api_token, forms)
+
+# Any LabKey API call, e.g. labkeyAsync(sc, select_rows, sc, 'study', 'GetNextSubjectID')
+async def labkeyAsync(server_context, func, *args, **kwargs):
+  return await _call(labkeyHost(server_context), func, *args, **kwargs)
+
+async def getNextLabKeyIDAsync(server_context):
+  return await labkeyAsync(server_context, NDDdb.getNextLabKeyID, server_context)
+
+async def LKinsertRowAsync(rcrd, query, schema, sc):
+  return await labkeyAsync(sc, NDDdb.LKinsertRow, rcrd, query, schema, sc)
+
+#### Async versions of the NDDdb_py_modules enrollment helpers ###
+
+# pushToDC: both dictionaries (and the proband's repeat instance, if needed) are fetched together,
+# then the data collection record is written and only after that the referral's dataproj_id, which
+# points at it (and tells a retry the referral is enrolled)
+async def pushToDCAsync(api_url, ref_api_key, dc_api_key, referral, refid, dcid, idnum, imnewhere, ctx=None):
+  pull = NDDdb.rcIO(ctx)[0]
+  dd_refer, dd_data, rep = await asyncio.gather(
+    getMetaDataAsync(api_url, ref_api_key, 'family_members'),
+    getMetaDataAsync(api_url, dc_api_key, 'family_members'),
+    _call(redcapHost(api_url), NDDdb.probandRepeat, api_url, dc_api_key, dcid, idnum, imnewhere, pull))
+  newfam, update = NDDdb.makeDCEnrollment(referral, refid, dcid, idnum, imnewhere, rep, dd_refer, dd_data)
+  await pushRCRecordAsync(api_url, dc_api_key, '', newfam, ctx)
+  if update is not None:
+    await pushRCRecordAsync(api_url, ref_api_key, '', update, ctx)
+  return '01'
+
+# assignLabKeyID: the LabKey row is written first and the ID stored in REDCap only once it succeeded,
+# since a subject with a labkey_subjid is taken to be in LabKey already. The LabKey row is upserted, so running it
+# again for the same subject & ID (e.g. a retried DET job) does no harm
+async def assignLabKeyIDAsync(api_url, dc_api_key, server_context, dcid, rep, lkid, reln, dateadded, ctx=None):
+  dcupdate = pd.DataFrame(data={'redcap_id':[dcid], 'redcap_event_name':['family_member_arm_1'], 'redcap_repeat_instance':[rep], 'labkey_subjid':[lkid]})
+  lkupdate = pd.DataFrame(data={'SubjectID':[lkid], 'demo_relation':[reln], 'date':[dateadded], 'familyid':[dcid]})
+  NDDdb.checkWrite(await labkeyAsync(server_context, NDDdb.LabKeyBulkWriter(server_context, 'study', 'Demographics', 'SubjectID').upsert, lkupdate))
+  await pushRCRecordAsync(api_url, dc_api_key, '', dcupdate, ctx)
+
+# assignFindivID: the data collection, referral (if refid is given) & LabKey writes run together; a
+# failed LabKey row raises once they are done
+async def assignFindivIDAsync(api_url, ref_api_key, dc_api_key, server_context, refid, dcid, rep, subjid, fnum, idnum, ctx=None):
+  f_idnum = fnum + '-' + idnum
+  update = pd.DataFrame(data={'redcap_id':[dcid],'redcap_event_name':['family_member_arm_1'],'redcap_repeat_instance':[rep], 'f_idnum':[f_idnum], 'idnum':[idnum]})
+  lkupdate = pd.DataFrame(data={'SubjectID':[subjid],'idnum':[idnum], 'f_idnum':[f_idnum]})
+  writes = [
+    pushRCRecordAsync(api_url, dc_api_key, '', update, ctx),
+    labkeyAsync(server_context, NDDdb.LabKeyBulkWriter(server_context, 'study', 'Enrollment', 'SubjectID').upsert, lkupdate)
+  ]
+  if refid:
+    writes.append(pushRCRecordAsync(api_url, ref_api_key, '', pd.DataFrame(data={'redcap_id':[refid], 'f_idnum':[f_idnum]}), ctx))
+  results = await asyncio.gather(*writes)
+  NDDdb.checkWrite(results[1])
+
+# assignFID: LabKey first, then (if that succeeded) the data collection project, whose fnum tells a
+# retry the F# is assigned
+async def assignFIDAsync(api_url, dc_api_key, server_context, dcid, fnum, ctx=None):
+  update = pd.DataFrame(data={'redcap_id':[dcid], 'fnum':[fnum]})
+  lkupdate = pd.DataFrame(data={'id':[dcid], 'fnum':[fnum]})
+  NDDdb.checkWrite(await labkeyAsync(server_context, NDDdb.LabKeyBulkWriter(server_context, 'lists', 'Families', 'id').upsert, lkupdate))
+  await pushRCRecordAsync(api_url, dc_api_key, '', update, ctx)
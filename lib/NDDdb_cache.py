@@ -0,0 +1,150 @@
+import os
+import time
+import json
+import hashlib
+import threading
+import pandas as pd
+
+# Exports are stored as Feather files, which can be memory-mapped, so a cached export loads without
+# parsing. Unlike pickles, loading one can't run code, so the cache needs pyarrow.
+try:
+  import pyarrow.feather as feather
+except ImportError:
+  feather = None
+
+# Create cachedir (0700) if needed, and check it's a real directory owned by this user that no one
+# else can read or write
+def privateCacheDir(cachedir):
+  try:
+    os.makedirs(cachedir, mode=0o700, exist_ok=True)
+    stat = os.lstat(cachedir)
+  except OSError:
+    return False
+  return os.path.isdir(cachedir) and not os.path.islink(cachedir) and stat.st_uid == os.getuid() and stat.st_mode & 0o077 == 0
+
+# On-disk cache of REDCap record exports.
+# Entries are keyed by the API URL, a hash of the project token, and the forms/fields/records
+# requested. Every file name starts with a prefix derived from (API URL, token) only, so all
+# entries for one project can be dropped at once by invalidate(). Entries older than ttl
+# seconds are treated as misses, and once the cache grows past maxbytes the least recently
+# read entries are deleted first. Reads bump a file's access time to keep track of recency.
+# Each project also has a generation file that invalidate() rewrites. A pull takes generation()
+# before it starts and hands it to put(), which drops the export if the project was invalidated
+# in the meantime, so a pull that raced a push can't write its (stale) export back.
+# The exports hold identifiable data, so the directory must be private to the user running the code
+# (see privateCacheDir); the cache refuses to start otherwise.
+class RCExportCache:
+  def __init__(self, path, ttl=3600, maxbytes=2*1024**3):
+    if feather is None:
+      raise RuntimeError('The REDCap export cache needs pyarrow')
+    path = os.path.expanduser(path)
+    if not privateCacheDir(path):
+      raise RuntimeError('Cache directory ' + path + ' must be a directory owned by this user and closed to everyone else (chmod 700)')
+    self.path = path
+    self.ttl = ttl
+    self.maxbytes = maxbytes
+    self.ext = '.feather'
+    self.lock = threading.Lock()
+
+  # The token itself is never written to disk, only its hash
+  def projectPrefix(self, api_url, api_token):
+    return hashlib.sha256((api_url + '\0' + api_token).encode('utf8')).hexdigest()[:16]
+
+  def generationPath(self, api_url, api_token):
+    return os.path.join(self.path, self.projectPrefix(api_url, api_token) + '.gen')
+
+  # Current invalidation generation of a project (shared by every process using the cache)
+  def generation(self, api_url, api_token):
+    try:
+      with open(self.generationPath(api_url, api_token)) as f:
+        return f.read()
+    except FileNotFoundError:
+      return ''
+
+  def entryPath(self, api_url, api_token, forms, fields, records, dateRangeBegin=''):
+    request = json.dumps([forms, fields, records, dateRangeBegin])
+    key = hashlib.sha256(request.encode('utf8')).hexdigest()[:24]
+    return os.path.join(self.path, self.projectPrefix(api_url, api_token) + '_' + key + self.ext)
+
+  # Return the cached export, or None if there isn't a fresh one
+  def get(self, api_url, api_token, forms, fields, records, dateRangeBegin=''):
+    fpath = self.entryPath(api_url, api_token, forms, fields, records, dateRangeBegin)
+    try:
+      stat = os.stat(fpath)
+      if time.time() - stat.st_mtime > self.ttl:
+        os.remove(fpath)
+        return None
+      df = feather.read_table(fpath, memory_map=True).to_pandas()
+      os.utime(fpath, (time.time(), stat.st_mtime))
+    except (FileNotFoundError, OSError, ValueError):
+      return None
+    # pullRCRecords frames are indexed from 1
+    df.index = pd.RangeIndex(1, len(df) + 1)
+    return df
+
+  # Store an export. generation is the project's generation() from before the pull started; if the
+  # project has been invalidated since, the export may be stale and isn't kept
+  def put(self, api_url, api_token, forms, fields, records, df, dateRangeBegin='', generation=None):
+    if generation is not None and self.generation(api_url, api_token) != generation:
+      return
+    fpath = self.entryPath(api_url, api_token, forms, fields, records, dateRangeBegin)
+    # Write to a temp file & move it into place so readers never see a partial file
+    tmppath = fpath + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    feather.write_feather(df.reset_index(drop=True), tmppath, compression='uncompressed')
+    try:
+      os.replace(tmppath, fpath)
+    except FileNotFoundError:
+      # invalidate() removed the temp file, so the project changed while it was written
+      return
+    # invalidate() bumps the generation before deleting, so if it ran between the check above and
+    # the replace, either it deleted the file or the generation shows it here
+    if generation is not None and self.generation(api_url, api_token) != generation:
+      try:
+        os.remove(fpath)
+      except FileNotFoundError:
+        pass
+      return
+    self.evict()
+
+  # Drop every entry for a project, e.g. after records were pushed to it
+  def invalidate(self, api_url, api_token):
+    prefix = self.projectPrefix(api_url, api_token) + '_'
+    genpath = self.generationPath(api_url, api_token)
+    tmppath = genpath + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(tmppath, 'w') as f:
+      f.write(str(time.time_ns()) + '.' + str(os.getpid()) + '.' + str(threading.get_ident()))
+    os.replace(tmppath, genpath)
+    with self.lock:
+      for fname in os.listdir(self.path):
+        if fname.startswith(prefix):
+          try:
+            os.remove(os.path.join(self.path, fname))
+          except FileNotFoundError:
+            pass
+
+  # Delete expired entries, then least recently read entries until the cache fits in maxbytes
+  def evict(self):
+    with self.lock:
+      entries = []
+      now = time.time()
+      for fname in os.listdir(self.path):
+        if not fname.endswith(self.ext):
+          continue
+        fpath = os.path.join(self.path, fname)
+        try:
+          stat = os.stat(fpath)
+          if now - stat.st_mtime > self.ttl:
+            os.remove(fpath)
+          else:
+            entries.append((stat.st_atime, stat.st_size, fpath))
+        except FileNotFoundError:
+          pass
+      total = sum(e[1] for e in entries)
+      for atime, size, fpath in sorted(entries):
+        if total <= self.maxbytes:
+          break
+        try:
+          os.remove(fpath)
+        except FileNotFoundError:
+          pass
+        total -= size
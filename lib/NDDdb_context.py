@@ -0,0 +1,91 @@
+import threading
+import pandas as pd
+
+# Records pulled from REDCap while handling one request (e.g. one DET pipeline run).
+# Each (project, forms, records, fields) export is pulled once and later reads are served from
+# memory; a pull can also be answered from an earlier, wider pull of the same forms (all fields
+# and/or all records) that has every requested column. Pushes made through the context are sent
+# to REDCap and then written into the cached frames, so later reads in the same request see
+# them. A pushed row that doesn't match any cached row (a new record or repeat instance) makes
+# the context drop that frame, which is pulled again the next time it is asked for.
+# pull/push are NDDdb_py_modules.pullRCRecords/pushRCRecord. A context can be shared by the threads
+# working on one request (e.g. the async helpers in NDDdb_async.py), but isn't meant to outlive it.
+class RecordContext:
+  def __init__(self, pull, push):
+    self.pull = pull
+    self.push = push
+    self.frames = {}
+    self.lock = threading.Lock()
+    self.pulls = 0
+    self.hits = 0
+
+  # Same arguments and result as pullRCRecords. Callers get their own copy to modify
+  def pullRCRecords(self, api_url, api_token, forms, records, fields):
+    key = (api_url, api_token, forms, records, fields)
+    with self.lock:
+      df = self.frames.get(key)
+      if df is None:
+        df = self._fromWider(*key)
+      if df is not None:
+        self.hits += 1
+        return df.copy()
+    df = self.pull(api_url, api_token, forms, records, fields)
+    with self.lock:
+      self.frames[key] = df
+      self.pulls += 1
+      return df.copy()
+
+  # Look for an earlier pull of the same forms covering these records & fields
+  def _fromWider(self, api_url, api_token, forms, records, fields):
+    wanted = [f for f in fields.split(',') if f != '']
+    for (url, token, cforms, crecords, cfields), df in self.frames.items():
+      if (url, token, cforms) != (api_url, api_token, forms):
+        continue
+      if crecords not in ['', records] or cfields not in ['', fields]:
+        continue
+      if not all(f in df.columns for f in wanted):
+        continue
+      if crecords != records:
+        df = df.loc[df['redcap_id'].isin(records.split(','))]
+        df.index = pd.RangeIndex(1, len(df) + 1)
+      return df
+    return None
+
+  # Same arguments, result & exceptions as pushRCRecord
+  def pushRCRecord(self, api_url, api_token, form, df):
+    try:
+      result = self.push(api_url, api_token, form, df)
+    except Exception:
+      # The push failed and we can't tell what (if anything) was written
+      self.invalidate(api_url, api_token)
+      raise
+    with self.lock:
+      for key in list(self.frames.keys()):
+        if key[:2] == (api_url, api_token) and not self._apply(self.frames[key], df):
+          del self.frames[key]
+    return result
+
+  # Write pushed rows into a cached frame. A row without redcap_repeat_instance updates the
+  # record's non-repeating row(s); one without redcap_event_name matches any event.
+  # Returns False if some pushed row isn't in the frame.
+  def _apply(self, cached, df):
+    for row in df.to_dict('records'):
+      match = cached['redcap_id'] == str(row['redcap_id'])
+      for col in ['redcap_event_name','redcap_repeat_instance']:
+        if col in cached.columns:
+          val = row.get(col, '') if col == 'redcap_repeat_instance' else row.get(col)
+          if val is not None:
+            match &= cached[col] == ('' if pd.isna(val) else str(val))
+      if not match.any():
+        return False
+      for col, val in row.items():
+        if col in cached.columns:
+          cached.loc[match, col] = '' if pd.isna(val) else str(val)
+    return True
+
+  # Forget everything pulled from one project, e.g. after it was changed by someone else
+  def invalidate(self, api_url, api_token):
+    with self.lock:
+      for key in list(self.frames.keys()):
+        if key[:2] == (api_url, api_token):
+          del self.frames[key]
@@ -0,0 +1,245 @@
+import re
+import sqlite3
+import time
+import threading
+import difflib
+import unicodedata
+import pandas as pd
+
+# Persistent index of enrolled subjects for duplicate checks, backed by a local SQLite file.
+# Names are normalized (lower case, accents & punctuation removed), DOBs parsed to YYYY-MM-DD.
+# Each subject is filed under up to three blocking keys -- DOB+sex, sex+initials+birth year (to
+# catch typos in the day/month) and the exact name+sex (so a person without a DOB on one side
+# can still be matched) -- and a probe only compares names against the subjects sharing a key
+# with it, so a check costs a few comparisons however big the cohort is.
+# Names are compared with difflib (either name order); a match needs a similarity of at least
+# threshold when the DOBs agree, and a stricter one when they are one typo apart or one is missing.
+# The index is filled from the data collection project's demographics (rebuild) and kept current
+# with update() as subjects are enrolled or their demographics are saved. Subjects imported through
+# the API (no DET) or deleted are only picked up by a rebuild, so the DET server rebuilds it on a
+# timer; rebuild_dedupe.py does it by hand. Indexes built with older keys report needsRebuild().
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS subjects (
+  dcid TEXT NOT NULL,
+  rep TEXT NOT NULL,
+  first TEXT NOT NULL,
+  last TEXT NOT NULL,
+  dob TEXT NOT NULL,
+  sex TEXT NOT NULL,
+  updated REAL NOT NULL,
+  PRIMARY KEY (dcid, rep)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+  key TEXT NOT NULL,
+  dcid TEXT NOT NULL,
+  rep TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_key ON blocks (key);
+CREATE INDEX IF NOT EXISTS blocks_subject ON blocks (dcid, rep);
+CREATE TABLE IF NOT EXISTS runs (
+  name TEXT PRIMARY KEY,
+  lastrun REAL NOT NULL
+);
+'''
+
+NONALPHA = re.compile('[^a-z]')
+
+# Bump when blockKeys changes, so existing indexes get rebuilt
+VERSION = 2
+
+def normalizeName(name):
+  if not isinstance(name, str):
+    return ''
+  name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+  return NONALPHA.sub('', name.lower())
+
+# Normalize the name/DOB/sex columns of a frame with columns first, last, dob, sex
+def normalizeFrame(df):
+  norm = pd.DataFrame(index=df.index)
+  norm['first'] = df['first'].map(normalizeName)
+  norm['last'] = df['last'].map(normalizeName)
+  norm['dob'] = pd.to_datetime(df['dob'], errors='coerce').dt.strftime('%Y-%m-%d').fillna('')
+  norm['sex'] = df['sex'].fillna('').astype(str).str.strip()
+  return norm
+
+def blockKeys(first, last, dob, sex):
+  keys = []
+  if dob != '':
+    keys.append('d:' + dob + '|' + sex)
+    if first != '' and last != '':
+      keys.append('n:' + sex + first[0] + last[0] + '|' + dob[:4])
+  if first != '' and last != '':
+    keys.append('e:' + sex + '|' + first + '|' + last)
+  return keys
+
+# DOBs that differ in a single character, or have day & month swapped
+def dobNear(a, b):
+  if len(a) != 10 or len(b) != 10:
+    return False
+  if sum(x != y for x, y in zip(a, b)) == 1:
+    return True
+  return a[:4] == b[:4] and a[5:7] == b[8:10] and a[8:10] == b[5:7]
+
+def nameSimilarity(first, last, cfirst, clast):
+  name = first + ' ' + last
+  best = 0
+  for cand in [cfirst + ' ' + clast, clast + ' ' + cfirst]:
+    sm = difflib.SequenceMatcher(None, name, cand)
+    if sm.real_quick_ratio() > best and sm.quick_ratio() > best:
+      best = max(best, sm.ratio())
+  return best
+
+class SubjectIndex:
+  def __init__(self, dbpath, threshold=0.88):
+    self.dbpath = dbpath
+    self.threshold = threshold
+    # Required similarity when the DOBs differ by a typo or one is missing
+    self.strict = threshold + (1 - threshold) / 2
+    self.timer = None
+    db = self._connect()
+    try:
+      db.execute('PRAGMA journal_mode=WAL')
+      db.executescript(SCHEMA)
+    finally:
+      db.close()
+
+  def _connect(self):
+    return sqlite3.connect(self.dbpath, timeout=30, isolation_level=None)
+
+  # True if the index is empty or was built with another version's blocking keys
+  def needsRebuild(self):
+    db = self._connect()
+    try:
+      version = db.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+      db.close()
+    return version != VERSION or self.count() == 0
+
+  def count(self):
+    db = self._connect()
+    try:
+      return db.execute('SELECT COUNT(*) FROM subjects').fetchone()[0]
+    finally:
+      db.close()
+
+  # Add or replace subjects; df has columns dcid, rep, first, last, dob, sex
+  def update(self, df, replace=False):
+    norm = normalizeFrame(df)
+    now = time.time()
+    db = self._connect()
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      if replace:
+        db.execute('DELETE FROM subjects')
+        db.execute('DELETE FROM blocks')
+        db.execute('PRAGMA user_version = ' + str(VERSION))
+      for dcid, rep, first, last, dob, sex in zip(df['dcid'].astype(str), df['rep'].astype(str), norm['first'], norm['last'], norm['dob'], norm['sex']):
+        db.execute('INSERT OR REPLACE INTO subjects (dcid, rep, first, last, dob, sex, updated) VALUES (?,?,?,?,?,?,?)', (dcid, rep, first, last, dob, sex, now))
+        db.execute('DELETE FROM blocks WHERE dcid = ? AND rep = ?', (dcid, rep))
+        db.executemany('INSERT INTO blocks (key, dcid, rep) VALUES (?,?,?)', [(k, dcid, rep) for k in blockKeys(first, last, dob, sex)])
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    finally:
+      db.close()
+
+  # Same as update, for rows of the data collection project's demographics form
+  def updateFromDemographics(self, demo, replace=False):
+    demo = demo.loc[demo['redcap_repeat_instance'] != '']
+    self.update(pd.DataFrame({'dcid':demo['redcap_id'], 'rep':demo['redcap_repeat_instance'], 'first':demo['demo_firstname'],
+      'last':demo['demo_lastname'], 'dob':demo['demo_dob'], 'sex':demo['demo_sex']}), replace)
+
+  # Replace the whole index with the subjects in demo
+  def rebuild(self, demo):
+    self.updateFromDemographics(demo, replace=True)
+
+  # Rebuild from fetch() (a demographics export) every interval seconds on a daemon thread. Every
+  # worker can start one: only one of them rebuilds per interval (see claimRun)
+  def startTimer(self, interval, fetch):
+    def tick():
+      try:
+        if self.claimRun('rebuild', interval):
+          self.rebuild(fetch())
+      except Exception as e:
+        print('WARNING: Duplicate index rebuild failed: ' + str(e))
+      self.startTimer(interval, fetch)
+    self.timer = threading.Timer(interval, tick)
+    self.timer.daemon = True
+    self.timer.start()
+
+  def stopTimer(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+
+  # Claim a periodic job (name) for this process: True, with the time recorded, unless a process
+  # sharing this file has run it in the last interval seconds. Lets every worker run the same timer
+  # while the work itself happens about once per interval
+  def claimRun(self, name, interval):
+    now = time.time()
+    db = self._connect()
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      row = db.execute('SELECT lastrun FROM runs WHERE name = ?', (name,)).fetchone()
+      claimed = row is None or now - row[0] >= interval * 0.9
+      if claimed:
+        db.execute('INSERT OR REPLACE INTO runs (name, lastrun) VALUES (?,?)', (name, now))
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    finally:
+      db.close()
+    return claimed
+
+  def _candidates(self, db, keys):
+    if len(keys) == 0:
+      return []
+    qmarks = ','.join('?' * len(keys))
+    return db.execute('SELECT DISTINCT s.dcid, s.rep, s.first, s.last, s.dob, s.sex FROM blocks b JOIN subjects s ON s.dcid = b.dcid AND s.rep = b.rep WHERE b.key IN (' + qmarks + ')', keys).fetchall()
+
+  def _score(self, first, last, dob, cand):
+    score = nameSimilarity(first, last, cand[2], cand[3])
+    if dob == '' or cand[4] == '':
+      return score if score >= self.strict else None
+    if cand[4] == dob:
+      return score if score >= self.threshold else None
+    if dobNear(dob, cand[4]) and score >= self.strict:
+      return score
+    return None
+
+  # Indexed subjects that look like this person, best first: list of (dcid, rep, score)
+  def match(self, first, last, dob, sex):
+    norm = normalizeFrame(pd.DataFrame({'first':[first], 'last':[last], 'dob':[dob], 'sex':[sex]})).iloc[0]
+    db = self._connect()
+    try:
+      cands = self._candidates(db, blockKeys(norm['first'], norm['last'], norm['dob'], norm['sex']))
+    finally:
+      db.close()
+    found = []
+    for cand in cands:
+      score = self._score(norm['first'], norm['last'], norm['dob'], cand)
+      if score is not None:
+        found.append((cand[0], cand[1], score))
+    return sorted(found, key=lambda m: -m[2])
+
+  # Best match for every row of df (columns first, last, dob, sex). Returns a frame on df's index
+  # with columns dcid, rep, score (blank/0 where nothing matched)
+  def matchFrame(self, df):
+    norm = normalizeFrame(df)
+    result = pd.DataFrame({'dcid':'', 'rep':'', 'score':0.0}, index=df.index)
+    db = self._connect()
+    try:
+      for i, first, last, dob, sex in zip(norm.index, norm['first'], norm['last'], norm['dob'], norm['sex']):
+        best = None
+        for cand in self._candidates(db, blockKeys(first, last, dob, sex)):
+          score = self._score(first, last, dob, cand)
+          if score is not None and (best is None or score > best[2]):
+            best = (cand[0], cand[1], score)
+        if best is not None:
+          result.loc[i] = list(best)
+    finally:
+      db.close()
+    return result
@@ -0,0 +1,196 @@
+import os
+import re
+import json
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+
+# ICD-10-CM code index, built from the flat file written by transform/icd10/process_icd10_codes.py.
+# The index is a directory of .npy arrays that are opened memory-mapped, so loading it costs no
+# parsing, and every process using the same index (gunicorn workers, the ETL) shares one copy of
+# it in the page cache. It holds:
+#   - the rows (code, description, parent, depth, leaf) in the converter's order
+#   - an open-addressing hash table of the normalized codes (upper case, no dot) for O(1) lookups
+#   - the normalized codes sorted, for prefix lookups by binary search (e.g. all of G40.*)
+#   - an inverted index of description tokens -> rows, for word search
+# Build it with buildICD10Index() (or process_icd10_codes.py --index), open it with getICD10Index().
+
+VERSION = 1
+TOKENPATTERN = re.compile('[a-z0-9]+')
+EMPTY = -1
+
+def normalizeCode(code):
+  return str(code).strip().upper().replace('.', '')
+
+def tokenize(text):
+  return TOKENPATTERN.findall(str(text).lower())
+
+# 32-bit FNV-1a, used for the hash table both when building it and when looking codes up
+def fnv1a(key):
+  h = 0x811c9dc5
+  for b in key:
+    h = ((h ^ b) * 0x01000193) & 0xffffffff
+  return h
+
+# Build the index in outdir from the converter's .csv or .parquet output. The new index is written
+# next to outdir and swapped in with a rename, so processes that have the old one open keep working
+def buildICD10Index(src, outdir):
+  if src.endswith('.parquet'):
+    df = pd.read_parquet(src)
+  else:
+    df = pd.read_csv(src, dtype='str', keep_default_na=False)
+  df = df.loc[df['code'] != ''].drop_duplicates('code').reset_index(drop=True)
+  n = len(df)
+  keys = df['code'].map(normalizeCode)
+  rowof = {code:i for i, code in enumerate(df['code'])}
+  arrays = {}
+  arrays['code'] = df['code'].to_numpy(dtype='S')
+  arrays['key'] = keys.to_numpy(dtype='S')
+  arrays['parent'] = np.array([rowof.get(p, EMPTY) for p in df['parent']], dtype=np.int32) if 'parent' in df else np.full(n, EMPTY, dtype=np.int32)
+  arrays['depth'] = df['depth'].astype(np.int8).to_numpy() if 'depth' in df else np.zeros(n, dtype=np.int8)
+  arrays['leaf'] = df['leaf'].astype(str).isin(['True','true','1']).to_numpy() if 'leaf' in df else np.ones(n, dtype=bool)
+  # Descriptions are stored as one UTF-8 blob plus the offset of each row's text
+  desc = [d.encode('utf8') for d in df['description']]
+  arrays['descoffsets'] = np.concatenate([[0], np.cumsum([len(d) for d in desc])]).astype(np.int64)
+  arrays['descblob'] = np.frombuffer(b''.join(desc), dtype=np.uint8)
+  # Hash table with at least twice as many slots as codes, so probe chains stay short
+  size = 1
+  while size < 2 * n:
+    size *= 2
+  slots = np.full(size, EMPTY, dtype=np.int32)
+  for i, key in enumerate(arrays['key']):
+    h = fnv1a(key) & (size - 1)
+    while slots[h] != EMPTY:
+      h = (h + 1) & (size - 1)
+    slots[h] = i
+  arrays['slots'] = slots
+  order = np.argsort(arrays['key'], kind='stable').astype(np.int32)
+  arrays['sortedkey'] = arrays['key'][order]
+  arrays['sortedrow'] = order
+  # Inverted index: sorted vocabulary, and for each token a run of row numbers in postings
+  postings = {}
+  for i, d in enumerate(df['description']):
+    for token in set(tokenize(d)):
+      postings.setdefault(token, []).append(i)
+  vocab = sorted(postings.keys())
+  arrays['vocab'] = np.array([t.encode('ascii') for t in vocab], dtype='S') if vocab else np.array([], dtype='S1')
+  arrays['postoffsets'] = np.concatenate([[0], np.cumsum([len(postings[t]) for t in vocab])]).astype(np.int64)
+  arrays['postings'] = np.array([i for t in vocab for i in postings[t]], dtype=np.int32)
+
+  outdir = os.path.abspath(outdir)
+  tmpdir = outdir + '.' + str(os.getpid()) + '.tmp'
+  os.makedirs(tmpdir, exist_ok=True)
+  for name, arr in arrays.items():
+    np.save(os.path.join(tmpdir, name + '.npy'), arr)
+  with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+    json.dump({'version':VERSION, 'count':n, 'source':os.path.abspath(src)}, f)
+  old = None
+  if os.path.exists(outdir):
+    old = outdir + '.' + str(os.getpid()) + '.old'
+    os.rename(outdir, old)
+  os.rename(tmpdir, outdir)
+  if old is not None:
+    shutil.rmtree(old, ignore_errors=True)
+  return n
+
+class ICD10Index:
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, 'meta.json')) as f:
+      self.meta = json.load(f)
+    if self.meta.get('version') != VERSION:
+      raise ValueError('ICD-10 index ' + path + ' was built by another version; rebuild it')
+    for name in ['code','key','parent','depth','leaf','descoffsets','descblob','slots','sortedkey','sortedrow','vocab','postoffsets','postings']:
+      setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+    self.mask = len(self.slots) - 1
+
+  def __len__(self):
+    return len(self.code)
+
+  # Row number of a code (with or without the dot, any case), or None
+  def find(self, code):
+    key = normalizeCode(code).encode('ascii', 'ignore')
+    if key == b'':
+      return None
+    h = fnv1a(key) & self.mask
+    while True:
+      row = int(self.slots[h])
+      if row == EMPTY:
+        return None
+      if self.key[row] == key:
+        return row
+      h = (h + 1) & self.mask
+
+  def description(self, row):
+    return bytes(self.descblob[self.descoffsets[row]:self.descoffsets[row + 1]]).decode('utf8')
+
+  def row(self, row):
+    parent = int(self.parent[row])
+    return {'code':self.code[row].decode('ascii'), 'description':self.description(row),
+      'parent':self.code[parent].decode('ascii') if parent != EMPTY else '',
+      'depth':int(self.depth[row]), 'leaf':bool(self.leaf[row])}
+
+  # Exact lookup: the code's row as a dict, or None
+  def lookup(self, code):
+    row = self.find(code)
+    return None if row is None else self.row(row)
+
+  # Row numbers of every code starting with prefix (e.g. 'G40' or 'G40.' for all of G40.*), in code order
+  def prefixRows(self, prefix):
+    lo, hi = prefixRange(self.sortedkey, normalizeCode(prefix).encode('ascii', 'ignore'))
+    return self.sortedrow[lo:hi]
+
+  def prefix(self, prefix, limit=None):
+    rows = self.prefixRows(prefix)
+    return [self.row(r) for r in (rows if limit is None else rows[:limit])]
+
+  # Rows posted under a token; with prefix=True, under every token starting with it
+  def _postings(self, token, prefix=False):
+    t = token.encode('ascii', 'ignore')
+    if prefix:
+      lo, hi = prefixRange(self.vocab, t)
+    elif len(t) > self.vocab.dtype.itemsize:
+      return np.array([], dtype=np.int32)
+    else:
+      lo, hi = np.searchsorted(self.vocab, t, side='left'), np.searchsorted(self.vocab, t, side='right')
+    if hi <= lo:
+      return np.array([], dtype=np.int32)
+    if hi - lo == 1:
+      return np.asarray(self.postings[self.postoffsets[lo]:self.postoffsets[lo + 1]])
+    return np.unique(np.concatenate([self.postings[self.postoffsets[i]:self.postoffsets[i + 1]] for i in range(lo, hi)]))
+
+  # Codes whose description contains every word of text, in code file order. With prefix=True the last
+  # word only has to start a word (for search-as-you-type)
+  def search(self, text, limit=50, prefix=True):
+    tokens = tokenize(text)
+    if not tokens:
+      return []
+    rows = None
+    for i, token in enumerate(tokens):
+      found = self._postings(token, prefix and i == len(tokens) - 1)
+      rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+      if len(rows) == 0:
+        return []
+    return [self.row(r) for r in rows[:limit]]
+
+# Bounds of the entries of sorted fixed-width byte array arr that start with prefix. Values longer than
+# the array's width would be truncated by searchsorted, so those are handled before searching
+def prefixRange(arr, prefix):
+  width = arr.dtype.itemsize
+  if len(prefix) > width:
+    return 0, 0
+  lo = np.searchsorted(arr, prefix, side='left')
+  if len(prefix) == width:
+    return lo, np.searchsorted(arr, prefix, side='right')
+  return lo, np.searchsorted(arr, prefix + b'\xff', side='left')
+
+# One shared, memory-mapped index per path for the whole process
+_indexes = {}
+_indexeslock = threading.Lock()
+
+def getICD10Index(path):
+  with _indexeslock:
+    if path not in _indexes:
+      _indexes[path] = ICD10Index(path)
+    return _indexes[path]
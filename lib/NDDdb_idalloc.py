@@ -0,0 +1,131 @@
+import sqlite3
+import time
+
+# Durable ID sequences shared by every process on this host, backed by a local SQLite file.
+# Each sequence stores the last value handed out; next() bumps and returns it inside an
+# IMMEDIATE transaction, so two concurrent callers (threads or processes) never get the same
+# value and an allocation costs one small write however large the cohort gets.
+# Sequences used by NDDdb_py_modules:
+#   dcid              data collection project record ids
+#   labkey_subjid     LabKey SubjectIDs
+#   fnum:YY           the counter part of F#s given out in year YY (FYYnnnn)
+#   idnum:<dcid>      individual numbers within one family, from 04 up (01-03, 88 & 99 are fixed)
+# Sequences only move forward: seed() raises one to at least the highest value found in
+# REDCap/LabKey, and reconcile() reports sequences that are behind or ahead of their source.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sequences (
+  name TEXT PRIMARY KEY,
+  last INTEGER NOT NULL,
+  updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+  name TEXT PRIMARY KEY,
+  lastrun REAL NOT NULL
+);
+'''
+
+class IDAllocator:
+  def __init__(self, dbpath):
+    self.dbpath = dbpath
+    db = self._connect()
+    try:
+      db.execute('PRAGMA journal_mode=WAL')
+      db.executescript(SCHEMA)
+    finally:
+      db.close()
+
+  def _connect(self):
+    return sqlite3.connect(self.dbpath, timeout=30, isolation_level=None)
+
+  # Claim a periodic job (name) for this process: True, with the time recorded, unless a process
+  # sharing this file has run it in the last interval seconds. Lets every worker run the same timer
+  # while the work itself happens about once per interval
+  def claimRun(self, name, interval):
+    now = time.time()
+    db = self._connect()
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      row = db.execute('SELECT lastrun FROM runs WHERE name = ?', (name,)).fetchone()
+      claimed = row is None or now - row[0] >= interval * 0.9
+      if claimed:
+        db.execute('INSERT OR REPLACE INTO runs (name, lastrun) VALUES (?,?)', (name, now))
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    finally:
+      db.close()
+    return claimed
+
+  # Hand out the next value of sequence name; it's never lower than floor + 1
+  def next(self, name, floor=0):
+    db = self._connect()
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      row = db.execute('SELECT last FROM sequences WHERE name = ?', (name,)).fetchone()
+      value = max(row[0] if row is not None else 0, int(floor)) + 1
+      db.execute('INSERT OR REPLACE INTO sequences (name, last, updated) VALUES (?,?,?)', (name, value, time.time()))
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    finally:
+      db.close()
+    return value
+
+  # Hand out the next n values of sequence name in one transaction
+  def nextBlock(self, name, n, floor=0):
+    db = self._connect()
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      row = db.execute('SELECT last FROM sequences WHERE name = ?', (name,)).fetchone()
+      first = max(row[0] if row is not None else 0, int(floor)) + 1
+      db.execute('INSERT OR REPLACE INTO sequences (name, last, updated) VALUES (?,?,?)', (name, first + n - 1, time.time()))
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    finally:
+      db.close()
+    return list(range(first, first + n))
+
+  # Last value handed out, or None for a sequence that hasn't been used or seeded
+  def last(self, name):
+    db = self._connect()
+    try:
+      row = db.execute('SELECT last FROM sequences WHERE name = ?', (name,)).fetchone()
+    finally:
+      db.close()
+    return row[0] if row is not None else None
+
+  # Raise each sequence in values (name -> highest value in use) to at least that value
+  def seed(self, values):
+    now = time.time()
+    db = self._connect()
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      for name, value in values.items():
+        db.execute('INSERT INTO sequences (name, last, updated) VALUES (?,?,?) ON CONFLICT(name) DO UPDATE SET last = MAX(last, excluded.last), updated = excluded.updated',
+          (name, int(value), now))
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    finally:
+      db.close()
+
+  # Compare sequences with the highest values in use in the source systems (name -> value).
+  # 'behind' sequences would hand out an ID that's already taken; 'ahead' ones have skipped
+  # values (e.g. allocated but never written). With fix=True, behind sequences are seeded.
+  def reconcile(self, values, fix=False):
+    report = []
+    for name, value in sorted(values.items()):
+      last = self.last(name)
+      if last is None or last < value:
+        report.append({'sequence':name, 'allocator':last, 'source':int(value), 'status':'behind'})
+      elif last > value:
+        report.append({'sequence':name, 'allocator':last, 'source':int(value), 'status':'ahead'})
+    if fix:
+      self.seed({r['sequence']:r['source'] for r in report if r['status'] == 'behind'})
+    return report
@@ -0,0 +1,300 @@
+import sqlite3
+import json
+import time
+import threading
+import traceback
+import sys
+from NDDdb_metrics import metrics, setCorrelationID
+
+# Durable queue for REDCap Data Entry Trigger (DET) jobs, backed by a local SQLite database.
+# Routes enqueue the trigger payload and return immediately; worker threads run the pipeline
+# registered for the job later. Failed jobs are retried with exponential backoff and, after
+# maxattempts, left in the table with status 'dead' (the dead-letter queue) for inspection.
+# Jobs for the same (pipeline, record) are run one at a time and in the order they arrived,
+# so two triggers for one record never race. Claims happen inside an IMMEDIATE transaction,
+# which also makes this safe with several server processes sharing one database file.
+# enqueueDebounced() holds a job back for a short window and folds further triggers for the
+# same (pipeline, record) that arrive meanwhile into it, so a burst of saves runs the pipeline
+# once; the handler then gets the list of merged triggers instead of a single payload.
+# A job that works on several records (e.g. a batch enrollment) is enqueued with keys: every
+# (pipeline, record) it touches. It then waits for, and holds up, the jobs of all of those records,
+# exactly as if it were one of them. The keys of each job are kept in the jobkeys table.
+# While a job runs, its worker renews the job's updated time every lease/4 seconds (the heartbeat).
+# Workers regularly put back jobs that have been 'running' without a heartbeat for lease seconds, so a
+# job whose process died (or was recycled by gunicorn) is picked up again within about lease seconds,
+# while a job that simply runs long is left alone.
+#
+# Job statuses: queued -> running -> done | queued (retry) | dead
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  pipeline TEXT NOT NULL,
+  record TEXT NOT NULL,
+  payload TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'queued',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  runat REAL NOT NULL,
+  created REAL NOT NULL,
+  updated REAL NOT NULL,
+  lasterror TEXT NOT NULL DEFAULT '',
+  merged INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, runat);
+CREATE INDEX IF NOT EXISTS jobs_record ON jobs (pipeline, record, status);
+CREATE TABLE IF NOT EXISTS jobkeys (
+  job INTEGER NOT NULL,
+  pipeline TEXT NOT NULL,
+  record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobkeys_job ON jobkeys (job);
+CREATE INDEX IF NOT EXISTS jobkeys_key ON jobkeys (pipeline, record);
+'''
+
+# Oldest runnable job none of whose keys has a job running or an older job waiting
+CLAIMSQL = '''
+SELECT id, pipeline, record, payload, attempts, runat FROM jobs j
+WHERE j.status = 'queued' AND j.runat <= ?
+AND NOT EXISTS (
+  SELECT 1 FROM jobkeys k
+  JOIN jobkeys o ON o.pipeline = k.pipeline AND o.record = k.record AND o.job != k.job
+  JOIN jobs r ON r.id = o.job
+  WHERE k.job = j.id AND (r.status = 'running' OR (r.status = 'queued' AND r.id < j.id)))
+ORDER BY j.runat, j.id LIMIT 1
+'''
+
+class DETJobQueue:
+  def __init__(self, dbpath, handlers, workers=4, maxattempts=5, retrydelay=30, lease=120, pollinterval=1):
+    self.dbpath = dbpath
+    self.handlers = handlers # pipeline name -> callable(payload)
+    self.workers = workers
+    self.maxattempts = maxattempts
+    self.retrydelay = retrydelay # seconds before the first retry; doubles on every attempt
+    self.lease = lease # a running job without a heartbeat for this long is assumed to belong to a dead worker
+    self.pollinterval = pollinterval
+    self.lastrecover = 0
+    self.wakeup = threading.Event()
+    self.stopping = threading.Event()
+    self.threads = []
+    db = self._connect()
+    try:
+      db.execute('PRAGMA journal_mode=WAL')
+      db.executescript(SCHEMA)
+      # Queue databases created before trigger coalescing lack the merged column
+      if 'merged' not in [c[1] for c in db.execute('PRAGMA table_info(jobs)')]:
+        db.execute('ALTER TABLE jobs ADD COLUMN merged INTEGER NOT NULL DEFAULT 0')
+      # ... and jobs queued before jobkeys existed have no keys yet
+      db.execute("INSERT INTO jobkeys (job, pipeline, record) SELECT id, pipeline, record FROM jobs WHERE status IN ('queued','running') AND id NOT IN (SELECT job FROM jobkeys)")
+    finally:
+      db.close()
+
+  # One connection per call keeps the queue usable from any thread. Autocommit mode, so
+  # transactions are only the explicit BEGIN IMMEDIATE blocks below.
+  def _connect(self):
+    return sqlite3.connect(self.dbpath, timeout=30, isolation_level=None)
+
+  # keys: the (pipeline, record)s the job works on, if more than its own
+  def enqueue(self, pipeline, record, payload, delay=0, keys=()):
+    now = time.time()
+    db = self._connect()
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      cur = db.execute('INSERT INTO jobs (pipeline, record, payload, runat, created, updated) VALUES (?,?,?,?,?,?)',
+        (pipeline, str(record), json.dumps(payload), now + delay, now, now))
+      jobid = cur.lastrowid
+      self._addKeys(db, jobid, [(pipeline, record)] + list(keys))
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    finally:
+      db.close()
+    self.wakeup.set()
+    return jobid
+
+  # Queue trigger (a dict) to run after window seconds. If a job for the same (pipeline, record)
+  # is still waiting to start, trigger is added to its list instead (unless an identical trigger
+  # is already there) and the job is pushed back by another window, but never to more than
+  # maxwait seconds after it was first queued. The handler is called with the list of triggers.
+  def enqueueDebounced(self, pipeline, record, trigger, window, maxwait=None):
+    if maxwait is None:
+      maxwait = 6 * window
+    now = time.time()
+    db = self._connect()
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      row = db.execute("SELECT id, payload, created FROM jobs WHERE pipeline = ? AND record = ? AND status = 'queued' AND attempts = 0 ORDER BY id DESC LIMIT 1",
+        (pipeline, str(record))).fetchone()
+      if row is None:
+        cur = db.execute('INSERT INTO jobs (pipeline, record, payload, runat, created, updated) VALUES (?,?,?,?,?,?)',
+          (pipeline, str(record), json.dumps([trigger]), now + window, now, now))
+        jobid = cur.lastrowid
+        self._addKeys(db, jobid, [(pipeline, record)])
+      else:
+        jobid = row[0]
+        triggers = json.loads(row[1])
+        if trigger not in triggers:
+          triggers.append(trigger)
+        runat = min(now + window, row[2] + maxwait)
+        db.execute('UPDATE jobs SET payload = ?, runat = ?, updated = ?, merged = merged + 1 WHERE id = ?', (json.dumps(triggers), runat, now, jobid))
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    finally:
+      db.close()
+    self.wakeup.set()
+    return jobid
+
+  def _addKeys(self, db, jobid, keys):
+    db.executemany('INSERT INTO jobkeys (job, pipeline, record) VALUES (?,?,?)', set((jobid, p, str(r)) for p, r in keys))
+
+  def claim(self):
+    db = self._connect()
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      row = db.execute(CLAIMSQL, (time.time(),)).fetchone()
+      if row is None:
+        db.execute('COMMIT')
+        return None
+      db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, updated = ? WHERE id = ?", (time.time(), row[0]))
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      raise
+    finally:
+      db.close()
+    return {'id':row[0], 'pipeline':row[1], 'record':row[2], 'payload':json.loads(row[3]), 'attempts':row[4] + 1, 'runat':row[5]}
+
+  # Only touches the job if it is still this attempt's (recover() may have handed it to another worker)
+  def _finish(self, job, error=None):
+    now = time.time()
+    mine = " WHERE id = ? AND status = 'running' AND attempts = ?"
+    db = self._connect()
+    try:
+      if error is None:
+        db.execute("UPDATE jobs SET status = 'done', updated = ?, lasterror = ''" + mine, (now, job['id'], job['attempts']))
+      elif job['attempts'] >= self.maxattempts:
+        db.execute("UPDATE jobs SET status = 'dead', updated = ?, lasterror = ?" + mine, (now, error, job['id'], job['attempts']))
+      else:
+        runat = now + self.retrydelay * 2 ** (job['attempts'] - 1)
+        db.execute("UPDATE jobs SET status = 'queued', runat = ?, updated = ?, lasterror = ?" + mine, (runat, now, error, job['id'], job['attempts']))
+    finally:
+      db.close()
+
+  # Renew the running job's updated time every lease/4 seconds until done is set
+  def _heartbeat(self, job, done):
+    while not done.wait(self.lease / 4):
+      db = self._connect()
+      try:
+        db.execute("UPDATE jobs SET updated = ? WHERE id = ? AND status = 'running' AND attempts = ?", (time.time(), job['id'], job['attempts']))
+      except sqlite3.OperationalError as e:
+        print('WARNING: DET job ' + str(job['id']) + ' heartbeat failed: ' + str(e))
+      finally:
+        db.close()
+
+  # Everything logged while the job runs carries the correlation id det-<job id>
+  def runJob(self, job):
+    setCorrelationID('det-' + str(job['id']))
+    print('DET job ' + str(job['id']) + ': ' + job['pipeline'] + ' record ' + job['record'] + ' (attempt ' + str(job['attempts']) + ')')
+    metrics.inc('det_job_wait_seconds_total', (('pipeline', job['pipeline']),), max(0, time.time() - job['runat']))
+    done = threading.Event()
+    heartbeat = threading.Thread(target=self._heartbeat, args=(job, done), name='det-heartbeat-' + str(job['id']), daemon=True)
+    heartbeat.start()
+    try:
+      with metrics.timed('det_job', pipeline=job['pipeline']):
+        self.handlers[job['pipeline']](job['payload'])
+    except Exception:
+      error = traceback.format_exc()
+      print('DET job ' + str(job['id']) + ' failed:\n' + error)
+      done.set()
+      self._finish(job, error)
+    else:
+      done.set()
+      self._finish(job)
+    sys.stdout.flush()
+
+  def _work(self):
+    while not self.stopping.is_set():
+      self._recoverDue()
+      try:
+        job = self.claim()
+      except sqlite3.OperationalError as e:
+        print('WARNING: DET queue claim failed: ' + str(e))
+        job = None
+      if job is None:
+        self.wakeup.wait(self.pollinterval)
+        self.wakeup.clear()
+        continue
+      self.runJob(job)
+
+  # Recover orphaned jobs every lease/4 seconds from whichever worker gets there
+  def _recoverDue(self):
+    if time.time() - self.lastrecover < self.lease / 4:
+      return
+    self.lastrecover = time.time()
+    try:
+      self.recover()
+    except sqlite3.OperationalError as e:
+      print('WARNING: DET queue recovery failed: ' + str(e))
+
+  # Put jobs whose worker died mid-run back in the queue
+  def recover(self):
+    db = self._connect()
+    try:
+      db.execute("UPDATE jobs SET status = 'queued', updated = ? WHERE status = 'running' AND updated < ?", (time.time(), time.time() - self.lease))
+    finally:
+      db.close()
+
+  # Delete finished jobs older than maxage seconds; dead jobs are kept until removed by hand
+  def purge(self, maxage=7*24*3600):
+    db = self._connect()
+    try:
+      db.execute("DELETE FROM jobs WHERE status = 'done' AND updated < ?", (time.time() - maxage,))
+      db.execute('DELETE FROM jobkeys WHERE job NOT IN (SELECT id FROM jobs)')
+    finally:
+      db.close()
+
+  # Status of one job (status, attempts, lasterror...), or None if there is no such job
+  def job(self, jobid):
+    db = self._connect()
+    try:
+      row = db.execute('SELECT id, pipeline, record, status, attempts, created, updated, lasterror FROM jobs WHERE id = ?', (jobid,)).fetchone()
+    finally:
+      db.close()
+    if row is None:
+      return None
+    return dict(zip(['id','pipeline','record','status','attempts','created','updated','lasterror'], row))
+
+  # Number of jobs in each status
+  def counts(self):
+    db = self._connect()
+    try:
+      return dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+    finally:
+      db.close()
+
+  # Triggers received by each pipeline and how many were merged into an already queued job
+  def mergeStats(self):
+    db = self._connect()
+    try:
+      rows = db.execute('SELECT pipeline, COUNT(*) + SUM(merged), SUM(merged) FROM jobs GROUP BY pipeline').fetchall()
+    finally:
+      db.close()
+    return {r[0]:{'triggers':r[1], 'merged':r[2]} for r in rows}
+
+  def start(self):
+    self.recover()
+    self.purge()
+    self.stopping.clear()
+    for i in range(self.workers):
+      t = threading.Thread(target=self._work, name='det-worker-' + str(i), daemon=True)
+      t.start()
+      self.threads.append(t)
+
+  def stop(self, timeout=None):
+    self.stopping.set()
+    self.wakeup.set()
+    for t in self.threads:
+      t.join(timeout)
+    self.threads = []
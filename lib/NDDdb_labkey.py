@@ -0,0 +1,190 @@
+import pandas as pd
+
+import labkey
+from labkey.query import select_rows, insert_rows, update_rows, QueryFilter
+from NDDdb_metrics import metrics
+
+BOOLTEXT = {'1':'true','true':'true','t':'true','yes':'true','y':'true','0':'false','false':'false','f':'false','no':'false','n':'false'}
+
+# Canonical text of a number (5, 5.0, '5' & '5.00' -> '5'; 2.5 -> '2.5'); anything else as it is
+def numberText(v):
+  try:
+    x = float(v)
+  except (TypeError, ValueError):
+    return str(v).strip()
+  if x != x:
+    return ''
+  return str(int(x)) if x.is_integer() else repr(x)
+
+def boolText(v):
+  if isinstance(v, bool):
+    return 'true' if v else 'false'
+  return BOOLTEXT.get(str(v).strip().lower(), str(v).strip())
+
+# Raised by checkWrite when rows of a LabKey write failed
+class LabKeyWriteError(RuntimeError):
+  pass
+
+# The writer methods below report failed rows instead of raising. Where later steps depend on the
+# write (e.g. an ID is only marked in REDCap once its LabKey row exists), pass the results through
+# checkWrite so the caller, and a DET job, fails instead
+def checkWrite(results):
+  failed = results.loc[~results['success'].astype(bool)]
+  if len(failed) > 0:
+    raise LabKeyWriteError(str(len(failed)) + ' of ' + str(len(results)) + ' LabKey rows failed, first ' + str(failed['key'].iloc[0]) + ': ' + str(failed['error'].iloc[0]))
+  return results
+
+# Batched writes of a data frame to one LabKey query (a list or a study dataset).
+# Rows are sent batchsize at a time instead of one request per row. upsert() sends each
+# batch as an update first; if LabKey rejects it because some keys don't exist yet, the
+# keys already present are looked up with a single select, those rows are updated and the
+# rest inserted. When a batch request fails outright, its rows are retried one at a time so
+# that the failure can be pinned to the offending rows. Every method returns a data frame
+# with one row per input row: key, action ('update'/'insert'), success, error.
+# sync() first compares the frame against what LabKey currently holds and only upserts the
+# rows whose content changed (or that are new).
+class LabKeyBulkWriter:
+  def __init__(self, server_context, schema, query, keycol, batchsize=500):
+    self.server_context = server_context
+    self.schema = schema
+    self.query = query
+    self.keycol = keycol
+    self.batchsize = batchsize
+
+  # LabKey's JSON encoder doesn't know numpy types or NaN, so send plain objects & None
+  def _records(self, df):
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+  def _batches(self, rows):
+    for start in range(0, len(rows), self.batchsize):
+      yield rows[start:start + self.batchsize]
+
+  def _result(self, row, action, success, error=''):
+    return {'key':row.get(self.keycol), 'action':action, 'success':success, 'error':error}
+
+  # One insert_rows/update_rows call, timed & counted
+  def _write(self, func, action, rows):
+    with metrics.timed('labkey_write', schema=self.schema, query=self.query, action=action) as m:
+      m['rows'] = len(rows)
+      func(self.server_context, self.schema, self.query, rows)
+
+  # Send rows in batches with func (insert_rows/update_rows); on a failed batch fall back to single rows
+  def _send(self, func, action, rows):
+    results = []
+    for batch in self._batches(rows):
+      try:
+        self._write(func, action, batch)
+        results.extend(self._result(row, action, True) for row in batch)
+      except labkey.exceptions.RequestError:
+        for row in batch:
+          try:
+            self._write(func, action, [row])
+            results.append(self._result(row, action, True))
+          except labkey.exceptions.RequestError as e:
+            print('ERROR: Could not ' + action + ' ' + self.query + ' row ' + str(row.get(self.keycol)) + ': ' + str(e))
+            results.append(self._result(row, action, False, str(e)))
+    return results
+
+  # Return the subset of keys that already have a row in LabKey
+  def existingKeys(self, keys):
+    found = set()
+    for batch in self._batches(list(keys)):
+      qfilter = QueryFilter(self.keycol, ';'.join(str(k) for k in batch), QueryFilter.Types.IN)
+      with metrics.timed('labkey_select', schema=self.schema, query=self.query) as m:
+        res = select_rows(self.server_context, self.schema, self.query, filter_array=[qfilter], columns=self.keycol)
+        m['rows'] = len(res['rows'])
+      found.update(str(r[self.keycol]) for r in res['rows'])
+    return found
+
+  def insert(self, df):
+    return pd.DataFrame(self._send(insert_rows, 'insert', self._records(df)), columns=['key','action','success','error'])
+
+  def update(self, df):
+    return pd.DataFrame(self._send(update_rows, 'update', self._records(df)), columns=['key','action','success','error'])
+
+  def upsert(self, df):
+    results = []
+    for batch in self._batches(self._records(df)):
+      try:
+        self._write(update_rows, 'update', batch)
+        results.extend(self._result(row, 'update', True) for row in batch)
+        continue
+      except labkey.exceptions.RequestError:
+        pass
+      # Some rows in this batch aren't in LabKey yet: update the ones that are & insert the rest
+      existing = self.existingKeys(set(str(row.get(self.keycol)) for row in batch))
+      results.extend(self._send(update_rows, 'update', [row for row in batch if str(row.get(self.keycol)) in existing]))
+      results.extend(self._send(insert_rows, 'insert', [row for row in batch if str(row.get(self.keycol)) not in existing]))
+    return pd.DataFrame(results, columns=['key','action','success','error'])
+
+  # Kind of each column ('bool', 'number' or 'text'), from the typed JSON values LabKey returns for it
+  def columnKinds(self, current, cols):
+    kinds = {}
+    for col in cols:
+      values = current[col].dropna() if col in current else pd.Series([], dtype=object)
+      values = values.loc[values != '']
+      if len(values) > 0 and values.map(lambda v: isinstance(v, bool)).all():
+        kinds[col] = 'bool'
+      elif len(values) > 0 and values.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)).all():
+        kinds[col] = 'number'
+      else:
+        kinds[col] = 'text'
+    return kinds
+
+  # Both sides are turned into the same text before hashing: LabKey hands dates back in its own format,
+  # so dates are compared as parsed timestamps; numbers are written canonically (5, 5.0 & '5' -> '5')
+  # and booleans as 'true'/'false' (True, '1', 'yes' & 't' -> 'true'), going by the column's kind in LabKey
+  def _normalize(self, df, cols, datecols, kinds=None):
+    kinds = kinds or {}
+    norm = df[cols].astype(object).where(df[cols].notna(), '')
+    for col in cols:
+      if col in datecols:
+        norm[col] = pd.to_datetime(norm[col], errors='coerce').dt.strftime('%Y-%m-%d %H:%M').fillna('')
+      elif kinds.get(col) == 'number':
+        norm[col] = norm[col].map(numberText)
+      elif kinds.get(col) == 'bool':
+        norm[col] = norm[col].map(boolText)
+    return norm.astype(str)
+
+  # Hash of each row's content, indexed on its key
+  def rowHashes(self, df, cols, datecols=('date',), kinds=None):
+    hashes = pd.util.hash_pandas_object(self._normalize(df, cols, datecols, kinds), index=False)
+    return pd.Series(hashes.values, index=df[self.keycol].astype(str).values)
+
+  # Everything LabKey currently holds for the given columns
+  def currentRows(self, cols):
+    with metrics.timed('labkey_select', schema=self.schema, query=self.query) as m:
+      res = select_rows(self.server_context, self.schema, self.query, columns=','.join(cols), max_rows=-1)
+      m['rows'] = len(res['rows'])
+    return pd.DataFrame(res['rows'], columns=cols)
+
+  # Rows of df that are new or differ from the row LabKey holds under the same key (current: LabKey's
+  # rows, if already fetched)
+  def changedRows(self, df, datecols=('date',), current=None):
+    cols = [self.keycol] + [c for c in df.columns if c != self.keycol]
+    if current is None:
+      current = self.currentRows(cols)
+    kinds = self.columnKinds(current, cols)
+    new = self.rowHashes(df, cols, datecols, kinds)
+    old = self.rowHashes(current, cols, datecols, kinds)
+    old = old[~old.index.duplicated()]
+    unchanged = new.values == old.reindex(new.index).values
+    return df.loc[~unchanged]
+
+  # Check the diff against itself: LabKey's own rows, written out as text the way the ETL writes them,
+  # must come back unchanged. Returns the number of rows the diff gets wrong (0 when it works)
+  def checkDiff(self, cols):
+    cols = [self.keycol] + [c for c in cols if c != self.keycol]
+    current = self.currentRows(cols)
+    astext = current.astype(object).where(current.notna(), '')
+    for col in cols:
+      astext[col] = astext[col].map(lambda v: ('1' if v else '0') if isinstance(v, bool) else numberText(v) if isinstance(v, float) else str(v))
+    spurious = self.changedRows(astext, current=current)
+    if len(spurious) > 0:
+      print('WARNING: ' + self.schema + '.' + self.query + ': ' + str(len(spurious)) + ' unchanged rows look changed to the diff')
+    return len(spurious)
+
+  def sync(self, df, datecols=('date',)):
+    changed = self.changedRows(df, datecols)
+    print(self.schema + '.' + self.query + ': ' + str(len(changed)) + ' of ' + str(len(df)) + ' rows new or changed')
+    return self.upsert(changed)
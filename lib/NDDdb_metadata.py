@@ -0,0 +1,185 @@
+import re
+import time
+import threading
+import numpy as np
+import pandas as pd
+
+# REDCap choices regexes
+CHOICEPATTERN = re.compile('^\s*([0-9]+),\s*(.*)\s*$')
+ALTPATTERN = re.compile('^\s*(.*),\s*(.*)\s*$')
+# HTML decoration/tags found in some labels (e.g. the Epi25 data dictionary)
+MARKUPPATTERN = re.compile('\[.*\]|<(br|div).*>')
+
+# Column names in a data dictionary downloaded from the REDCap UI -> names used by the API
+DDFILECOLUMNS = {
+  'Variable / Field Name':'field_name',
+  'Form Name':'form_name',
+  'Section Header':'section_header',
+  'Field Type':'field_type',
+  'Field Label':'field_label',
+  'Choices, Calculations, OR Slider Labels':'select_choices_or_calculations',
+  'Field Note':'field_note',
+  'Text Validation Type OR Show Slider Number':'text_validation_type_or_show_slider_number',
+  'Text Validation Min':'text_validation_min',
+  'Text Validation Max':'text_validation_max',
+  'Identifier?':'identifier',
+  'Branching Logic (Show field only if...)':'branching_logic',
+  'Required Field?':'required_field',
+  'Custom Alignment':'custom_alignment',
+  'Question Number (surveys only)':'question_number',
+  'Matrix Group Name':'matrix_group_name',
+  'Matrix Ranking?':'matrix_ranking',
+  'Field Annotation':'field_annotation'
+}
+
+# Parse map of choices from REDCap data dictionary -> Python dictionary of code:label
+def parseChoices(optstr, stripmarkup=False):
+  choicesmap = {}
+  if not isinstance(optstr, str):
+    return choicesmap
+  for opt in optstr.split('|'):
+    if stripmarkup:
+      opt = MARKUPPATTERN.sub('', opt)
+    opt = opt.rstrip()
+    parsed = CHOICEPATTERN.search(opt)
+    if parsed is None:
+      parsed = ALTPATTERN.search(opt)
+      if parsed is None:
+        continue
+    choicesmap[parsed.group(1)] = parsed.group(2)
+  return choicesmap
+
+# Convert a column of dropdown/radio codes to labels. Each distinct code is looked up once
+# (factorize), and the labels are then taken for every row by position. Values that aren't
+# in the map are left as they are, like Series.replace would.
+def decodeChoices(s, choicemap):
+  codes, uniques = pd.factorize(s)
+  labels = np.array([choicemap.get(u, u) for u in uniques] + [np.nan], dtype=object)
+  return pd.Series(labels[codes], index=s.index, name=s.name)
+
+# Map (field, code) -> export column for every 'field___code' checkbox column in columns
+def indexCheckboxColumns(columns):
+  cbindex = {}
+  for col in columns:
+    field, sep, code = col.rpartition('___')
+    if sep:
+      cbindex[(field, code.lower())] = col
+  return cbindex
+
+# Convert a checkbox field's 'field___code' columns to a single ';'-delimited string of the checked
+# options' labels. The columns are compared to '1' as one boolean matrix, which is multiplied by
+# the labels (True*'label;' == 'label;', False*'label;' == '') and summed across each row.
+# Raises KeyError if an option in choicemap has no column in cbindex.
+def decodeCheckboxes(frame, field, choicemap, cbindex):
+  cols = [cbindex[(field, str(code).lower())] for code in choicemap.keys()]
+  if not cols:
+    return pd.Series('', index=frame.index, name=field)
+  checked = frame[cols].to_numpy() == '1'
+  labels = np.array([label + ';' for label in choicemap.values()], dtype=object)
+  joined = (checked * labels).sum(axis=1)
+  return pd.Series(joined, index=frame.index, name=field).str[:-1]
+
+# The reverse of decodeCheckboxes: turn a column of sep-delimited option labels into 0/1
+# 'field___code' columns, one per option in labelmap (label -> code), in labelmap's order.
+# The column is exploded into one (row, label) pair per selected option, the labels are looked
+# up in labelmap once as a dictionary join, and the indicator matrix is filled from the
+# (row, code) positions in one pass. Also returns the labels that aren't in labelmap, as a
+# Series on the exploded rows (the same index label repeats for a row with several).
+def encodeCheckboxes(s, field, labelmap, sep=';'):
+  codes = list(dict.fromkeys(labelmap.values()))
+  parts = s.reset_index(drop=True).fillna('').astype(str).str.split(sep).explode().str.strip()
+  parts = parts.loc[parts != '']
+  codepos = parts.map({label:codes.index(code) for label, code in labelmap.items()})
+  mapped = codepos.notna()
+  unmapped = parts.loc[~mapped]
+  unmapped.index = s.index[unmapped.index]
+  onehot = np.zeros((len(s), len(codes)), dtype=np.int8)
+  onehot[codepos.index[mapped], codepos.loc[mapped].astype(int)] = 1
+  coded = pd.DataFrame(onehot, index=s.index, columns=[field + '___' + str(code) for code in codes])
+  return coded, unmapped
+
+# A project's data dictionary, indexed on field_name, with every dropdown/radio/checkbox
+# choice list parsed once into forward (code -> label) and reverse (label -> code) maps
+class RCDataDictionary:
+  def __init__(self, dd, stripmarkup=False):
+    self.dd = dd.set_index(keys='field_name', drop=False, verify_integrity=True)
+    self.choices = {}
+    self.labels = {}
+    for field, fieldtype, optstr in zip(self.dd['field_name'], self.dd['field_type'], self.dd['select_choices_or_calculations']):
+      if fieldtype in ['dropdown','radio','checkbox'] and isinstance(optstr, str) and optstr != '':
+        optmap = parseChoices(optstr, stripmarkup)
+        self.choices[field] = optmap
+        self.labels[field] = {v:k for k,v in optmap.items()}
+    self.loaded = time.time()
+
+  # Load a data dictionary .csv downloaded from the REDCap UI. These contain non-UTF8 chars, so read as latin-1
+  @classmethod
+  def fromFile(cls, fpath, stripmarkup=False):
+    dd = pd.read_csv(fpath, encoding='latin-1', dtype='str', keep_default_na=False)
+    dd.rename(columns=DDFILECOLUMNS, inplace=True)
+    return cls(dd, stripmarkup)
+
+# Process-wide store of data dictionaries. Each (API URL, token, forms) dictionary is fetched
+# once with fetch(api_url, api_token, forms) -- normally NDDdb_py_modules.getMetaData -- and
+# then served from memory until it is older than ttl seconds (if set), refresh() is called
+# (e.g. from a webhook), or the background timer started by startTimer() reloads it.
+class RCMetadataRegistry:
+  def __init__(self, fetch, ttl=None):
+    self.fetch = fetch
+    self.ttl = ttl
+    self.dicts = {}
+    self.lock = threading.Lock()
+    self.keylocks = {} # one lock per dictionary, so different dictionaries can be fetched at the same time
+    self.timer = None
+
+  def _keylock(self, key):
+    with self.lock:
+      return self.keylocks.setdefault(key, threading.Lock())
+
+  def get(self, api_url, api_token, forms=''):
+    key = (api_url, api_token, forms)
+    entry = self.dicts.get(key)
+    if entry is None or (self.ttl is not None and time.time() - entry.loaded > self.ttl):
+      with self._keylock(key):
+        entry = self.dicts.get(key)
+        if entry is None or (self.ttl is not None and time.time() - entry.loaded > self.ttl):
+          entry = RCDataDictionary(self.fetch(api_url, api_token, forms))
+          self.dicts[key] = entry
+    return entry
+
+  # Re-fetch every dictionary already loaded (optionally only those for one project). A dictionary that
+  # fails to load is logged and keeps its old copy, and the rest are still refreshed. Returns the
+  # number that failed
+  def refresh(self, api_url=None, api_token=None):
+    failed = 0
+    for key in list(self.dicts.keys()):
+      if api_url is not None and key[0] != api_url:
+        continue
+      if api_token is not None and key[1] != api_token:
+        continue
+      try:
+        entry = RCDataDictionary(self.fetch(*key))
+      except Exception as e:
+        print('WARNING: Could not refresh the data dictionary for ' + key[0] + ' (forms: ' + str(key[2] or 'all') + '): ' + str(e))
+        failed += 1
+        continue
+      with self.lock:
+        self.dicts[key] = entry
+    return failed
+
+  # Refresh all loaded dictionaries every interval seconds on a daemon thread
+  def startTimer(self, interval):
+    def tick():
+      try:
+        self.refresh()
+      except Exception as e:
+        print('WARNING: Metadata refresh failed: ' + str(e))
+      self.startTimer(interval)
+    self.timer = threading.Timer(interval, tick)
+    self.timer.daemon = True
+    self.timer.start()
+
+  def stopTimer(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
@@ -0,0 +1,290 @@
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# In-process metrics for the REDCap/LabKey helpers and the DET server, rendered in the
+# Prometheus text format by render() (served on /metrics) and, if jsonlogs is on, also written
+# to stdout as one JSON object per call. Every log line carries the correlation id of the DET
+# trigger or HTTP request being handled, which is kept in a context variable, so it follows the
+# work into asyncio.to_thread calls.
+# On its own a registry only knows about its own process. Under gunicorn every worker has one, so
+# share() points them all at one SQLite file: each process adds what it counted since the last flush()
+# to the totals there (every few seconds, see startFlusher, and before each render), and render() reads
+# the totals, so a scrape sees the whole server whichever worker answers it. Counters and histograms
+# are summed over all processes, including exited ones. Gauges are kept per process until that process
+# is gone, and merged by the rule given to describe(): the latest value (default), the max or the sum.
+
+# Latency buckets in seconds, from a cached read up to a full-project export
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS totals (
+  name TEXT NOT NULL,
+  labels TEXT NOT NULL,
+  part INTEGER NOT NULL,
+  value REAL NOT NULL,
+  PRIMARY KEY (name, labels, part)
+);
+CREATE TABLE IF NOT EXISTS gauges (
+  name TEXT NOT NULL,
+  labels TEXT NOT NULL,
+  pid INTEGER NOT NULL,
+  value REAL NOT NULL,
+  updated REAL NOT NULL,
+  PRIMARY KEY (name, labels, pid)
+);
+'''
+
+# Parts of a histogram in the totals table: bucket i, then sum & count; plain counters use COUNTER
+COUNTER = -1
+
+def _pidAlive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+correlation = contextvars.ContextVar('correlation_id', default='')
+
+def newCorrelationID(prefix=''):
+  cid = prefix + uuid.uuid4().hex[:12]
+  correlation.set(cid)
+  return cid
+
+def setCorrelationID(cid):
+  correlation.set(cid)
+
+def _labelstr(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in labels) + '}'
+
+class MetricsRegistry:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.help = {} # name -> (type, help)
+    self.merge = {} # gauge name -> 'last', 'max' or 'sum' across processes
+    self.counters = {} # (name, labels) -> value
+    self.gauges = {}
+    self.histograms = {} # (name, labels) -> [bucket counts..., sum, count]
+    self.projects = {} # token hash -> readable project name
+    self.jsonlogs = False
+    self.dbpath = None
+    self.flusher = None
+
+  def describe(self, name, mtype, helptext, merge='last'):
+    self.help[name] = (mtype, helptext)
+    self.merge[name] = merge
+
+  # Keep totals in the SQLite file dbpath, shared with every other process that calls share() on it
+  def share(self, dbpath):
+    db = sqlite3.connect(dbpath, timeout=30, isolation_level=None)
+    try:
+      db.execute('PRAGMA journal_mode=WAL')
+      db.executescript(SCHEMA)
+    finally:
+      db.close()
+    self.dbpath = dbpath
+
+  # Add the counts since the last flush to the shared totals and store this process's gauges.
+  # Call before forking too, so the children don't inherit (and report again) unflushed counts
+  def flush(self):
+    if self.dbpath is None:
+      return
+    with self.lock:
+      counters, histograms, gauges = self.counters, self.histograms, dict(self.gauges)
+      self.counters, self.histograms = {}, {}
+    rows = [(n, json.dumps(l), COUNTER, v) for (n, l), v in counters.items()]
+    rows += [(n, json.dumps(l), i, v) for (n, l), h in histograms.items() for i, v in enumerate(h) if v != 0]
+    pid = os.getpid()
+    db = sqlite3.connect(self.dbpath, timeout=30, isolation_level=None)
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      db.executemany('INSERT INTO totals (name, labels, part, value) VALUES (?,?,?,?) ON CONFLICT (name, labels, part) DO UPDATE SET value = value + excluded.value', rows)
+      db.executemany('INSERT OR REPLACE INTO gauges (name, labels, pid, value, updated) VALUES (?,?,?,?,?)',
+        [(n, json.dumps(l), pid, v, time.time()) for (n, l), v in gauges.items()])
+      db.execute('COMMIT')
+    except Exception:
+      db.execute('ROLLBACK')
+      # Keep the counts for the next flush
+      with self.lock:
+        for k, v in counters.items():
+          self.counters[k] = self.counters.get(k, 0) + v
+        for k, h in histograms.items():
+          mine = self.histograms.setdefault(k, [0] * len(h))
+          self.histograms[k] = [a + b for a, b in zip(mine, h)]
+      raise
+    finally:
+      db.close()
+
+  # Flush every interval seconds on a daemon thread. Threads don't survive a fork, so start it in
+  # each worker
+  def startFlusher(self, interval=5):
+    def tick():
+      try:
+        self.flush()
+      except sqlite3.Error as e:
+        print('WARNING: Metrics flush failed: ' + str(e))
+      self.startFlusher(interval)
+    self.flusher = threading.Timer(interval, tick)
+    self.flusher.daemon = True
+    self.flusher.start()
+
+  # Totals of every process sharing the file, as (counters, gauges, histograms) like the local ones
+  def _shared(self):
+    db = sqlite3.connect(self.dbpath, timeout=30, isolation_level=None)
+    try:
+      totals = db.execute('SELECT name, labels, part, value FROM totals').fetchall()
+      gaugerows = db.execute('SELECT name, labels, pid, value, updated FROM gauges ORDER BY updated').fetchall()
+      dead = [pid for pid in set(r[2] for r in gaugerows) if not _pidAlive(pid)]
+      if len(dead) > 0:
+        db.executemany('DELETE FROM gauges WHERE pid = ?', [(pid,) for pid in dead])
+    finally:
+      db.close()
+    counters, histograms = {}, {}
+    for name, labels, part, value in totals:
+      key = (name, tuple(tuple(l) for l in json.loads(labels)))
+      if part == COUNTER:
+        counters[key] = value
+      else:
+        histograms.setdefault(key, [0] * (len(BUCKETS) + 2))[part] = value if part == len(BUCKETS) else int(value)
+    values = {}
+    for name, labels, pid, value, updated in gaugerows:
+      if pid not in dead:
+        values.setdefault((name, tuple(tuple(l) for l in json.loads(labels))), []).append(value)
+    gauges = {}
+    for key, vals in values.items():
+      merge = self.merge.get(key[0], 'last')
+      gauges[key] = max(vals) if merge == 'max' else sum(vals) if merge == 'sum' else vals[-1]
+    return counters, gauges, histograms
+
+  def inc(self, name, labels=(), value=1):
+    key = (name, tuple(labels))
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def setGauge(self, name, labels=(), value=0):
+    with self.lock:
+      self.gauges[(name, tuple(labels))] = value
+
+  def observe(self, name, labels=(), value=0):
+    key = (name, tuple(labels))
+    with self.lock:
+      h = self.histograms.get(key)
+      if h is None:
+        h = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+      for i, b in enumerate(BUCKETS):
+        if value <= b:
+          h[i] += 1
+      h[-2] += value
+      h[-1] += 1
+
+  # Label REDCap metrics with a name instead of the token. Unnamed projects get a hash of the token
+  def nameProject(self, api_token, name):
+    self.projects[self.tokenHash(api_token)] = name
+
+  def tokenHash(self, api_token):
+    return hashlib.sha256(api_token.encode('utf8')).hexdigest()[:8]
+
+  def project(self, api_token):
+    h = self.tokenHash(api_token)
+    return self.projects.get(h, h)
+
+  def log(self, event, **fields):
+    if not self.jsonlogs:
+      return
+    rec = {'ts':time.strftime('%Y-%m-%dT%H:%M:%S'), 'event':event, 'correlation_id':correlation.get()}
+    rec.update(fields)
+    print(json.dumps(rec, default=str))
+    sys.stdout.flush()
+
+  # Time the block as one call of name: <name>_calls_total, <name>_errors_total and a
+  # <name>_seconds histogram, all with labels. The block can add numbers (rows, bytes) to the
+  # yielded dict; each becomes a <name>_<key>_total counter and a field of the JSON log line.
+  @contextmanager
+  def timed(self, name, **labels):
+    lbl = tuple(sorted(labels.items()))
+    extra = {}
+    start = time.perf_counter()
+    error = None
+    try:
+      yield extra
+    except BaseException as e:
+      error = e
+      raise
+    finally:
+      elapsed = time.perf_counter() - start
+      self.inc(name + '_calls_total', lbl)
+      self.observe(name + '_seconds', lbl, elapsed)
+      if error is not None:
+        self.inc(name + '_errors_total', lbl)
+      for k, v in extra.items():
+        if isinstance(v, (int, float)):
+          self.inc(name + '_' + k + '_total', lbl, v)
+      self.log(name, seconds=round(elapsed, 4), error=None if error is None else repr(error), **dict(labels, **extra))
+
+  # Everything in the Prometheus text format: this process's metrics, or with share() the whole server's
+  def render(self, extralabels=()):
+    if self.dbpath is not None:
+      self.flush()
+      counters, gauges, histograms = self._shared()
+    else:
+      with self.lock:
+        counters, gauges, histograms = dict(self.counters), dict(self.gauges), {k:list(h) for k, h in self.histograms.items()}
+    extralabels = tuple(extralabels)
+    lines = []
+    names = sorted(set(k[0] for k in list(counters) + list(gauges) + list(histograms)))
+    for name in names:
+      if name in self.help:
+        lines.append('# HELP ' + name + ' ' + self.help[name][1])
+        lines.append('# TYPE ' + name + ' ' + self.help[name][0])
+      elif name in set(k[0] for k in histograms):
+        lines.append('# TYPE ' + name + ' histogram')
+      elif name in set(k[0] for k in counters):
+        lines.append('# TYPE ' + name + ' counter')
+      else:
+        lines.append('# TYPE ' + name + ' gauge')
+      for (n, labels), v in sorted(counters.items()):
+        if n == name:
+          lines.append(name + _labelstr(extralabels + labels) + ' ' + repr(v))
+      for (n, labels), v in sorted(gauges.items()):
+        if n == name:
+          lines.append(name + _labelstr(extralabels + labels) + ' ' + repr(v))
+      for (n, labels), h in sorted(histograms.items()):
+        if n != name:
+          continue
+        for i, b in enumerate(BUCKETS):
+          lines.append(name + '_bucket' + _labelstr(extralabels + labels + (('le', repr(float(b))),)) + ' ' + str(h[i]))
+        lines.append(name + '_bucket' + _labelstr(extralabels + labels + (('le', '+Inf'),)) + ' ' + str(h[-1]))
+        lines.append(name + '_sum' + _labelstr(extralabels + labels) + ' ' + repr(h[-2]))
+        lines.append(name + '_count' + _labelstr(extralabels + labels) + ' ' + str(h[-1]))
+    return '\n'.join(lines) + '\n'
+
+# The registry everything in this process reports to
+metrics = MetricsRegistry()
+metrics.describe('redcap_pull_seconds', 'histogram', 'REDCap record exports, by project and form')
+metrics.describe('redcap_push_seconds', 'histogram', 'REDCap record imports, by project and form')
+metrics.describe('redcap_metadata_seconds', 'histogram', 'REDCap data dictionary exports')
+metrics.describe('labkey_select_seconds', 'histogram', 'LabKey select_rows calls, by schema and query')
+metrics.describe('labkey_write_seconds', 'histogram', 'LabKey insert_rows/update_rows calls, by schema, query and action')
+metrics.describe('det_job_seconds', 'histogram', 'DET pipeline runs')
+metrics.describe('http_request_seconds', 'histogram', 'HTTP requests handled, by endpoint')
+
+# Label for a REDCap forms argument: the form, or the first form and how many more were asked for
+def formsLabel(forms):
+  forms = [f for f in forms.split(',') if f != '']
+  if len(forms) == 0:
+    return ''
+  if len(forms) == 1:
+    return forms[0]
+  return forms[0] + '+' + str(len(forms) - 1)
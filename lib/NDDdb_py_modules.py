@@ -2,22 +2,162 @@ import pycurl
 import io
 import sys
 import csv
+import codecs
 import pandas as pd
 import numpy as np
 import datetime as dt
 import json
 import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import NDDdb_field_maps as NDDmap
+from NDDdb_redcap import REDCapClient, getRCClient, configureRCClient, reopenRCClients
+from NDDdb_redcap import REDCapError, REDCapHTTPError, REDCapTransportError, REDCapUnavailable
+from NDDdb_cache import RCExportCache, privateCacheDir
+from NDDdb_labkey import LabKeyBulkWriter, LabKeyWriteError, checkWrite
+from NDDdb_jobqueue import DETJobQueue
+from NDDdb_context import RecordContext
+from NDDdb_idalloc import IDAllocator
+from NDDdb_dedupe import SubjectIndex
+from NDDdb_metrics import metrics, formsLabel
+from NDDdb_metadata import RCMetadataRegistry, RCDataDictionary, decodeChoices, decodeCheckboxes, encodeCheckboxes, indexCheckboxColumns
+from NDDdb_translate import TranslationPlan
+from NDDdb_icd10 import ICD10Index, getICD10Index, buildICD10Index
 
 import labkey
 from labkey.query import select_rows, insert_rows, update_rows
 
+# Incremental parser for REDCap's CSV exports. An instance is handed to pycurl as the
+# WRITEFUNCTION, so each network chunk is decoded, split into complete CSV records
+# (a record is complete once its double quotes are balanced, which keeps multi-line
+# quoted notes fields together) and parsed as it arrives. Parsed rows are flushed into
+# per-column object arrays every CHUNKROWS rows, so only the current chunk is ever held
+# as raw text or as Python row lists.
+class RCExportReader:
+	CHUNKROWS = 5000
+
+	def __init__(self, chunkrows=None):
+		self.chunkrows = chunkrows or self.CHUNKROWS
+		self.decoder = codecs.getincrementaldecoder('utf8')()
+		self.pending = '' # text received after the last complete record
+		self.record = [] # lines of a record whose quotes haven't been closed yet
+		self.quotes = 0
+		self.header = None
+		self.rows = []
+		self.columns = None
+		self.nrows = 0
+		self.nbytes = 0
+
+	# pycurl write callback
+	def write(self, data):
+		self.nbytes += len(data)
+		try:
+			text = self.decoder.decode(data)
+		except UnicodeDecodeError:
+			# Same fallback as before: treat the rest of the export as latin-1
+			buffered = self.decoder.getstate()[0]
+			self.decoder = codecs.getincrementaldecoder('latin-1')()
+			text = self.decoder.decode(buffered + data)
+		self._feed(text)
+
+	def _feed(self, text):
+		lines = (self.pending + text).split('\n')
+		# The last piece has no newline yet, so hold on to it until the next chunk
+		self.pending = lines.pop()
+		records = []
+		for line in lines:
+			self.record.append(line)
+			self.quotes += line.count('"')
+			if self.quotes % 2 == 0:
+				records.append('\n'.join(self.record))
+				self.record = []
+				self.quotes = 0
+		self._parse(records)
+
+	def _parse(self, records):
+		# Blank lines outside of quotes never held data, so skip them like the old regex split did
+		for rec in csv.reader([r for r in records if r.strip('\r') != ''], delimiter=','):
+			if self.header is None:
+				self.header = rec
+				self.columns = [[] for h in rec]
+			else:
+				self.rows.append(rec)
+		if len(self.rows) >= self.chunkrows:
+			self._flush()
+
+	# Move parsed rows into per-column arrays
+	def _flush(self):
+		if not self.rows:
+			return
+		width = len(self.header)
+		for rec in self.rows:
+			if len(rec) < width:
+				rec.extend([''] * (width - len(rec)))
+		for j, col in enumerate(self.columns):
+			col.append(np.array([rec[j] for rec in self.rows], dtype=object))
+		self.nrows += len(self.rows)
+		self.rows = []
+
+	# Parse whatever is left & assemble the data frame. Returns None if the export was empty.
+	def close(self):
+		tail = self.decoder.decode(b'', final=True)
+		self._feed(tail + '\n')
+		if self.record:
+			# Unbalanced quotes at the end of the export; let the csv module make sense of it
+			self._parse(['\n'.join(self.record)])
+			self.record = []
+		if self.header is None:
+			return None
+		self._flush()
+		data = {}
+		for h, col in zip(self.header, self.columns):
+			data[h] = np.concatenate(col) if col else np.array([], dtype=object)
+			col.clear()
+		# Keep the 1-based row index that callers have always relied on (e.g. .loc[1,...])
+		df = pd.DataFrame(data, index=pd.RangeIndex(1, self.nrows + 1), columns=self.header)
+		return df
+
+# Optional on-disk cache of record exports (see NDDdb_cache). When set, pushRCRecord drops the
+# cached exports of the project it writes to. Processes that need live data (e.g. the DET server)
+# can set the cache with pulls=False, so their pushes still invalidate it but their pulls bypass it.
+# With stores=True as well, those pulls still write their fresh exports to the cache for others.
+_rccache = None
+_rccachepulls = False
+_rccachestores = False
+
+def setRCCache(cache, pulls=True, stores=None):
+	global _rccache, _rccachepulls, _rccachestores
+	_rccache = cache
+	_rccachepulls = pulls
+	_rccachestores = pulls if stores is None else stores
+
+def invalidateRCCache(api_url, api_token):
+	if _rccache is not None:
+		_rccache.invalidate(api_url, api_token)
+
 # Select row from REDCap & populate data frame
-def pullRCRecords(api_url, api_token, forms, records, fields):
+# If dateRangeBegin ('YYYY-MM-DD HH:MM:SS') is given, only records created or modified since then are returned
+def pullRCRecords(api_url, api_token, forms, records, fields, dateRangeBegin=''):
+	with metrics.timed('redcap_pull', project=metrics.project(api_token), form=formsLabel(forms)) as m:
+		df = _pullRCRecords(api_url, api_token, forms, records, fields, dateRangeBegin, m)
+		m['rows'] = len(df)
+	return(df)
 
-	buf = io.BytesIO()
+def _pullRCRecords(api_url, api_token, forms, records, fields, dateRangeBegin, m):
 
-	fields = [
+	# Serve repeat pulls from the on-disk cache if one is set. Delta pulls are never repeated, so they skip it
+	usecache = _rccache is not None and _rccachepulls and not dateRangeBegin
+	if usecache:
+		df = _rccache.get(api_url, api_token, forms, fields, records)
+		if df is not None:
+			m['cache_hits'] = 1
+			return(df)
+	# Note the project's cache generation before pulling, so the export isn't stored if a push invalidates it meanwhile
+	store = _rccache is not None and _rccachestores and not dateRangeBegin
+	generation = _rccache.generation(api_url, api_token) if store else None
+
+	postfields = [
 		('token', api_token),
 		('content', 'record'),
 		('format', 'csv'),
@@ -26,45 +166,54 @@ def pullRCRecords(api_url, api_token, forms, records, fields):
 		('records', records),
 		('fields', fields)
 	]
+	if dateRangeBegin:
+		postfields.append(('dateRangeBegin', dateRangeBegin))
 
-	ch = pycurl.Curl()
-	ch.setopt(ch.URL, api_url)
-	ch.setopt(ch.HTTPPOST, fields)
-	ch.setopt(ch.WRITEFUNCTION, buf.write)
-	#ch.setopt(pycurl.VERBOSE, 1) #for debugging
-	ch.setopt(pycurl.SSL_VERIFYPEER, 1) # 1 = Curl verifies whether the certificate is authentic
-	ch.setopt(pycurl.SSL_VERIFYHOST, 2) # 2 = Curl verifies that the server you're communicating with is the same as the one on the cert
-	ch.perform()
-	response_code = ch.getinfo(pycurl.HTTP_CODE)
-	ch.close()
-
-	#If the request was not successful, terminate
-	if response_code!=200:
-		sys.exit('Error communicating with REDCap database: could not pull participant records from REDCap.')
-
-	#convert bytestream to bytes...
-	bytereport = buf.getvalue()
-	buf.close()
-	#...to string...
-	try:
-		stringreport = bytereport.decode('utf8')
-	except UnicodeDecodeError:
-		stringreport = bytereport.decode('latin-1')
-		stringreport.encode('utf8')
-	#...to list of strings by matching things that are either in quotes or things that aren't newlines
-	linesplit = re.findall('(?:"[^"]*"|.)+', stringreport)
-	# make dataframe to hold results
-	df = pd.DataFrame(list(list(rec) for rec in csv.reader(linesplit, delimiter=',')))
-	# If dataframe isn't empty, make first row the header. If it is, pull the form's metadata to get column names
-	if not df.empty:
-		header = df.iloc[0]
-		df = df[1:]
-		df.columns = header
-	else:
-		df = pd.DataFrame(columns=getMetaData(api_url,api_token,forms)['field_name'])
+	# Send through the shared, connection-reusing client for this API URL. Exports are safe to repeat,
+	# so transient failures are retried; anything else raises a REDCapError
+	reader = getRCClient(api_url).request(postfields, RCExportReader)
+	m['bytes'] = reader.nbytes
+
+	# Finish parsing the stream. If nothing came back, pull the form's metadata to get column names
+	df = reader.close()
+	if df is None:
+		df = pd.DataFrame(columns=metadata.get(api_url,api_token,forms).dd['field_name'])
+	elif store:
+		_rccache.put(api_url, api_token, forms, fields, records, df, generation=generation)
 	return(df)
 
-# Insert/update REDCap with data frame
+# Pull a long list of forms in chunks of chunksize forms at a time, with at most `workers`
+# chunk exports running against REDCap at once, then line the chunks up side by side on
+# keyfields. Every chunk is reindexed onto one MultiIndex built from the union of all chunks'
+# keys, so the combine is a single concat instead of a chain of pairwise outer merges.
+def pullRCRecordsChunked(api_url, api_token, forms, keyfields, chunksize=10, workers=4, dateRangeBegin=''):
+  chunks = [forms[i:i + chunksize] for i in range(0, len(forms), chunksize)]
+  def pullChunk(n, chunk):
+    start = time.perf_counter()
+    df = pullRCRecords(api_url, api_token, ','.join(chunk), '', ','.join(keyfields), dateRangeBegin)
+    print('Chunk ' + str(n) + '/' + str(len(chunks)) + ' (' + str(len(chunk)) + ' forms): ' + str(len(df)) + ' rows, ' + str(len(df.columns)) + ' columns in ' + '{:.1f}'.format(time.perf_counter() - start) + 's')
+    sys.stdout.flush()
+    return df
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    frames = list(pool.map(pullChunk, range(1, len(chunks) + 1), chunks))
+  # An empty chunk comes back with data dictionary columns only, so make sure the keys exist
+  frames = [df.reindex(columns=keyfields + [c for c in df.columns if c not in keyfields]).set_index(keyfields) for df in frames]
+  keys = frames[0].index.append([df.index for df in frames[1:]]).unique()
+  rc = pd.concat([df.reindex(keys) for df in frames], axis=1)
+  rc.reset_index(inplace=True)
+  print('Pulled ' + str(len(forms)) + ' forms in ' + str(len(chunks)) + ' chunks (' + str(workers) + ' workers): ' + '{:.1f}'.format(time.perf_counter() - start) + 's')
+  return rc
+
+# Whether importing df twice leaves REDCap as importing it once: true unless a row asks for a new
+# repeat instance, since every other row names the record (and instance) it overwrites
+def isIdempotentImport(df):
+	if 'redcap_repeat_instance' not in df.columns:
+		return True
+	return not (df['redcap_repeat_instance'].astype(str) == 'new').any()
+
+# Insert/update REDCap with data frame. Returns the number of records updated (as a string);
+# raises a REDCapError if the import failed
 def pushRCRecord(api_url, api_token, form, df):
 	to_update = df.to_dict('records')
 	to_update_json = json.dumps(to_update, separators=(',',':'))
@@ -75,32 +224,33 @@ def pushRCRecord(api_url, api_token, form, df):
 	    ('data',to_update_json)
 	]
 	print(payload)
-	buf = io.BytesIO()
-	ch = pycurl.Curl()
-	ch.setopt(ch.URL, api_url)
-	ch.setopt(ch.HTTPPOST, payload)
-	ch.setopt(ch.WRITEFUNCTION, buf.write)
-	ch.setopt(pycurl.VERBOSE, 1) #for debugging
-	ch.setopt(pycurl.SSL_VERIFYPEER, 1) # 1 = Curl verifies whether the certificate is authentic
-	ch.setopt(pycurl.SSL_VERIFYHOST, 2) # 2 = Curl verifies that the server you're communicating with is the same as the one on the cert
 	try:
-		ch.perform()
-	except pycurl.error:
-		print('BIG TROUBLE')
-	response_code = ch.getinfo(pycurl.HTTP_CODE)
-	ch.close()
-	# If the request was not successful, terminate
-	if response_code!=200:
-		return('Error communicating with REDCap database.')
+		with metrics.timed('redcap_push', project=metrics.project(api_token), form=formsLabel(form)) as m:
+			m['rows'] = len(df)
+			m['bytes'] = len(to_update_json)
+			buf = getRCClient(api_url).request(payload, io.BytesIO, idempotent=isIdempotentImport(df), verbose=True) # verbose for debugging
+	finally:
+		# Whatever happened, cached exports of this project may now be stale
+		invalidateRCCache(api_url, api_token)
 	# Get the number of records updated in REDCap
-	bytereport = buf.getvalue()
+	stringreport = buf.getvalue().decode('utf8', 'replace')
 	buf.close()
-	stringreport = bytereport.decode('utf8')
-	countPattern = re.compile('{\"count\":\s*([0-9]+)')
-	c = countPattern.match(stringreport)
-	recordsUpdated = c.group(1)
+	try:
+		recordsUpdated = json.loads(stringreport)['count']
+	except (ValueError, KeyError, TypeError):
+		raise REDCapError(api_url, 'Unexpected response to REDCap import: ' + stringreport[:1024])
 	return(str(recordsUpdated))
 
+# Request-scoped cache of pulled records, with pushes written through to it (see NDDdb_context.py)
+def newRecordContext():
+	return RecordContext(pullRCRecords, pushRCRecord)
+
+# The pull & push functions for helpers that take an optional RecordContext
+def rcIO(ctx):
+	if ctx is None:
+		return pullRCRecords, pushRCRecord
+	return ctx.pullRCRecords, ctx.pushRCRecord
+
 # Make dictionary from options list in REDCap
 def populateFieldDict(s, fieldmap):
 	dictionary = {}
@@ -110,7 +260,6 @@ def populateFieldDict(s, fieldmap):
 
 # Get the data dictionary for the specified project & convert to data frame
 def getMetaData(api_url, api_token, forms):
-	buf = io.BytesIO()
 	fields = [
 		('token', api_token),
 		('content', 'metadata'),
@@ -118,49 +267,38 @@ def getMetaData(api_url, api_token, forms):
 		('type', 'flat'),
 		('forms', forms)
 	]
-	ch = pycurl.Curl()
-	ch.setopt(ch.URL, api_url)
-	ch.setopt(ch.HTTPPOST, fields)
-	ch.setopt(ch.WRITEFUNCTION, buf.write)
-	#ch.setopt(pycurl.VERBOSE, 1) #for debugging
-	ch.setopt(pycurl.SSL_VERIFYPEER, 1) # 1 = Curl verifies whether the certificate is authentic
-	ch.setopt(pycurl.SSL_VERIFYHOST, 2) # 2 = Curl verifies that the server you're communicating with is the same as the one on the cert
-	ch.perform()
-	response_code = ch.getinfo(pycurl.HTTP_CODE)
-	ch.close()
-	#If the request was not successful, terminate
-	if response_code!=200:
-		sys.exit('Error communicating with REDCap database: could not pull participant records from REDCap.')
-	#convert bytestream to bytes...
-	bytereport = buf.getvalue()
-	buf.close()
-	#...to string...
-	try:
-		stringreport = bytereport.decode('utf8')
-	except UnicodeDecodeError:
-		stringreport = bytereport.decode('latin-1')
-		stringreport.encode('utf8')
-	#...to list of strings.
-	linesplit = re.findall('(?:"[^"]*"|.)+', stringreport)
-	# make dataframe to hold results
-	df = pd.DataFrame(list(list(rec) for rec in csv.reader(linesplit, delimiter=',')))
-	header = df.iloc[0]
-	df = df[1:]
-	df.columns = header
+	# Send through the shared, connection-reusing client for this API URL
+	with metrics.timed('redcap_metadata', project=metrics.project(api_token), form=formsLabel(forms)) as m:
+		reader = getRCClient(api_url).request(fields, RCExportReader)
+		m['bytes'] = reader.nbytes
+		df = reader.close()
+		m['rows'] = 0 if df is None else len(df)
+	if df is None:
+		raise REDCapError(api_url, 'REDCap data dictionary export was empty')
 	return(df)
 
+# Data dictionaries, fetched once per project and shared by everything in this process
+metadata = RCMetadataRegistry(getMetaData)
+
 # Take the value(s) of multiple source checkbox fields & translate into a single target checkbox
+# dd_refer/dd_data are RCDataDictionary objects (see metadata.get), whose choice maps are already parsed
 def collapseFields(i, dat, sources, target, dd_refer, dd_data):
   for f in sources:
     if dat.loc[i,f] != '':
-      optmap_refer = parseChoiceMap(dd_refer['select_choices_or_calculations'].loc[f],CHOICEPATTERN,ALTPATTERN)
-      optmap_data = parseChoiceMap(dd_data['select_choices_or_calculations'].loc[target],CHOICEPATTERN,ALTPATTERN)
-      optmap_data = {v:k for k,v in optmap_data.items()}
-      sourceval = optmap_refer[dat.loc[i,f]]
-      targetval = optmap_data[sourceval]
+      sourceval = dd_refer.choices[f][dat.loc[i,f]]
+      targetval = dd_data.labels[target][sourceval]
       return targetval
   return ''
 
+# collapseFields for every row of dat at once. The first non-blank source field of each row wins.
+# Rows with a code that can't be translated get NaN, so the caller can report them.
+def collapseFieldsFrame(dat, sources, target, dd_refer, dd_data):
+  result = pd.Series('', index=dat.index, dtype=object)
+  for f in reversed(sources):
+    mapped = dat[f].map(dd_refer.choices[f]).map(dd_data.labels[target])
+    result = result.where(dat[f] == '', mapped)
+  return result
+
 # # Parse map of choices from REDCap data dictionary -> Python dictionary
 CHOICEPATTERN = re.compile('^\s*([0-9]+),\s(.*)\s*$')
 ALTPATTERN = re.compile('^\s*(.*),\s(.*)\s*$')
@@ -181,25 +319,23 @@ def parseChoiceMap(optstr, pattern, altpattern):
       choicesmap[parsed.group(1)] = parsed.group(2)
   return choicesmap
 
+# Key column used by the single-row LabKey helpers, in order of preference
+LKKEYCOLS = ['lsid','SubjectID','id','Key']
+def getLKKeyCol(rcrd):
+  for keycol in LKKEYCOLS:
+    if keycol in rcrd.index:
+      return keycol
+  return rcrd.index[0]
+
 # Push new record to LabKey.
 def LKinsertRow(rcrd, query, schema, sc):
-  try:
-    insertres = insert_rows(sc, schema, query, [rcrd.to_dict()])
-  except labkey.exceptions.RequestError:
-    print('Insert failed for record: ' + rcrd.index)
+  LabKeyBulkWriter(sc, schema, query, getLKKeyCol(rcrd)).insert(rcrd.to_frame().T)
   return
 
 # Attempt to update LabKey record, and if failed, insert new
 def LKupdateinsertRow(rcrd, query, schema, sc):
-  try:
-    updateres = update_rows(sc, schema, query, [rcrd.to_dict()])
-  except labkey.exceptions.QueryNotFoundError:
-    print('Update failed for record: ' + rcrd.index)
-    try:
-      insertres = insert_rows(sc, schema, query, [rcrd.to_dict()])
-    except labkey.exceptions.RequestError:
-      print('ERROR: Could not insert/update ' + query + ' data for subject ' + str(rcrd['SubjectID']))
-    return
+  LabKeyBulkWriter(sc, schema, query, getLKKeyCol(rcrd)).upsert(rcrd.to_frame().T)
+  return
 
 # Change invalid dates to empty strings
 def tryCoerceDate(date):
@@ -218,28 +354,131 @@ def parseFs(r):
     return fnum[1:]
 
 # Copy proband's email to Family Enrollment instrument
-def setFamEmail(api_url, dc_api_key, email, dcid):
+def setFamEmail(api_url, dc_api_key, email, dcid, ctx=None):
+  push = rcIO(ctx)[1]
   update = pd.DataFrame()
   update['fam_email'] = [email]
   update['redcap_event_name'] = ['family_data_arm_1']
   update['redcap_id'] = [dcid]
-  pushRCRecord(api_url, dc_api_key, '', update)
+  push(api_url, dc_api_key, '', update)
   return
 
 #### Functions for getting IDs ###
 
+# Optional shared ID allocator (see NDDdb_idalloc.py). When one is set, getNextDCID, getNextFnum,
+# getNextIndNum (given a dcid) and getNextLabKeyID take IDs from it instead of scanning REDCap/LabKey.
+# Records can still be created outside the server (in the REDCap UI, by API imports), so the allocator
+# is never trusted blindly: seedIDAllocator() (at startup) and startIDAllocatorReseed() (on a timer)
+# raise every sequence to the highest ID in use in REDCap & LabKey, and DC IDs are also checked against
+# REDCap before use. In between, allocation is a single local transaction, with no REDCap/LabKey reads
+# (individual numbers still get the family's own idnums, which the caller already has, as their floor).
+_idalloc = None
+_idreseedtimer = None
+def setIDAllocator(alloc):
+  global _idalloc
+  _idalloc = alloc
+
+def hasIDAllocator():
+  return _idalloc is not None
+
+FNUMPATTERN = re.compile('^F([0-9]{2})([0-9]{4})$')
+
+# Highest ID of each kind currently in use in REDCap & LabKey, as allocator sequence name -> value.
+# With families=True the individual numbers of every family are included too.
+def idSourceValues(api_url, dc_api_key, server_context, families=False):
+  values = {}
+  fam = pullRCRecords(api_url, dc_api_key, 'family_enrollment', '', '')
+  if len(fam) > 0:
+    values['dcid'] = fam['redcap_id'].astype(int).max()
+    fnums = fam['fnum'].str.extract(FNUMPATTERN).dropna()
+    for yy, n in fnums.groupby(0)[1]:
+      values['fnum:' + yy] = n.astype(int).max()
+  nextSubjID = select_rows(server_context, 'study', 'GetNextSubjectID')['rows'][0]['nextSubjID']
+  if nextSubjID:
+    values['labkey_subjid'] = int(nextSubjID) - 1
+  if families:
+    enroll = pullRCRecords(api_url, dc_api_key, 'enrollment', '', 'redcap_id,idnum')
+    idnums = pd.to_numeric(enroll['idnum'], errors='coerce')
+    idnums = idnums[(idnums > 3) & ~idnums.isin([88,99])]
+    for dcid, n in idnums.groupby(enroll['redcap_id']):
+      values['idnum:' + dcid] = n.max()
+  return values
+
+# Bring the allocator up to date with REDCap & LabKey, e.g. at server startup
+def seedIDAllocator(alloc, api_url, dc_api_key, server_context):
+  values = idSourceValues(api_url, dc_api_key, server_context)
+  alloc.seed(values)
+  return values
+
+# Re-seed the shared allocator every interval seconds on a daemon thread. Every worker can start one:
+# only one of them re-seeds per interval (see IDAllocator.claimRun)
+def startIDAllocatorReseed(interval, api_url, dc_api_key, server_context):
+  global _idreseedtimer
+  def tick():
+    try:
+      if _idalloc is not None and _idalloc.claimRun('reseed', interval):
+        seedIDAllocator(_idalloc, api_url, dc_api_key, server_context)
+    except Exception as e:
+      print('WARNING: ID allocator re-seed failed: ' + str(e))
+    startIDAllocatorReseed(interval, api_url, dc_api_key, server_context)
+  _idreseedtimer = threading.Timer(interval, tick)
+  _idreseedtimer.daemon = True
+  _idreseedtimer.start()
+
+# DC IDs among dcids that already have a record in REDCap (one small export of just those records)
+def takenDCIDs(api_url, api_key, dcids):
+  found = pullRCRecords(api_url, api_key, '', ','.join(str(d) for d in dcids), 'redcap_id')
+  if len(found) == 0:
+    return set()
+  return set(found['redcap_id'].astype(str)) & set(str(d) for d in dcids)
+
+# n new DC IDs from the allocator. If any is already taken in REDCap (a record was made outside the
+# server), the allocator is re-seeded from REDCap and the block allocated again above the highest ID in use
+def allocateDCIDs(api_url, api_key, n):
+  dcids = _idalloc.nextBlock('dcid', n)
+  taken = takenDCIDs(api_url, api_key, dcids)
+  if taken:
+    print('WARNING: DC IDs ' + ','.join(sorted(taken)) + ' from the ID allocator are already in REDCap; re-seeding it')
+    fams = pullRCRecords(api_url, api_key, 'family_enrollment', '', '')
+    floor = fams['redcap_id'].astype(int).max() if len(fams) > 0 else 0
+    dcids = _idalloc.nextBlock('dcid', n, floor)
+  return dcids
+
 # Retrieve the next sequential data collection ID
-def getNextDCID(api_url, api_key):
-  allreferids = pullRCRecords(api_url, api_key, 'family_enrollment', '', 'redcap_id')
+def getNextDCID(api_url, api_key, ctx=None):
+  if _idalloc is not None:
+    return allocateDCIDs(api_url, api_key, 1)[0]
+  pull = rcIO(ctx)[0]
+  allreferids = pull(api_url, api_key, 'family_enrollment', '', '') # same export as the F# lookup, so a RecordContext can share it
   if len(allreferids) > 0:
     return allreferids['redcap_id'].astype(int).max() + 1
   else:
     return 1
 
-# Retrieve the next sequential F#
+# Data collection record already enrolled from referral refid (its family row's referralid), or '' if
+# there is none. Lets a retried enrollment reuse the family an earlier, failed attempt created
+# instead of allocating another one
+def findDCIDForReferral(api_url, dc_api_key, refid, ctx=None):
+  fams = referralFamilies(api_url, dc_api_key, ctx)
+  return fams.get(str(refid), '')
+
+# Referral id -> data collection id of every family enrolled from a referral
+def referralFamilies(api_url, dc_api_key, ctx=None):
+  pull = rcIO(ctx)[0]
+  fams = pull(api_url, dc_api_key, '', '', 'redcap_id,referralid')
+  if len(fams) == 0:
+    return pd.Series(dtype=object)
+  fams = fams.loc[(fams['redcap_event_name']=='family_data_arm_1') & (fams['referralid']!='')].drop_duplicates('referralid')
+  return pd.Series(fams['redcap_id'].values, index=fams['referralid'].values)
+
+# Retrieve the next sequential F#. fnumdf is the family_enrollment export; with an allocator set, it
+# isn't needed (the allocator's reseed keeps up with F#s given out in REDCap by hand)
 def getNextFnum(apptdate,fnumdf):
   refyr = tryCoerceDate(apptdate).year
   yy = str(refyr)[-2:]
+  if _idalloc is not None:
+    nextInt = str(_idalloc.next('fnum:' + yy))
+    return 'F' + yy + ('0' * (4-len(nextInt))) + nextInt
   fnumdf['Fxx'] = fnumdf['fnum'].str[1:]
   fnumdf['Fyrs'] = fnumdf['Fxx'].str[:2]
   fnumdf['Fcount'] = fnumdf.Fxx.str[-4:]
@@ -253,10 +492,14 @@ def getNextFnum(apptdate,fnumdf):
   return nextF
 
 # Using the specified relation of an individual & list of claimed individual #s in the family, assign the next available individual #
-def getNextIndNum(reln, idnums): #TODO add error handling for duplicate moms/dads
+# If dcid is given and an allocator is set, the family's sequence hands out the number (it never goes below idnums)
+def getNextIndNum(reln, idnums, dcid=None): #TODO add error handling for duplicate moms/dads
   idnums = pd.to_numeric(idnums).dropna()
   # Drop non-bio parents so that their individual numbers don't throw off ID assignment
   idnums = idnums[~idnums.isin([88,99])]
+  if _idalloc is not None and dcid is not None and reln not in ['1','2','3','10','11']:
+    nextInd = str(_idalloc.next('idnum:' + str(dcid), max(int(idnums.max()) if idnums.size > 0 else 0, 3)))
+    return('0' * (2-len(nextInd)) + nextInd)
   if reln == '1': # Proband
     return '01'
   elif reln == '2': # Mother
@@ -285,10 +528,8 @@ def pushToReferral(api_url, ref_api_key, dc_api_key, referral, submitid):
     # Get next available data collection ID
     dcid = getNextDCID(api_url, dc_api_key)
   # Get project metadata
-  dd_refer = getMetaData(api_url, ref_api_key, 'family_members')
-  dd_data = getMetaData(api_url, dc_api_key, 'family_members')
-  dd_refer.set_index(keys='field_name', drop = False, inplace = True, verify_integrity = True)
-  dd_data.set_index(keys='field_name', drop = False, inplace = True, verify_integrity = True)
+  dd_refer = metadata.get(api_url, ref_api_key, 'family_members')
+  dd_data = metadata.get(api_url, dc_api_key, 'family_members')
   # Construct data frame for import to data collection project
   newfam = pd.DataFrame()
   newfam['referralid'] = referral['redcap_id']
@@ -328,7 +569,7 @@ def pushToReferral(api_url, ref_api_key, dc_api_key, referral, submitid):
   proband['physician_other'] = referral.loc[refid,'providerother']
   proband['hospitalcenter'] = collapseFields(refid, referral, ['sinaicenter','sinaistatus'], 'hospitalcenter', dd_refer, dd_data)
   proband['hospitalcenter_other'] = referral.loc[refid, 'hospitalcenter_other']
-  newfam = newfam.append(proband, ignore_index=True, verify_integrity=False, sort=None)
+  newfam = pd.concat([newfam, pd.DataFrame([proband])], ignore_index=True)
   newfam['redcap_id'] = dcid
   newfam.set_index(keys='redcap_id', drop = False, inplace = True, verify_integrity = False)
   newfam.replace(np.nan,'', inplace=True)
@@ -341,12 +582,31 @@ def pushToReferral(api_url, ref_api_key, dc_api_key, referral, submitid):
     updatereferreq = pushRCRecord(api_url, ref_api_key, '', update)
   return ''
 
-def pushToDC(api_url, ref_api_key, dc_api_key, referral, refid, dcid, idnum, imnewhere):
+def pushToDC(api_url, ref_api_key, dc_api_key, referral, refid, dcid, idnum, imnewhere, ctx=None):
+  pull, push = rcIO(ctx)
   # Get project metadata
-  dd_refer = getMetaData(api_url, ref_api_key, 'family_members')
-  dd_data = getMetaData(api_url, dc_api_key, 'family_members')
-  dd_refer.set_index(keys='field_name', drop = False, inplace = True, verify_integrity = True)
-  dd_data.set_index(keys='field_name', drop = False, inplace = True, verify_integrity = True)
+  dd_refer = metadata.get(api_url, ref_api_key, 'family_members')
+  dd_data = metadata.get(api_url, dc_api_key, 'family_members')
+  rep = probandRepeat(api_url, dc_api_key, dcid, idnum, imnewhere, pull)
+  newfam, update = makeDCEnrollment(referral, refid, dcid, idnum, imnewhere, rep, dd_refer, dd_data)
+  # Enroll new subject in data collection project
+  newfamreq = push(api_url, dc_api_key, '', newfam)
+  # Finally write new project id back to 'dataproj_id'
+  if update is not None:
+    updatereferreq = push(api_url, ref_api_key, '', update)
+  return '01'
+
+# Repeat instance of the proband in the data collection project. A new family's proband is instance 1;
+# otherwise check his/her individual # and determine which repeat instance he/she is
+def probandRepeat(api_url, dc_api_key, dcid, idnum, imnewhere, pull=pullRCRecords):
+  if imnewhere or idnum == '01':
+    return '1'
+  myfam = pull(api_url, dc_api_key, '', dcid, 'redcap_id,idnum')
+  return myfam.loc[myfam['idnum']==idnum,'redcap_repeat_instance'].values[0]
+
+# The rows pushToDC writes: the family & proband rows for the data collection project, and for a
+# new family the update writing the new project id back to the referral (None otherwise)
+def makeDCEnrollment(referral, refid, dcid, idnum, imnewhere, rep, dd_refer, dd_data):
   # Construct data frame for import to data collection project
   newfam = pd.DataFrame()
   newfam['referralid'] = referral['redcap_id']
@@ -366,18 +626,10 @@ def pushToDC(api_url, ref_api_key, dc_api_key, referral, refid, dcid, idnum, imn
   # Handle proband's startdate and other fields that should only need to be captured once
   if imnewhere:
     idnum = '01'
-    rep = '1'
     proband['demo_relation'] = '1' # 1 = 'Proband'
     proband['demo_dateadded'] = dt.datetime.today().strftime('%Y-%m-%d')
     proband['referraldate'] = referral.loc[refid, 'referraldate']
     proband['hasndd'] = '1'
-  # If individual isn't new, check his/her individual # and determine which repeat instance he/she is
-  else:
-    if idnum == '01':
-      rep = '1'
-    else:
-      myfam = pullRCRecords(api_url, dc_api_key, '', dcid, 'redcap_id,idnum')
-      rep = myfam.loc[myfam['idnum']==idnum,'redcap_repeat_instance'].values[0]
   proband['idnum'] = idnum
   proband['redcap_repeat_instance'] = rep
   #proband['referraldate'] = referral.loc[refid,'referraldate']
@@ -387,46 +639,141 @@ def pushToDC(api_url, ref_api_key, dc_api_key, referral, refid, dcid, idnum, imn
   proband['hospitalcenter'] = collapseFields(refid, referral, ['sinaicenter','sinaistatus'], 'hospitalcenter', dd_refer, dd_data)
   proband['hospitalcenter_other'] = referral.loc[refid, 'hospitalcenter_other']
   #newfam = newfam.append(proband, ignore_index=True, verify_integrity=False, sort=None) #'Sort' argument throwing errors 04172019
-  newfam = newfam.append(proband, ignore_index=True, verify_integrity=False)
+  newfam = pd.concat([newfam, pd.DataFrame([proband])], ignore_index=True) # DataFrame.append is gone from pandas 2
   newfam['redcap_id'] = dcid
   newfam.set_index(keys='redcap_id', drop = False, inplace = True, verify_integrity = False)
   newfam.replace(np.nan,'', inplace=True)
   #newfam.to_csv('newfam.csv')
-  # Enroll new subject in data collection project
-  newfamreq = pushRCRecord(api_url, dc_api_key, '', newfam)
-  # Finally write new project id back to 'dataproj_id'
+  update = None
   if imnewhere:
     update = pd.DataFrame(data={'redcap_id':[refid], 'dataproj_id':[dcid], 'idnum': idnum})
-    updatereferreq = pushRCRecord(api_url, ref_api_key, '', update)
-  return '01'
+  return newfam, update
+
+# Enroll many referrals at once: the batch version of pushToDC, for catching up on a backlog.
+# referral holds the referrals' records indexed on redcap_id; refids are the ones to enroll.
+# DC IDs for the new families are allocated in one step, the family & proband rows for all of
+# them are built column-wise, and each project gets a single push. A referral whose family was
+# already created by an earlier, failed run keeps that family (so a retried batch is harmless). Returns one row per referral:
+# refid, dcid, idnum, new, success, error. Referrals whose provider/center can't be translated
+# to the data collection project's choices are reported and left out of the push.
+# Needs an ID allocator: scanning REDCap for the highest ID and counting on from it isn't atomic, so two
+# batches (or a batch and a single enrollment) could be given overlapping blocks.
+def pushToDCBatch(api_url, ref_api_key, dc_api_key, referral, refids, ctx=None):
+  if _idalloc is None:
+    raise RuntimeError('Batch enrollment needs an ID allocator (see setIDAllocator)')
+  pull, push = rcIO(ctx)
+  dd_refer = metadata.get(api_url, ref_api_key, 'family_members')
+  dd_data = metadata.get(api_url, dc_api_key, 'family_members')
+  today = dt.datetime.today().strftime('%Y-%m-%d')
+  refs = referral.loc[list(refids)]
+  results = pd.DataFrame({'refid':refs['redcap_id'], 'dcid':refs['dataproj_id'], 'idnum':refs['idnum'], 'new':refs['dataproj_id'] == '', 'success':False, 'error':''})
+  # Translate provider & center; rows that fail are dropped here
+  physician = collapseFieldsFrame(refs, ['sinaiprovider','nyuprovider','barnabasprovider'], 'physician', dd_refer, dd_data)
+  hospitalcenter = collapseFieldsFrame(refs, ['sinaicenter','sinaistatus'], 'hospitalcenter', dd_refer, dd_data)
+  bad = physician.isna() | hospitalcenter.isna()
+  results.loc[bad, 'error'] = 'Provider or center has no match in the data collection project'
+  ok = ~bad
+  if not ok.any():
+    return results.reset_index(drop=True)
+  # New families get consecutive DC IDs and are proband 01 / instance 1
+  new = ok & results['new']
+  if new.any():
+    existing = referralFamilies(api_url, dc_api_key, ctx)
+    found = new & results['refid'].isin(existing.index)
+    results.loc[found, 'dcid'] = results.loc[found, 'refid'].map(existing)
+    fresh = new & ~found
+    if fresh.any():
+      dcids = allocateDCIDs(api_url, dc_api_key, int(fresh.sum()))
+      results.loc[fresh, 'dcid'] = [str(d) for d in dcids]
+    results.loc[new, 'idnum'] = '01'
+  # Existing families: look up each proband's repeat instance from one pull of all their idnums
+  rep = pd.Series('1', index=refs.index, dtype=object)
+  lookup = ok & ~new & (results['idnum'] != '01')
+  if lookup.any():
+    fams = pull(api_url, dc_api_key, '', ','.join(results.loc[lookup, 'dcid'].unique()), 'redcap_id,idnum')
+    fams = fams.loc[fams['redcap_repeat_instance'] != ''].drop_duplicates(['redcap_id','idnum']).set_index(['redcap_id','idnum'])
+    keys = pd.MultiIndex.from_arrays([results.loc[lookup, 'dcid'], results.loc[lookup, 'idnum']])
+    rep[lookup] = fams['redcap_repeat_instance'].reindex(keys).values
+    missing = lookup & rep.isna()
+    results.loc[missing, 'error'] = 'Individual number not found in the family'
+    ok = ok & ~missing
+    new = new & ok
+  if not ok.any():
+    return results.reset_index(drop=True)
+  # One family row & one proband row per referral
+  famrows = pd.DataFrame({
+    'redcap_id':results.loc[ok, 'dcid'],
+    'redcap_event_name':'family_data_arm_1',
+    'referralid':results.loc[ok, 'refid'],
+    'labkey_famid':results.loc[ok, 'dcid'],
+    'dataprojdate':np.where(new[ok], today, '')
+  })
+  probands = pd.DataFrame({
+    'redcap_id':results.loc[ok, 'dcid'],
+    'redcap_event_name':'family_member_arm_1',
+    'redcap_repeat_instance':rep[ok],
+    'idnum':results.loc[ok, 'idnum'],
+    'demo_firstname':refs.loc[ok, 'firstname'],
+    'demo_lastname':refs.loc[ok, 'lastname'],
+    'demo_mrn':refs.loc[ok, 'epic'],
+    'demo_dob':refs.loc[ok, 'dob'],
+    'demo_sex':refs.loc[ok, 'sex'],
+    'physician':physician[ok],
+    'physician_other':refs.loc[ok, 'providerother'],
+    'hospitalcenter':hospitalcenter[ok],
+    'hospitalcenter_other':refs.loc[ok, 'hospitalcenter_other'],
+    # Fields captured only when the family is new; blanks don't overwrite existing values on import
+    'demo_relation':np.where(new[ok], '1', ''),
+    'demo_dateadded':np.where(new[ok], today, ''),
+    'referraldate':np.where(new[ok], refs.loc[ok, 'referraldate'], ''),
+    'hasndd':np.where(new[ok], '1', '')
+  })
+  newfam = pd.concat([famrows, probands], ignore_index=True).fillna('')
+  try:
+    push(api_url, dc_api_key, '', newfam)
+  except REDCapError as e:
+    results.loc[ok, 'error'] = str(e)
+    return results.reset_index(drop=True)
+  results.loc[ok, 'success'] = True
+  # Write the new DC IDs back to the referrals
+  if new.any():
+    update = pd.DataFrame({'redcap_id':results.loc[new, 'refid'], 'dataproj_id':results.loc[new, 'dcid'], 'idnum':'01'})
+    try:
+      push(api_url, ref_api_key, '', update)
+    except REDCapError as e:
+      results.loc[new, 'error'] = 'Enrolled, but dataproj_id was not written back: ' + str(e)
+  return results.reset_index(drop=True)
 
 # Assign F# for a newly enrolled subject
-def assignFID(api_url, dc_api_key, server_context, dcid, fnum):
+def assignFID(api_url, dc_api_key, server_context, dcid, fnum, ctx=None):
+  push = rcIO(ctx)[1]
   # Write to data collection project
   update = pd.DataFrame(data={'redcap_id':[dcid], 'fnum':[fnum]})
-  updateDCreq = pushRCRecord(api_url, dc_api_key, '', update)
+  updateDCreq = push(api_url, dc_api_key, '', update)
   # Write to LabKey
   lkupdate = pd.DataFrame(data={'id':[dcid], 'fnum':[fnum]})
-  LKupdateinsertRow(lkupdate.iloc[0], 'Families', 'lists', server_context)
+  LabKeyBulkWriter(server_context, 'lists', 'Families', 'id').upsert(lkupdate)
   return
 
 # Assign F-individual# for a newly enrolled subject
 # TODO probably need to pass relation in func instead of getting it from data, since I want to recycle this func
 # Recycling also means I need to disable referral project push when assigning F-ind to family member
-def assignFindivID(api_url, ref_api_key, dc_api_key, server_context, refid, dcid, rep, subjid, fnum, idnum):
+def assignFindivID(api_url, ref_api_key, dc_api_key, server_context, refid, dcid, rep, subjid, fnum, idnum, ctx=None):
+  push = rcIO(ctx)[1]
   f_idnum = fnum + '-' + idnum
+  # Write to LabKey first: the data pipeline only assigns an idnum to subjects without one, so REDCap
+  # must not get it unless LabKey did
+  #NDDdb.assignLabKeyID(rc_api_url, rc_data_apikey, server_context, enroll, rep, lkid)
+  lkupdate = pd.DataFrame(data={'SubjectID':[subjid],'idnum':[idnum], 'f_idnum':[f_idnum]})
+  checkWrite(LabKeyBulkWriter(server_context, 'study', 'Enrollment', 'SubjectID').upsert(lkupdate))
   # Write to data collection project
   update = pd.DataFrame(data={'redcap_id':[dcid],'redcap_event_name':['family_member_arm_1'],'redcap_repeat_instance':[rep], 'f_idnum':[f_idnum], 'idnum':[idnum]})
-  updateDCreq = pushRCRecord(api_url, dc_api_key, '', update)
+  updateDCreq = push(api_url, dc_api_key, '', update)
   # If a referral ID was passed, write to referral project
   if refid:
     print('update referral project')
     update = pd.DataFrame(data={'redcap_id':[refid], 'f_idnum':[f_idnum]})
-    updatereferreq = pushRCRecord(api_url, ref_api_key, '', update)
-  # Write to LabKey
-  #NDDdb.assignLabKeyID(rc_api_url, rc_data_apikey, server_context, enroll, rep, lkid)
-  lkupdate = pd.DataFrame(data={'SubjectID':[subjid],'idnum':[idnum], 'f_idnum':[f_idnum]})
-  LKupdateinsertRow(lkupdate.iloc[0], 'Enrollment', 'study', server_context)
+    updatereferreq = push(api_url, ref_api_key, '', update)
   return
 
 def assignFID___DEPR(api_url, ref_api_key, dc_api_key, server_context, apptdate, refid, dcid, idnum):
@@ -463,20 +810,45 @@ def assignFID___DEPR(api_url, ref_api_key, dc_api_key, server_context, apptdate,
     LKinsertRow(lkupdate.iloc[0], 'Families', 'lists', server_context)
   return f_idnum
 
-# Get next LabKey subject ID
+# Get next LabKey subject ID, from the allocator if one is set (no LabKey query), else from LabKey
 def getNextLabKeyID(server_context):
-  nextIDqresult = select_rows(server_context, 'study', 'GetNextSubjectID')
+  if _idalloc is not None:
+    return _idalloc.next('labkey_subjid')
+  return liveNextLabKeyID(server_context)
+
+def liveNextLabKeyID(server_context):
+  with metrics.timed('labkey_select', schema='study', query='GetNextSubjectID'):
+    nextIDqresult = select_rows(server_context, 'study', 'GetNextSubjectID')
   nextSubjID = nextIDqresult['rows'][0]['nextSubjID']
   if not nextSubjID:
     nextSubjID = 0
   return nextSubjID
 
+# assignLabKeyID for many subjects: subjects has columns dcid, rep, reln, dateadded. The LabKey IDs
+# are allocated as one block from the ID allocator (required, like pushToDCBatch), then REDCap & LabKey
+# each get a single write. Returns the IDs given out
+def assignLabKeyIDBatch(api_url, dc_api_key, server_context, subjects, ctx=None):
+  if _idalloc is None:
+    raise RuntimeError('Batch LabKey ID assignment needs an ID allocator (see setIDAllocator)')
+  push = rcIO(ctx)[1]
+  lkids = _idalloc.nextBlock('labkey_subjid', len(subjects))
+  lkids = [str(l) for l in lkids]
+  # LabKey rows first, and all of them: a subject with a labkey_subjid in REDCap is taken to be in LabKey already
+  lkupdate = pd.DataFrame(data={'SubjectID':lkids, 'demo_relation':subjects['reln'].values, 'date':subjects['dateadded'].values, 'familyid':subjects['dcid'].values})
+  checkWrite(LabKeyBulkWriter(server_context, 'study', 'Demographics', 'SubjectID').upsert(lkupdate))
+  dcupdate = pd.DataFrame(data={'redcap_id':subjects['dcid'].values, 'redcap_event_name':'family_member_arm_1', 'redcap_repeat_instance':subjects['rep'].values, 'labkey_subjid':lkids})
+  updateDCreq = push(api_url, dc_api_key, '', dcupdate)
+  return lkids
+
 # Assign LabKey ID to newly enrolled subject  NOTE: can write relation here, NOT F-indiv#
-def assignLabKeyID(api_url, dc_api_key, server_context, dcid, rep, lkid, reln, dateadded):
-  dcupdate = pd.DataFrame(data={'redcap_id':[dcid], 'redcap_event_name':['family_member_arm_1'], 'redcap_repeat_instance':[rep], 'labkey_subjid':[lkid]})
-  #update = enroll.loc[[rep],['redcap_id','redcap_event_name','redcap_repeat_instance','labkey_subjid']]
-  updateDCreq = pushRCRecord(api_url, dc_api_key, '', dcupdate)
+# The LabKey row is upserted (so a retry is harmless) and the ID only stored in REDCap once it is there,
+# since a subject with a labkey_subjid is never given a LabKey row again
+def assignLabKeyID(api_url, dc_api_key, server_context, dcid, rep, lkid, reln, dateadded, ctx=None):
+  push = rcIO(ctx)[1]
   #lkupdate = enroll.loc[[rep],['redcap_id','labkey_subjid','demo_dateadded','demo_relation']].rename(columns={'labkey_subjid':'SubjectID','redcap_id':'familyid','demo_dateadded':'date'})
   lkupdate = pd.DataFrame(data={'SubjectID':[lkid], 'demo_relation':[reln], 'date':[dateadded], 'familyid':[dcid]})
-  LKinsertRow(lkupdate.iloc[0], 'Demographics', 'study', server_context)
+  checkWrite(LabKeyBulkWriter(server_context, 'study', 'Demographics', 'SubjectID').upsert(lkupdate))
+  dcupdate = pd.DataFrame(data={'redcap_id':[dcid], 'redcap_event_name':['family_member_arm_1'], 'redcap_repeat_instance':[rep], 'labkey_subjid':[lkid]})
+  #update = enroll.loc[[rep],['redcap_id','redcap_event_name','redcap_repeat_instance','labkey_subjid']]
+  updateDCreq = push(api_url, dc_api_key, '', dcupdate)
   return
@@ -0,0 +1,290 @@
+import pycurl
+import queue
+import random
+import threading
+import time
+from NDDdb_metrics import metrics
+
+# Connection-reusing client for the REDCap API.
+# Each client owns a fixed-size pool of pycurl handles for one API URL. Handles are
+# reset (not closed) between requests, so libcurl keeps their connections alive, and
+# they all share a CurlShare with a common DNS cache and TLS session cache, so even a
+# handle opening a fresh connection can resume the TLS session instead of doing a
+# full handshake. Handles are checked out of a queue, so a client can be used from
+# any number of threads; at most poolsize requests are in flight at once.
+#
+# request() adds the error handling on top of post(): failures raise a REDCapError subclass
+# instead of returning a status code, and transient ones (5xx, 429, timeouts, dropped or
+# refused connections) are retried up to `retries` times with exponential backoff and full
+# jitter, honouring Retry-After. A request marked idempotent=False (an import REDCap might
+# already have applied) is only retried when REDCap can't have seen it: the connection was
+# never made, or the server answered 429/503. A circuit breaker shared by everything using
+# the client opens after breakerthreshold transient failures in a row; while it's open,
+# requests fail at once with REDCapUnavailable instead of tying up workers, and after
+# breakercooldown seconds one request is let through to probe whether REDCap is back.
+
+DEFAULT_POOLSIZE = 4
+DEFAULT_TIMEOUT = 300 # seconds allowed for a whole request; full-project exports can be slow
+DEFAULT_CONNECTTIMEOUT = 30
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF = 1 # seconds before the first retry; doubled for each one after
+DEFAULT_MAXBACKOFF = 60
+DEFAULT_BREAKERTHRESHOLD = 5
+DEFAULT_BREAKERCOOLDOWN = 30
+
+RETRYSTATUS = [429, 500, 502, 503, 504]
+# Answers that mean the request was turned away before REDCap did anything with it
+NOTPROCESSEDSTATUS = [429, 503]
+RETRYERRORS = [pycurl.E_COULDNT_RESOLVE_HOST, pycurl.E_COULDNT_CONNECT, pycurl.E_OPERATION_TIMEDOUT,
+  pycurl.E_SSL_CONNECT_ERROR, pycurl.E_GOT_NOTHING, pycurl.E_SEND_ERROR, pycurl.E_RECV_ERROR, pycurl.E_PARTIAL_FILE]
+# Transfer errors that happen before anything was sent
+NOTSENTERRORS = [pycurl.E_COULDNT_RESOLVE_HOST, pycurl.E_COULDNT_CONNECT, pycurl.E_SSL_CONNECT_ERROR]
+
+class REDCapError(Exception):
+  def __init__(self, api_url, message):
+    super().__init__(message)
+    self.api_url = api_url
+
+# REDCap answered with a status other than 200; body holds the start of its response
+class REDCapHTTPError(REDCapError):
+  def __init__(self, api_url, status, body=''):
+    super().__init__(api_url, 'REDCap API returned HTTP ' + str(status) + (': ' + body if body else ''))
+    self.status = status
+    self.body = body
+
+# The transfer itself failed (timeout, connection refused or reset, ...); code is the libcurl error
+class REDCapTransportError(REDCapError):
+  def __init__(self, api_url, code, message):
+    super().__init__(api_url, 'REDCap API request failed (curl error ' + str(code) + '): ' + message)
+    self.code = code
+
+# The circuit breaker is open: REDCap has been failing and wasn't contacted
+class REDCapUnavailable(REDCapError):
+  pass
+
+class CircuitBreaker:
+  def __init__(self, threshold=DEFAULT_BREAKERTHRESHOLD, cooldown=DEFAULT_BREAKERCOOLDOWN):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.lock = threading.Lock()
+    self.failures = 0
+    self.openedat = None
+    self.probing = False
+
+  # Whether a request may go out now. Once the cooldown is over, one probe is let through at a time
+  def allow(self):
+    with self.lock:
+      if self.openedat is None:
+        return True
+      if self.probing or time.monotonic() - self.openedat < self.cooldown:
+        return False
+      self.probing = True
+      return True
+
+  def success(self):
+    with self.lock:
+      self.failures = 0
+      self.openedat = None
+      self.probing = False
+
+  # Returns True if this failure opened (or re-opened) the breaker
+  def failure(self):
+    with self.lock:
+      self.failures += 1
+      if self.probing or (self.openedat is None and self.failures >= self.threshold):
+        self.openedat = time.monotonic()
+        self.probing = False
+        return True
+      return False
+
+  def isOpen(self):
+    with self.lock:
+      return self.openedat is not None
+
+class REDCapClient:
+  def __init__(self, api_url, poolsize=DEFAULT_POOLSIZE, timeout=DEFAULT_TIMEOUT, connecttimeout=DEFAULT_CONNECTTIMEOUT,
+      retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, maxbackoff=DEFAULT_MAXBACKOFF,
+      breakerthreshold=DEFAULT_BREAKERTHRESHOLD, breakercooldown=DEFAULT_BREAKERCOOLDOWN):
+    self.api_url = api_url
+    self.poolsize = poolsize
+    self.timeout = timeout
+    self.connecttimeout = connecttimeout
+    self.retries = retries
+    self.backoff = backoff
+    self.maxbackoff = maxbackoff
+    self.breaker = CircuitBreaker(breakerthreshold, breakercooldown)
+    self.share = pycurl.CurlShare()
+    self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+    self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+    # Handles are created on first use; None marks a free slot without a handle yet
+    self.pool = queue.LifoQueue(maxsize=poolsize)
+    for i in range(poolsize):
+      self.pool.put(None)
+    # Once closed, handles still checked out are closed as they come back (see close)
+    self.lock = threading.Lock()
+    self.closed = False
+    self.checkedin = 0
+
+  # Settings to recreate this client with, e.g. after a fork
+  def settings(self):
+    return {'poolsize':self.poolsize, 'timeout':self.timeout, 'connecttimeout':self.connecttimeout,
+      'retries':self.retries, 'backoff':self.backoff, 'maxbackoff':self.maxbackoff,
+      'breakerthreshold':self.breaker.threshold, 'breakercooldown':self.breaker.cooldown}
+
+  # Set the options every request needs. reset() clears them but leaves the connection open.
+  def _prepare(self, ch, fields, writefunction, timeout, verbose, headerfunction):
+    ch.setopt(pycurl.URL, self.api_url)
+    ch.setopt(pycurl.SHARE, self.share)
+    ch.setopt(pycurl.HTTPPOST, fields)
+    ch.setopt(pycurl.WRITEFUNCTION, writefunction)
+    if headerfunction is not None:
+      ch.setopt(pycurl.HEADERFUNCTION, headerfunction)
+    ch.setopt(pycurl.VERBOSE, 1 if verbose else 0)
+    ch.setopt(pycurl.SSL_VERIFYPEER, 1) # 1 = Curl verifies whether the certificate is authentic
+    ch.setopt(pycurl.SSL_VERIFYHOST, 2) # 2 = Curl verifies that the server you're communicating with is the same as the one on the cert
+    ch.setopt(pycurl.NOSIGNAL, 1) # Req'd for timeouts when handles are used outside the main thread
+    ch.setopt(pycurl.TCP_KEEPALIVE, 1)
+    ch.setopt(pycurl.CONNECTTIMEOUT, self.connecttimeout)
+    ch.setopt(pycurl.TIMEOUT, timeout if timeout is not None else self.timeout)
+
+  # POST fields to the API, streaming the response body into writefunction. Returns the HTTP status code.
+  # Raises pycurl.error if the transfer fails; the handle involved is discarded rather than reused.
+  def post(self, fields, writefunction, timeout=None, verbose=False, headerfunction=None):
+    ch = self.pool.get()
+    try:
+      if ch is None:
+        ch = pycurl.Curl()
+      else:
+        ch.reset()
+      self._prepare(ch, fields, writefunction, timeout, verbose, headerfunction)
+      ch.perform()
+      response_code = ch.getinfo(pycurl.HTTP_CODE)
+      # Drop the reference to the caller's buffers while the handle sits in the pool
+      ch.setopt(pycurl.WRITEFUNCTION, lambda data: None)
+      ch.setopt(pycurl.HEADERFUNCTION, lambda data: None)
+      return response_code
+    except pycurl.error:
+      ch.close()
+      ch = None
+      raise
+    finally:
+      self._checkin(ch)
+
+  def _checkin(self, ch):
+    with self.lock:
+      if not self.closed:
+        self.pool.put(ch)
+        return
+      self.checkedin += 1
+      last = self.checkedin == self.poolsize
+    if ch is not None:
+      ch.close()
+    if last:
+      self.share.close()
+
+  # POST fields with retries (see above). newsink() is called for every attempt and must return a
+  # fresh object with a write method to stream the response into; the sink of the successful
+  # attempt is returned. Raises REDCapHTTPError, REDCapTransportError or REDCapUnavailable.
+  def request(self, fields, newsink, idempotent=True, timeout=None, verbose=False):
+    attempt = 0
+    while True:
+      if not self.breaker.allow():
+        metrics.inc('redcap_circuit_rejected_total')
+        raise REDCapUnavailable(self.api_url, 'REDCap API calls suspended for up to ' + str(self.breaker.cooldown) + 's after repeated failures')
+      sink = newsink()
+      head = []
+      headers = {}
+      def write(data):
+        if len(head) < 4:
+          head.append(data)
+        return sink.write(data)
+      def header(line):
+        name, sep, value = line.decode('latin-1').partition(':')
+        if sep:
+          headers[name.strip().lower()] = value.strip()
+      try:
+        status = self.post(fields, write, timeout, verbose, header)
+      except pycurl.error as e:
+        code = e.args[0]
+        error = REDCapTransportError(self.api_url, code, str(e.args[1]) if len(e.args) > 1 else '')
+        transient = code in RETRYERRORS
+        retryable = transient and (idempotent or code in NOTSENTERRORS)
+        retryafter = None
+      else:
+        if status == 200:
+          self.breaker.success()
+          return sink
+        error = REDCapHTTPError(self.api_url, status, b''.join(head)[:1024].decode('utf8', 'replace'))
+        transient = status in RETRYSTATUS
+        retryable = transient and (idempotent or status in NOTPROCESSEDSTATUS)
+        retryafter = headers.get('retry-after')
+      # A 4xx means REDCap is up, just unhappy with this request
+      if not transient:
+        self.breaker.success()
+        raise error
+      if self.breaker.failure():
+        print('WARNING: REDCap API circuit breaker opened for ' + str(self.breaker.cooldown) + 's: ' + str(error))
+      if not retryable or attempt >= self.retries or self.breaker.isOpen():
+        raise error
+      attempt += 1
+      delay = self._delay(attempt, retryafter)
+      metrics.inc('redcap_retries_total')
+      print('WARNING: ' + str(error) + '; retry ' + str(attempt) + '/' + str(self.retries) + ' in ' + '{:.1f}'.format(delay) + 's')
+      time.sleep(delay)
+
+  # Full jitter: a random wait up to the exponential backoff, but at least what Retry-After asks for
+  def _delay(self, attempt, retryafter=None):
+    delay = random.uniform(0, min(self.maxbackoff, self.backoff * 2 ** (attempt - 1)))
+    if retryafter is not None and retryafter.isdigit():
+      delay = max(delay, min(self.maxbackoff, int(retryafter)))
+    return delay
+
+  # Close every idle handle in the pool without waiting for the ones in use: those are closed when
+  # their request finishes, and the share once the last of them is back
+  def close(self):
+    idle = []
+    with self.lock:
+      if self.closed:
+        return
+      self.closed = True
+      while True:
+        try:
+          idle.append(self.pool.get_nowait())
+        except queue.Empty:
+          break
+      self.checkedin += len(idle)
+      last = self.checkedin == self.poolsize
+    for ch in idle:
+      if ch is not None:
+        ch.close()
+    if last:
+      self.share.close()
+
+# One shared client per API URL for the whole process
+_clients = {}
+_clientslock = threading.Lock()
+
+def getRCClient(api_url):
+  with _clientslock:
+    if api_url not in _clients:
+      _clients[api_url] = REDCapClient(api_url)
+    return _clients[api_url]
+
+# Replace the shared client for api_url with one using the given pool size/timeouts/retry settings
+def configureRCClient(api_url, **kwargs):
+  with _clientslock:
+    old = _clients.pop(api_url, None)
+    _clients[api_url] = REDCapClient(api_url, **kwargs)
+  if old is not None:
+    old.close()
+  return _clients[api_url]
+
+# Swap every shared client for a new one with the same settings and close the old handles.
+# Used before forking worker processes, which must not inherit the parent's open connections
+def reopenRCClients():
+  with _clientslock:
+    old = list(_clients.values())
+    for client in old:
+      _clients[client.api_url] = REDCapClient(client.api_url, **client.settings())
+  for client in old:
+    client.close()
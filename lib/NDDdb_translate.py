@@ -0,0 +1,219 @@
+import os
+import json
+import hashlib
+import threading
+import pandas as pd
+
+from NDDdb_cache import privateCacheDir
+from NDDdb_metadata import DDFILECOLUMNS, parseChoices, decodeChoices, decodeCheckboxes, encodeCheckboxes
+
+# Translation plan compiled from a REDCap data dictionary, for moving data in either direction:
+# labels -> codes when making a REDCap import (transform/general/make_redcap_import.py) and
+# codes -> labels when exporting REDCap data to LabKey (redcap2labkey_etl). The dictionary is
+# walked once and every field gets an operation, its forward (code -> label) and reverse
+# (label -> code) choice maps, its 'field___code' checkbox columns and, for validated text
+# fields, a regex for the values REDCap will accept. toCodes()/toLabels() then translate whole
+# columns at a time from the plan, without looking at the dictionary again.
+# Plans can be cached on disk (cachedir) as JSON, keyed by a hash of the dictionary's contents, so
+# an unchanged dictionary is only parsed once; editing it in REDCap gives it a new hash. The cache
+# directory is created private (0700), and it and its files are only used if they belong to the
+# user running the code, so nobody else can plant a plan in it.
+#
+# Operations:
+#   text      text/notes field (or a dropdown/radio without choices), passed through
+#   date      text field validated as a date; times are stripped on import
+#   yesno     yes/no field
+#   choice    dropdown/radio field, translated with its choice map
+#   checkbox  checkbox field, one 'field___code' column per option in REDCap
+#   skip      checkbox without choices: no columns in either direction
+#   other     anything else (calc, descriptive, file, slider, ...), passed through on export
+
+# Bump when the plan's contents change, so plans cached by an older version aren't loaded
+VERSION = 1
+
+# Columns of the dictionary that go into a plan (and into its hash)
+PLANCOLUMNS = ['field_name','form_name','field_type','select_choices_or_calculations','text_validation_type_or_show_slider_number','identifier']
+
+# Labels for yes/no fields on import
+YNMAP = {
+  't':'1','true':'1','y':'1','yes':'1',
+  'f':'0','false':'0','n':'0','no':'0'
+}
+DATETIMEPATTERN = '[0-9]{0,3}:[0-9]{0,3}:[0-9]{0,3}'
+
+# Values REDCap accepts for its text validation types; other types aren't checked
+VALIDATIONPATTERNS = {
+  'date_mdy':'^[0-9]{1,2}[-/][0-9]{1,2}[-/][0-9]{4}$',
+  'date_dmy':'^[0-9]{1,2}[-/][0-9]{1,2}[-/][0-9]{4}$',
+  'date_ymd':'^[0-9]{4}[-/][0-9]{1,2}[-/][0-9]{1,2}$',
+  'integer':'^[-+]?[0-9]+$',
+  'number':'^[-+]?([0-9]+[.]?[0-9]*|[.][0-9]+)$',
+  'email':'^[^@\\s]+@[^@\\s]+\\.[^@\\s]+$',
+  'zipcode':'^[0-9]{5}(-[0-9]{4})?$',
+  'phone':'^[^0-9]*([0-9][^0-9]*){10}$',
+  'time':'^[0-9]{1,2}:[0-9]{2}$'
+}
+
+def planOperation(fieldtype, validation, codes):
+  if fieldtype in ['text','notes']:
+    return 'date' if validation.startswith('date_') else 'text'
+  if fieldtype == 'yesno':
+    return 'yesno'
+  if fieldtype in ['dropdown','radio']:
+    return 'choice' if codes else 'text'
+  if fieldtype == 'checkbox':
+    return 'checkbox' if codes else 'skip'
+  return 'other'
+
+# Hash of the parts of a dictionary a plan is built from
+def dictionaryHash(dd, stripmarkup=False):
+  cols = [c for c in PLANCOLUMNS if c in dd.columns]
+  content = dd[cols].fillna('').to_csv(index=False)
+  return hashlib.sha256((str(VERSION) + '|' + str(stripmarkup) + '|' + content).encode('utf8')).hexdigest()[:24]
+
+class TranslationPlan:
+  # dd: a data dictionary frame with the API's column names (e.g. from getMetaData, or RCDataDictionary.dd)
+  def __init__(self, dd, stripmarkup=False):
+    self.hash = dictionaryHash(dd, stripmarkup)
+    self.fields = {}
+    identifiers = dd['identifier'] if 'identifier' in dd.columns else pd.Series('', index=dd.index)
+    for field, form, fieldtype, optstr, validation, identifier in zip(dd['field_name'], dd['form_name'], dd['field_type'],
+        dd['select_choices_or_calculations'], dd['text_validation_type_or_show_slider_number'], identifiers):
+      validation = validation if isinstance(validation, str) else ''
+      codes = parseChoices(optstr, stripmarkup) if fieldtype in ['dropdown','radio','checkbox'] else {}
+      self.fields[field] = {
+        'form':form,
+        'type':fieldtype,
+        'op':planOperation(fieldtype, validation, codes),
+        'identifier':identifier == 'y',
+        'codes':codes,
+        'labels':{label:code for code, label in codes.items()},
+        'cbcols':[field + '___' + str(code) for code in codes.keys()] if fieldtype == 'checkbox' else [],
+        'validation':validation,
+        'pattern':VALIDATIONPATTERNS.get(validation)
+      }
+
+  # The plan for dd, loaded from cachedir if it was compiled before, otherwise compiled (and saved)
+  @classmethod
+  def load(cls, dd, cachedir=None, stripmarkup=False):
+    if cachedir is None:
+      return cls(dd, stripmarkup)
+    cachedir = os.path.expanduser(cachedir)
+    planhash = dictionaryHash(dd, stripmarkup)
+    fpath = os.path.join(cachedir, 'plan_' + planhash + '.json')
+    if not privateCacheDir(cachedir):
+      print('WARNING: Not using plan cache ' + cachedir + ': it is not a directory owned by this user and closed to others')
+      return cls(dd, stripmarkup)
+    try:
+      fd = os.open(fpath, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+      with os.fdopen(fd, 'r', encoding='utf8') as f:
+        if os.fstat(f.fileno()).st_uid == os.getuid():
+          plan = cls.fromDict(json.load(f))
+          if plan.hash == planhash:
+            return plan
+    except (OSError, ValueError, KeyError, TypeError):
+      pass
+    plan = cls(dd, stripmarkup)
+    # Write to a temp file & move it into place so readers never see a partial file
+    tmppath = fpath + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    with open(os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf8') as f:
+      json.dump(plan.toDict(), f)
+    os.replace(tmppath, fpath)
+    return plan
+
+  def toDict(self):
+    return {'version':VERSION, 'hash':self.hash, 'fields':self.fields}
+
+  @classmethod
+  def fromDict(cls, d):
+    if d['version'] != VERSION:
+      raise ValueError('Translation plan was written by another version')
+    plan = cls.__new__(cls)
+    plan.hash = d['hash']
+    plan.fields = d['fields']
+    return plan
+
+  # Same as load, for a data dictionary .csv downloaded from the REDCap UI (read as latin-1, like RCDataDictionary.fromFile)
+  @classmethod
+  def fromFile(cls, fpath, cachedir=None, stripmarkup=False):
+    dd = pd.read_csv(fpath, encoding='latin-1', dtype='str', keep_default_na=False)
+    dd.rename(columns=DDFILECOLUMNS, inplace=True)
+    return cls.load(dd, cachedir, stripmarkup)
+
+  # Fields in dictionary order, optionally only those on one form and/or with one of ops
+  def fieldsOf(self, form=None, ops=None):
+    return [f for f, p in self.fields.items() if (form is None or p['form'] == form) and (ops is None or p['op'] in ops)]
+
+  def op(self, field):
+    return self.fields[field]['op']
+
+  # A copy of the plan with fields renamed (old -> new), e.g. for data whose record id column was renamed
+  def renamed(self, mapping):
+    plan = TranslationPlan.__new__(TranslationPlan)
+    plan.hash = self.hash
+    plan.fields = {}
+    for field, p in self.fields.items():
+      new = mapping.get(field, field)
+      plan.fields[new] = dict(p, cbcols=[new + col[len(field):] for col in p['cbcols']])
+    return plan
+
+  # Labels -> codes, for a REDCap import. Translates each of fields in dat, and returns a frame of
+  # the translated columns (a checkbox field becomes its 'field___code' columns) and a list of
+  # messages about values that couldn't be translated or won't pass REDCap's validation
+  def toCodes(self, dat, fields):
+    columns = []
+    messages = []
+    for field in fields:
+      p = self.fields[field]
+      op = p['op']
+      if op == 'checkbox':
+        # Explode the ';'-delimited labels once, look them up in the label -> code map and build every
+        # 'field___code' column in one pass (see encodeCheckboxes). Labels not in the map come back from the same pass
+        coded, unmapped = encodeCheckboxes(dat[field], field, p['labels'])
+        if len(unmapped) > 0:
+          messages.append(field + ' contains unmappable values (' + str(unmapped.index.nunique()) + ' rows):\n' + unmapped.value_counts().to_string())
+        columns.append(coded)
+        continue
+      s = dat[field]
+      if op == 'date':
+        s = s.str.replace(DATETIMEPATTERN, '', regex=True)
+      elif op == 'yesno':
+        s = s.str.lower().replace(YNMAP)
+        # Check to see if any values could not be translated
+        populated = s[s.notna()]
+        if ~populated.isin(['0','1']).all():
+          messages.append('The following rows contain values that cannot be mapped to booleans and have been set to NA:\n' + str(populated.loc[~populated.isin(['0','1'])]))
+          s = s.where(s.isin(['0','1']), '')
+      elif op == 'choice':
+        s = s.replace(p['labels'])
+      if p['pattern'] is not None:
+        populated = s[s.notna()].str.strip()
+        populated = populated.loc[populated != '']
+        invalid = populated.loc[~populated.str.match(p['pattern'])]
+        if len(invalid) > 0:
+          messages.append(field + ' has ' + str(len(invalid)) + ' values that are not valid ' + p['validation'] + ', e.g. ' + ', '.join(invalid.unique()[:5]))
+      columns.append(s.rename(field))
+    if not columns:
+      return pd.DataFrame(index=dat.index), messages
+    return pd.concat(columns, axis=1), messages
+
+  # Codes -> labels, for exporting REDCap data. Returns a frame with a column per field (skipped
+  # checkboxes have none): choices decoded, checkbox columns (found through cbindex, see
+  # indexCheckboxColumns) joined into a ';'-delimited string of labels, yes/no fields mapped with
+  # ynmap, and everything else as it is. Raises KeyError if a checkbox option has no column.
+  def toLabels(self, dat, fields, cbindex=None, ynmap=None):
+    columns = {}
+    for field in fields:
+      p = self.fields[field]
+      op = p['op']
+      if op == 'skip':
+        continue
+      if op == 'checkbox':
+        columns[field] = decodeCheckboxes(dat, field, p['codes'], cbindex)
+      elif op == 'choice':
+        columns[field] = decodeChoices(dat[field], p['codes'])
+      elif op == 'yesno' and ynmap is not None:
+        columns[field] = dat[field].map(ynmap)
+      else:
+        columns[field] = dat[field]
+    return pd.DataFrame(columns, index=dat.index)
@@ -19,7 +19,6 @@ sys.path.insert(0,'../lib')
 
 from pyserver_etl_config import rcparams, lkparams, importStudyArchivePath
 from rc2lk_table_config import rcinstr2lkconfig,rfreferralinstr,lktableconfig,dontimport,ynmap
-from functools import reduce
 import NDDdb_py_modules as NDDdb
 import pycurl
 import io
@@ -31,6 +30,7 @@ import re
 
 import os
 import shutil
+import pyarrow.feather as feather
 
 import labkey
 from labkey.utils import create_server_context
@@ -52,37 +52,41 @@ def concatCheckboxVals__DEPR(r):
     else:
         return ''
 
-# Find the Subject ID of an individual who was specified in a Redcap dropdown from piped-in vars
-RCDDPATTERN = '\[family_member_arm_1\]\[demo_firstname\]\[([0-9])\]'
-def getSubjIDof(rcstr,rcid,selectfampattern):
-    if rcstr=='' or rcstr.startswith('Unknown'):
-        return ''
-    else:
-        parsed = re.search(selectfampattern, rcstr)
-        rep = parsed.group(1)
-        subjid = rcsubjdat.loc[((rcsubjdat['redcap_id']==rcid) & (rcsubjdat['redcap_repeat_instance']==rep)),'labkey_subjid']
-        if len(subjid) > 0:
-            return subjid.iloc[0]
-        else:
-            return ''
-
-# For clinical genetics results, match the report
-RCCGPATTERN = '\[clinical_data_coll_arm_1\]\[clingen_reportsubj\]\[([0-9])\]'
-def getFromReport(rcstr,rcid,selectpattern,matchinstr):
-    if rcstr=='' or rcstr.startswith('Unknown'):
-        return ''
-    else:
-        parsed = re.search(selectpattern, rcstr)
-        rep = parsed.group(1)
-        matchrow = rcclindat.loc[((rcclindat['redcap_repeat_instrument']==matchinstr) & ((rcclindat['redcap_id']==rcid) & (rcclindat['redcap_repeat_instance']==rep))),]
-        subjid = getSubjIDof(matchrow['clingen_reportsubj'].iloc[0],rcid,RCDDPATTERN)
-        date = matchrow['clingen_reportdate'].iloc[0]
-        # lsid = rcforms[matchinstr].loc[((rcforms[f]['redcap_repeat_instrument']==matchinstr) & ((rcforms[f]['redcap_id']==rcid) & (rcforms[f]['redcap_repeat_instance']==rep))),'lsid'].iloc[0]
-        reportlsid = rcforms[matchinstr].loc[(rcforms[matchinstr]['redcap_repeat_instance']==rep) & (rcforms[matchinstr]['SubjectID']==subjid),'lsid'].iloc[0]
-        if len(subjid) > 0:
-            return {'SubjectID':subjid,'date':date,'reportLSID':reportlsid}
-        else:
-            return ''
+# Find the Subject IDs of individuals who were specified in a Redcap dropdown from piped-in vars.
+# Works on whole columns: the repeat instance is pulled out of every piped string with one str.extract,
+# then (family id, repeat instance) pairs are looked up in subjindex, a Series of labkey_subjid indexed
+# on (redcap_id, redcap_repeat_instance). Blank, 'Unknown' and unmatched selections resolve to ''.
+RCDDPATTERN = '\[family_member_arm_1\]\[demo_firstname\]\[([0-9]+)\]'
+def getSubjIDsOf(rcstrs,rcids,subjindex):
+    reps = rcstrs.fillna('').str.extract(RCDDPATTERN, expand=False)
+    keys = pd.MultiIndex.from_arrays([rcids.values, reps.values])
+    return pd.Series(subjindex.reindex(keys).values, index=rcstrs.index).fillna('')
+
+# Build the (redcap_id, redcap_repeat_instance) -> labkey_subjid lookup used by getSubjIDsOf
+def makeSubjIndex(subjdat):
+    subjindex = subjdat.set_index(['redcap_id','redcap_repeat_instance'])['labkey_subjid']
+    return subjindex[~subjindex.index.duplicated()]
+
+# For clinical genetics results, match the report. Each report of type matchinstr in clindat is indexed
+# on (redcap_id, redcap_repeat_instance) with its subject & date, and each row of the processed report
+# form on (redcap_repeat_instance, SubjectID) with its lsid, so every finding resolves with two joins.
+RCCGPATTERN = '\[clinical_data_coll_arm_1\]\[clingen_reportsubj\]\[([0-9]+)\]'
+def getFromReports(rcstrs,rcids,matchinstr,clindat,reportform,subjindex):
+    reports = clindat.loc[clindat['redcap_repeat_instrument']==matchinstr]
+    reports = pd.DataFrame({
+        'SubjectID':getSubjIDsOf(reports['clingen_reportsubj'],reports['redcap_id'],subjindex).values,
+        'date':reports['clingen_reportdate'].values
+    }, index=pd.MultiIndex.from_arrays([reports['redcap_id'].values, reports['redcap_repeat_instance'].values]))
+    reports = reports[~reports.index.duplicated()]
+    lsids = reportform.set_index(['redcap_repeat_instance','SubjectID'])['lsid']
+    lsids = lsids[~lsids.index.duplicated()]
+    reps = rcstrs.fillna('').str.extract(RCCGPATTERN, expand=False)
+    found = reports.reindex(pd.MultiIndex.from_arrays([rcids.values, reps.values])).fillna('')
+    found['reportLSID'] = lsids.reindex(pd.MultiIndex.from_arrays([reps.values, found['SubjectID'].values])).fillna('').values
+    found.index = rcstrs.index
+    # Findings whose report subject couldn't be resolved get no report info at all
+    found.loc[found['SubjectID']=='',['date','reportLSID']] = ''
+    return found
 
 # Combine multiple fields into a single one
 def concatFields(fields):
@@ -106,6 +110,51 @@ def zipdir(path, ziph):
         for file in files:
             ziph.write(os.path.join(root, file))
 
+#################
+# Incremental (delta) sync
+# The last pull of each REDCap project is kept on disk along with the time that pull started.
+# Delta runs only ask REDCap for records created/modified since then (dateRangeBegin) and splice
+# them into the snapshot, replacing every row of a changed record. Records deleted in REDCap are
+# not picked up by a delta run, so run with 'full' periodically to resync from scratch.
+# Snapshots hold identifiable data, so they are Feather files (loading one can't run code, unlike a
+# pickle) in a directory private to the user running the ETL (see NDDdb_cache.privateCacheDir).
+SNAPSHOTMARGIN = dt.timedelta(minutes=10) # overlap between runs to cover clock skew with the REDCap server
+
+def loadSnapshots(path):
+    try:
+        with open(os.path.join(path, 'state.json')) as fh:
+            state = json.load(fh)
+        return {
+            'since': state['since'],
+            'referral': feather.read_feather(os.path.join(path, 'referral.feather')),
+            'data': feather.read_feather(os.path.join(path, 'data.feather'))
+        }
+    except (FileNotFoundError, KeyError, ValueError, OSError):
+        return None
+
+def saveSnapshots(path, referral, data, pullstart):
+    feather.write_feather(referral.reset_index(drop=True), os.path.join(path, 'referral.feather'))
+    feather.write_feather(data.reset_index(drop=True), os.path.join(path, 'data.feather'))
+    # Snapshots from before the switch to Feather are never read again
+    for old in ['referral.pkl', 'data.pkl']:
+        if os.path.exists(os.path.join(path, old)):
+            os.remove(os.path.join(path, old))
+    # Write the high-water mark last, so an interrupted save never pairs a new mark with old data
+    with open(os.path.join(path, 'state.json'), 'w') as fh:
+        json.dump({'since': (pullstart - SNAPSHOTMARGIN).strftime('%Y-%m-%d %H:%M:%S')}, fh)
+
+# Replace every row of the records in delta, and add new records, then report what was pulled vs. reused
+def mergeDelta(project, snapshot, delta, idcol='redcap_id'):
+    if len(delta) == 0:
+        print(project + ': 0 records pulled, ' + str(snapshot[idcol].nunique()) + ' reused from snapshot')
+        return snapshot
+    changed = delta[idcol].unique()
+    reused = snapshot.loc[~snapshot[idcol].isin(changed)]
+    columns = list(snapshot.columns) + [c for c in delta.columns if c not in snapshot.columns]
+    merged = pd.concat([reused, delta], ignore_index=True)[columns]
+    print(project + ': ' + str(len(changed)) + ' records pulled, ' + str(reused[idcol].nunique()) + ' reused from snapshot')
+    return merged
+
 #################################################
 
 # Get command line arguments
@@ -114,6 +163,27 @@ debugMode = sys.argv[1] # {True,False}
 if debugMode == '':
     debugMode = True
 
+# Sync mode {delta,full}: delta (default) merges changed records into the local snapshot of the last
+# pull, full forces a complete re-export. Delta falls back to full when there is no snapshot yet.
+syncMode = sys.argv[2] if len(sys.argv) > 2 else 'delta'
+snapshotPath = os.path.expanduser(rcparams.get('snapshot_path', importStudyArchivePath + '/../rc_snapshot'))
+if not NDDdb.privateCacheDir(snapshotPath):
+    sys.exit('Snapshot directory ' + snapshotPath + ' must be a directory owned by you and closed to everyone else (chmod 700)')
+
+# Import mode {archive,direct,both}: archive (default) writes the TSVs & study archive zip for a full
+# reload in LabKey; direct pushes only new/changed rows through the LabKey query API; both does both.
+importMode = sys.argv[3] if len(sys.argv) > 3 else 'archive'
+writeArchive = importMode in ['archive','both']
+pushDirect = importMode in ['direct','both']
+
+# Share REDCap exports with other scripts through the on-disk cache, if one is configured. Every
+# pull here seeds or extends the snapshot, whose high-water mark assumes the data is live: a cached
+# export could be up to cache_ttl old, and records changed since it was written would never be
+# pulled again. So pulls always go to REDCap, but full exports are still stored in the cache for
+# other scripts, and pushes invalidate it.
+if 'cache_path' in rcparams:
+    NDDdb.setRCCache(NDDdb.RCExportCache(rcparams['cache_path'], rcparams.get('cache_ttl', 3600), rcparams.get('cache_maxbytes', 2*1024**3)), pulls=False, stores=True)
+
 # Get LabKey params & establish server context
 labkey_server = lkparams['labkey_server']
 project_name = lkparams['project_name']
@@ -123,24 +193,35 @@ use_ssl = lkparams['use_ssl']
 
 server_context = create_server_context(labkey_server, project_name, context_path, use_ssl)
 
-# Pull all REDCap records
+# Pull all REDCap records (or, in delta mode, only those changed since the last run)
+pullstart = dt.datetime.now()
+snapshots = loadSnapshots(snapshotPath) if syncMode == 'delta' else None
+since = snapshots['since'] if snapshots else ''
+if since:
+  print('Delta sync: pulling records modified since ' + since)
+else:
+  print('Full sync: pulling all records')
+
 # encoding = "ISO-8859-1" fixes import, but....
-refs = NDDdb.pullRCRecords(rcparams['rc_api_url'], rcparams['ndd_rc_refer_apikey'],'','','')
+refs = NDDdb.pullRCRecords(rcparams['rc_api_url'], rcparams['ndd_rc_refer_apikey'],'','','',since)
 
-# Pull Redcap instruments in chunks of n instruments at a time, then combine into single data frame
-def chunks(lst, n):
-  for i in range(0, len(lst), n):
-    yield lst[i:i + n]
+# Pull Redcap instruments in chunks of n instruments at a time, several chunks at once, then combine into single data frame
+# Chunk size & number of concurrent exports can be tuned in rcparams; per-chunk timings are printed
+chunksize = rcparams.get('export_chunksize', 10)
+exportworkers = rcparams.get('export_workers', 4)
+NDDdb.configureRCClient(rcparams['rc_api_url'], poolsize=exportworkers)
 
-chunksize = 10
 instr = list(set(rcinstr2lkconfig.keys()) - set(rfreferralinstr))
-instr_subsets = chunks(instr,chunksize)
-
-rc_list = []
-for i in instr_subsets:
-  rc_list.append(NDDdb.pullRCRecords(rcparams['rc_api_url'], rcparams['ndd_rc_data_apikey'],','.join(i),'','redcap_id,redcap_event_name,redcap_repeat_instance,redcap_repeat_instrument'))
-
-rc = reduce(lambda left,right: pd.merge(left,right,left_on=['redcap_id','redcap_event_name','redcap_repeat_instance','redcap_repeat_instrument'],right_on=['redcap_id','redcap_event_name','redcap_repeat_instance','redcap_repeat_instrument'],how='outer'), rc_list)
+rc = NDDdb.pullRCRecordsChunked(rcparams['rc_api_url'], rcparams['ndd_rc_data_apikey'], instr, ['redcap_id','redcap_event_name','redcap_repeat_instance','redcap_repeat_instrument'], chunksize, exportworkers, since)
+
+# Splice the changed records into the previous pull, then save the result as the new snapshot
+if snapshots:
+  refs = mergeDelta('Referral', snapshots['referral'], refs)
+  rc = mergeDelta('Data collection', snapshots['data'], rc)
+else:
+  print('Referral: ' + str(refs['redcap_id'].nunique()) + ' records pulled')
+  print('Data collection: ' + str(rc['redcap_id'].nunique()) + ' records pulled')
+saveSnapshots(snapshotPath, refs, rc, pullstart)
 rc.reset_index(inplace=True,drop=True)
 
 # Separate rows by event
@@ -178,10 +259,12 @@ rc.set_index(keys='redcap_id', drop = False, inplace = True, verify_integrity =
 rcnr.set_index(keys='redcap_id', drop = False, inplace = True, verify_integrity = True)
 
 # Pull the REDCap projects' data dictionaries to get all the unique form names in REDCap
-dd_dc = NDDdb.getMetaData(rcparams['rc_api_url'], rcparams['ndd_rc_data_apikey'],'')
-dd_dc.set_index(keys='field_name', drop = False, inplace = True, verify_integrity = True)
+# The registry parses every field's choice list once; copy the data frames since they're modified below
+ddreg_dc = NDDdb.metadata.get(rcparams['rc_api_url'], rcparams['ndd_rc_data_apikey'],'')
+dd_dc = ddreg_dc.dd.copy()
 
-dd_refer = NDDdb.getMetaData(rcparams['rc_api_url'], rcparams['ndd_rc_refer_apikey'],'')
+ddreg_refer = NDDdb.metadata.get(rcparams['rc_api_url'], rcparams['ndd_rc_refer_apikey'],'')
+dd_refer = ddreg_refer.dd.reset_index(drop=True)
 dd_refer.loc[dd_refer['field_name']=='redcap_id','field_name']='referral_id'
 dd_refer = dd_refer.loc[dd_refer['form_name']=='physician_referral_form'] # TODO this line can be deprecated once the leftover instruments are deleted from the Referral project
 dd_refer.set_index(keys='field_name', drop = False, inplace = True, verify_integrity = True)
@@ -198,59 +281,40 @@ for f in forms:
     rcforms[f][completefield] =  rcdat[completefield]
     rcforms[f]['redcap_repeat_instance'] = rcdat['redcap_repeat_instance']
 
-# Iterate over each field in the REDCap data dictionary
-# If it's in the data dictionary OR it's a checkbox field:
-#   If it is NOT an identifier:
-#     Check if it's a dropdown or radio button field
-#     If NO:
-#         Take the column and transfer it to the appropriate new data frame
-#     If YES:
-#         Parse the 'select_choices_or_calculations' field in the data dict and make a map of integers -> values
-#         Apply the transformation over every row
-#         Move the result to the the appropriate new data frame
-for dd in [dd_refer,dd_dc]:
-  for field in dd.index:
-      if field not in dontimport:
-          if dd['form_name'].loc[field] in forms:
-              isCheckbox = dd['field_type'].loc[field] == 'checkbox'
-              if field in rc or field in refs or isCheckbox:
-                  if dd['identifier'].loc[field] == 'y' and field != 'redcap_id':
-                    continue
-                  # Use event name to determine which dataframe to pull rows from
-                  rcdat = rcdict[rcinstr2lkconfig[dd['form_name'].loc[field]]['event']]
-                  if dd['field_type'].loc[field] in ['dropdown','radio','checkbox']:
-                      if dd['select_choices_or_calculations'].loc[field] != '': # handle edge cases like 'topecdate' where input type may be wrong
-                          optmap = NDDdb.parseChoiceMap(dd['select_choices_or_calculations'].loc[field],CHOICEPATTERN,ALTPATTERN)
-                          # If field is a checkbox:
-                          #   Iterate through every integer value in the choices map
-                          #   Find the corresponding checkbox field
-                          if isCheckbox:
-                              checkedlistcols = []
-                              #f = filter(lambda x:'icd_epi' in x, list(rc)) #Better way to select columns
-                              for (o,v) in optmap.items():
-                                  FIELDPATTERN = re.compile('^' + field + '_*' + str(o).lower()+'$')
-                                  cbfieldmatch = list(filter(FIELDPATTERN.match, list(rcdat)))
-                                  if len(cbfieldmatch) != 1:
-                                      print('FATAL ERROR: No match for regex pattern ' + str(FIELDPATTERN) + ' for REDCap field ' + field)
-                                      sys.exit()
-                                  else:
-                                      cbfield = cbfieldmatch[0]
-                                  # Replace '0' (unchecked) with null to mark it for removal, and replace '1' (checked) with the option's value
-                                  rcdat[cbfield].replace(to_replace = ['0','1'], value = [np.nan,v], inplace=True)
-                                  checkedlistcols.append(cbfield)
-                              #concatcbs = rcdat[checkedlistcols].apply(concatCheckboxVals, axis=1) # No longer works after update to latest pandas on 4/1/2020
-                              concatcbs = rcdat[checkedlistcols].apply(lambda x: ';'.join(x[~x.isna()]),axis=1)
-                              rcforms[dd['form_name'].loc[field]][field] = concatcbs
-                          # If it isn't a checkbox, convert all codes to their values
-                          else:
-                              rcdat[field].replace(optmap, inplace=True)
-                  if dd['field_type'].loc[field] == 'yesno':
-                      rcforms[dd['form_name'].loc[field]][field] = rcdat[field].map(ynmap)
-                  elif not isCheckbox:
-                      rcforms[dd['form_name'].loc[field]][field] = rcdat[field]
-              else:
-                  # print('that field isn\'t in the data dump')
-                  pass
+# Index each event's 'field___code' checkbox columns once, rather than regex-scanning the columns for every option
+cbindexes = {event: NDDdb.indexCheckboxColumns(list(rcdat)) for event, rcdat in rcdict.items()}
+
+# Translation plans for both projects' dictionaries (see NDDdb_translate.py): each field's operation,
+# choice map & checkbox columns, worked out once and cached on disk until the dictionary changes.
+# The referral project's record id is called referral_id here
+planCachePath = rcparams.get('plan_cache_path')
+plan_refer = NDDdb.TranslationPlan.load(ddreg_refer.dd, planCachePath).renamed({'redcap_id':'referral_id'})
+plan_dc = NDDdb.TranslationPlan.load(ddreg_dc.dd, planCachePath)
+
+# For each form, take the fields in the REDCap data dump (and all checkbox fields) that aren't identifiers,
+# and translate them as a whole frame: dropdown/radio codes decoded to labels, the checked 'field___code'
+# columns of each checkbox joined into a ';'-delimited string of labels, yes/no mapped with ynmap, and
+# everything else copied as it is. The result goes to the form's new data frame
+for dd, plan in [(dd_refer,plan_refer),(dd_dc,plan_dc)]:
+  for f in forms:
+      event = rcinstr2lkconfig[f]['event']
+      # Use event name to determine which dataframe to pull rows from
+      rcdat = rcdict[event]
+      fields = [field for field in plan.fieldsOf(form=f) if field in dd.index and field not in dontimport
+                and (field in rc or field in refs or plan.fields[field]['type'] == 'checkbox')
+                and not (plan.fields[field]['identifier'] and field != 'redcap_id')]
+      if not fields:
+          continue
+      try:
+          decoded = plan.toLabels(rcdat, fields, cbindexes[event], ynmap)
+      except KeyError as missing:
+          print('FATAL ERROR: No checkbox column for REDCap checkbox option ' + str(missing))
+          sys.exit()
+      # Decoded dropdowns also replace the codes in the REDCap data, since later steps (e.g. getFromReports) read their labels
+      for field in fields:
+          if plan.op(field) == 'choice':
+              rcdat[field] = decoded[field]
+      rcforms[f] = pd.concat([rcforms[f], decoded], axis=1)
 
 ### Assign LabKey SubjectIDs
 # Get the next available SubjectID
@@ -285,18 +349,23 @@ if anybodynew:
     idcols = ['redcap_id','redcap_event_name','redcap_repeat_instance', 'labkey_subjid']
     rcupdate = rcsubjdat[idcols]
     rcupdate = rcupdate.applymap(str)
-    rcupdatereq = NDDdb.pushRCRecord(rcparams['rc_api_url'], rcparams['ndd_rc_data_apikey'], '', rcupdate)
-    if rcupdatereq == 'Error communicating with REDCap database.':
-        print('FATAL ERROR: Could not import newly assigned identifers to REDCap')
+    try:
+        NDDdb.pushRCRecord(rcparams['rc_api_url'], rcparams['ndd_rc_data_apikey'], '', rcupdate)
+    except NDDdb.REDCapError as e:
+        print('FATAL ERROR: Could not import newly assigned identifers to REDCap: ' + str(e))
         sys.exit()
 
 # Add LabKey SubjectID column to referrals data frame
 refs['labkey_subjid']=rcsubjdat.loc[rcsubjdat['f_idnum'].str.startswith('F')].set_index('f_idnum',verify_integrity=True)['labkey_subjid']
 
+# Index subjects on (family id, repeat instance) now that everyone has a SubjectID, so that
+# dropdowns naming a family member can be resolved with a join instead of a scan per row
+subjindex = makeSubjIndex(rcsubjdat)
+
 # Clean out old import TSVs from minimal study archive folder before making new ones
 listPath = importStudyArchivePath + '/lists/'
 datasetPath = importStudyArchivePath + '/study/datasets/'
-for location in [listPath, datasetPath]:
+for location in [listPath, datasetPath] if writeArchive else []:
   for folder, subfolders, files in os.walk(location):
     for file in files:
         if file.endswith('.tsv'):
@@ -361,27 +430,27 @@ for table, LKconfig in lktableconfig.items():
       elif RCconfig['event']=='clinical_data_coll_arm_1':
           rcforms[f]['familyid'] = rcclindat['redcap_id'] # Think this line is a quicker way to do the same thing as line below
           if f=='clinical_genetics_finding':
-              cgreport = rcforms[f].apply(lambda x: getFromReport(x['clingen_report_id'],x['familyid'],RCCGPATTERN,'clinical_genetics_report'), axis=1, result_type='expand')
+              cgreport = getFromReports(rcforms[f]['clingen_report_id'],rcforms[f]['familyid'],'clinical_genetics_report',rcclindat,rcforms['clinical_genetics_report'],subjindex)
               rcforms[f]['SubjectID'] = cgreport['SubjectID']
               rcforms[f]['clingen_reportdate'] = cgreport['date']
               rcforms[f]['reportLSID'] = cgreport['reportLSID']
           else:
-              rcforms[f]['SubjectID'] = rcforms[f].apply(lambda x: getSubjIDof(x[RCconfig['subjcol']],x['familyid'],RCDDPATTERN), axis=1)
+              rcforms[f]['SubjectID'] = getSubjIDsOf(rcforms[f][RCconfig['subjcol']],rcforms[f]['familyid'],subjindex)
           rcforms[f].drop(columns=['familyid',RCconfig['subjcol']],inplace=True) # drop family id & REDCap coded-subject column before import #TODO could also just rename subject col to SubjectID first--then I'd be able to handle these fields the same way I do other subject dropdowns
       # Additional handling req'd for demographics form:
       #  1. Add family ids & consent date to demographics table
       #  2. Translate 'demo_twinsib', 'demo_mother', and 'demo_father' fields to SubjectIDs
-      #  Note: if twin/mother/father don't have a subjectID (because not consented, etc.) then getSubjIDof returns '' TODO
+      #  Note: if twin/mother/father don't have a subjectID (because not consented, etc.) then getSubjIDsOf returns '' TODO
       if f=='demographics':
-          rcforms[f]['familyid'] = rcforms[f].index.map(lambda x: str(rcsubjdat.loc[x,'redcap_id']))
-          rcforms[f][RCconfig['datecol']] = rcforms[f].index.map(lambda x: str(rcsubjdat.loc[x,RCconfig['datecol']]))
-          rcforms[f]['demo_twinsib'] = rcforms[f].apply(lambda x: getSubjIDof(x['demo_twinsib'], x['familyid'],RCDDPATTERN), axis=1)
-          rcforms[f]['demo_mother'] = rcforms[f].apply(lambda x: getSubjIDof(x['demo_mother'], x['familyid'],RCDDPATTERN), axis=1)
-          rcforms[f]['demo_father'] = rcforms[f].apply(lambda x: getSubjIDof(x['demo_father'], x['familyid'],RCDDPATTERN), axis=1)
+          rcforms[f]['familyid'] = rcsubjdat['redcap_id'].reindex(rcforms[f].index).astype(str)
+          rcforms[f][RCconfig['datecol']] = rcsubjdat[RCconfig['datecol']].reindex(rcforms[f].index).astype(str)
+          rcforms[f]['demo_twinsib'] = getSubjIDsOf(rcforms[f]['demo_twinsib'], rcforms[f]['familyid'], subjindex)
+          rcforms[f]['demo_mother'] = getSubjIDsOf(rcforms[f]['demo_mother'], rcforms[f]['familyid'], subjindex)
+          rcforms[f]['demo_father'] = getSubjIDsOf(rcforms[f]['demo_father'], rcforms[f]['familyid'], subjindex)
       # Additional handling req'd for enrollment form:
       #  1. Get demo_dateadded field from demographics table
       elif f in ['enrollment','phenotype','chart_review','appointment_questions_subject','rett_questions'] :
-          rcforms[f][RCconfig['datecol']] = rcforms[f].index.map(lambda x: str(rcsubjdat.loc[x,RCconfig['datecol']]))
+          rcforms[f][RCconfig['datecol']] = rcsubjdat[RCconfig['datecol']].reindex(rcforms[f].index).astype(str)
       # Specify which column will include the date and then drop that column
       rcforms[f]['date'] = rcforms[f][RCconfig['datecol']]
       rcforms[f].drop(columns=[RCconfig['datecol']],inplace=True)
@@ -406,7 +475,26 @@ for table, LKconfig in lktableconfig.items():
     fname = listPath + '/' + query + '.tsv'
     # Output TSV of all data to update
     # fname = outPath + query +'_forLKimport.tsv'
-  importdf.to_csv(fname,sep='\t')
+  if writeArchive:
+    importdf.to_csv(fname,sep='\t')
+  # Diff the table against LabKey's copy by row content hash & push only new/changed rows, in batches.
+  # Study rows are keyed on lsid (SubjectID for demographic datasets), lists on their 'key' config (default 'id').
+  # QCStateLabel is left out so that direct pushes don't reset QC states set in LabKey.
+  if pushDirect:
+    if schema == 'study':
+      lkkey = 'lsid' if 'lsid' in importdf else 'SubjectID'
+    else:
+      lkkey = LKconfig.get('key', 'id')
+    if lkkey not in importdf:
+      print('WARNING: ' + query + ' has no ' + lkkey + ' column, so it can only be imported via the study archive')
+    else:
+      lkwriter = NDDdb.LabKeyBulkWriter(server_context, schema, query, lkkey, lkparams.get('import_batchsize', 500))
+      # With check_diff set, first make sure the diff sees LabKey's own rows as unchanged
+      if lkparams.get('check_diff', False):
+        lkwriter.checkDiff([c for c in importdf.columns if c != 'QCStateLabel'])
+      lkresult = lkwriter.sync(importdf.drop(columns=['QCStateLabel'], errors='ignore'))
+      if not lkresult['success'].all():
+        print('ERROR: ' + str((~lkresult['success']).sum()) + ' ' + query + ' rows could not be written to LabKey')
 
 # For import to labkey, need a zip file containing:
 #   a study.xml file (see structure below)
@@ -424,11 +512,12 @@ for table, LKconfig in lktableconfig.items():
 #   <properties dir="properties"/>
 # </study>
 
-zipfname = 'studyArchiveToImport'
-zipPath = importStudyArchivePath + '/../' + zipfname
-try:
-  os.remove(zipPath + '.zip')
-except FileNotFoundError:
-  pass
+if writeArchive:
+  zipfname = 'studyArchiveToImport'
+  zipPath = importStudyArchivePath + '/../' + zipfname
+  try:
+    os.remove(zipPath + '.zip')
+  except FileNotFoundError:
+    pass
 
-shutil.make_archive(zipPath, 'zip', importStudyArchivePath)
+  shutil.make_archive(zipPath, 'zip', importStudyArchivePath)
@@ -0,0 +1,66 @@
+# gunicorn settings for the DET server.
+#>  gunicorn -c gunicorn.conf.py wsgi:app
+# The app is loaded once in the master (preload_app), so the data dictionaries, ID allocator seed
+# and duplicate index are fetched once and shared by the forked workers. Send the master SIGHUP
+# (kill -HUP, or POST to /refresh_metadata) to re-read the dictionaries and gracefully replace the workers;
+# gunicorn re-reads this file on SIGHUP too. Load time and each worker's memory are logged.
+# Settings come from flaskparams in pyserver_etl_config.py:
+#   gunicorn_bind (0.0.0.0:5000), gunicorn_workers (2), gunicorn_threads (8), gunicorn_timeout (120),
+#   behind_proxy (False: serve TLS with sslcer/sslkey; True: a proxy terminates TLS, serve plain HTTP)
+
+import os
+import sys
+import time
+import resource
+
+# gunicorn reads this file before it preloads the app, so startup is timed from here
+confloaded = time.perf_counter()
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(chdir, '../conf'))
+
+import pyserver_etl_config as config
+
+bind = config.flaskparams.get('gunicorn_bind', '0.0.0.0:5000')
+workers = config.flaskparams.get('gunicorn_workers', 2)
+threads = config.flaskparams.get('gunicorn_threads', 8)
+worker_class = 'gthread'
+timeout = config.flaskparams.get('gunicorn_timeout', 120)
+graceful_timeout = 60
+preload_app = True
+if not config.flaskparams.get('behind_proxy', False):
+  certfile = config.flaskparams['sslcer']
+  keyfile = config.flaskparams['sslkey']
+else:
+  forwarded_allow_ips = config.flaskparams.get('forwarded_allow_ips', '127.0.0.1')
+
+def rssMB():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def on_starting(server):
+  # Lets /refresh_metadata in a worker ask the master for a graceful reload
+  os.environ['NDDDB_GUNICORN_MASTER'] = str(os.getpid())
+
+def when_ready(server):
+  import pyserver_etl_ssl
+  server.log.info('Started in %.1fs, master RSS %.0f MB', time.perf_counter() - confloaded, rssMB())
+  pyserver_etl_ssl.prepareFork()
+
+# SIGHUP: refresh the master's dictionaries before the new workers are forked from it
+def on_reload(server):
+  import pyserver_etl_ssl
+  pyserver_etl_ssl.NDDdb.metadata.refresh()
+  pyserver_etl_ssl.prepareFork()
+  server.log.info('Data dictionaries refreshed, replacing workers')
+
+def post_fork(server, worker):
+  import pyserver_etl_ssl
+  pyserver_etl_ssl.startWorkers()
+
+def post_worker_init(worker):
+  worker.log.info('Worker %s ready, RSS %.0f MB', worker.pid, rssMB())
+
+def worker_exit(server, worker):
+  import pyserver_etl_ssl
+  pyserver_etl_ssl.detqueue.stop(timeout=graceful_timeout)
+  pyserver_etl_ssl.metrics.flush()
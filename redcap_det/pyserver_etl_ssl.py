@@ -1,19 +1,22 @@
 # Flask server for handling database transactions requested from REDCap.
-# To run:
-#>  export FLASK_APP=pyserver_lk.py
-#>  flask run
-# To run in debug mode, uncomment last line and then:
-#>  python3 pyserver_lk.py
+# To run in production (see gunicorn.conf.py & wsgi.py):
+#>  gunicorn -c gunicorn.conf.py wsgi:app
+# To run Flask's development server:
+#>  python3 pyserver_etl_ssl.py
 
 import sys # sys.stdout.flush() req'd to view stdout
-sys.path.insert(0,'../conf')
-sys.path.insert(0,'../lib')
+import os
+import time
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../conf'))
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'../lib'))
 
 import pyserver_etl_config as config
 import NDDdb_py_modules as NDDdb
+import NDDdb_async as NDDasync
+from NDDdb_metrics import metrics, newCorrelationID, setCorrelationID
 import NDDdb_field_dict as NDDdict
 
-from flask import Flask, request, redirect
+from flask import Flask, Blueprint, Response, request, redirect, g
 from flask_cors import CORS, cross_origin
 
 from OpenSSL import SSL
@@ -21,6 +24,10 @@ from OpenSSL import SSL
 import requests
 
 import json
+import hmac
+import asyncio
+import signal
+import resource
 
 import pandas as pd
 import numpy as np
@@ -30,6 +37,7 @@ import re
 import datetime as dt
 
 from labkey.utils import create_server_context
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 ##########
 # REDCap choices regexes
@@ -52,29 +60,181 @@ rc_data_pid = config.rcparams['ndd_rc_data_pid']
 rc_data_apikey = config.rcparams['ndd_rc_data_apikey']
 rc_sample_pid = config.rcparams['ndd_rc_sample_pid']
 rc_sample_apikey = config.rcparams['ndd_rc_sample_apikey']
-# Initialize LK properties from config file and create server context where queries will be executed
+# Initialize LK properties from config file
 labkey_server = config.lkparams['labkey_server']
 project_name = config.lkparams['project_name']
 context_path = config.lkparams['context_path']
 use_ssl = config.lkparams['use_ssl']
-server_context = create_server_context(labkey_server, project_name, context_path, use_ssl)
 
-app = Flask(__name__)
-app.config['SERVER_NAME']=config.flaskparams['servname']
-app.config['PREFERRRED_URL_SCHEME']='https'
-cors = CORS(app, resources={r'/*': {'origins': originspermitted}})
+# Set up by initShared(), once per server. Under gunicorn with preload_app this runs in the master,
+# so the workers share the loaded dictionaries etc. instead of each fetching them again
+server_context = None
+subjindex = None
+detqueue = None
+icd10 = None
+det_debounce = config.flaskparams.get('det_debounce', 10)
+det_maxwait = config.flaskparams.get('det_maxwait', 60)
+startup = {}
 
-# Pull RedCap metadata that will be used in various routes
-dd_refer = NDDdb.getMetaData(rc_api_url, rc_refer_apikey, 'family_members')
-dd_data = NDDdb.getMetaData(rc_api_url, rc_data_apikey, 'family_members')
-dd_refer.set_index(keys='field_name', drop = False, inplace = True, verify_integrity = True)
-dd_data.set_index(keys='field_name', drop = False, inplace = True, verify_integrity = True)
+def initShared():
+  global server_context, subjindex, detqueue, icd10
+  if server_context is not None:
+    return
+  start = time.perf_counter()
+  # REDCap call metrics are labelled with the project name instead of (a hash of) its token.
+  # JSON log lines (one per REDCap/LabKey call, route & DET job) can be turned off with json_logs
+  metrics.jsonlogs = config.flaskparams.get('json_logs', True)
+  # Every process (gunicorn's master & workers) adds its metrics to one shared file, so /metrics
+  # reports the whole server whichever worker answers the scrape
+  metrics.share(config.flaskparams.get('metrics_db', 'metrics.sqlite'))
+  metrics.describe('process_max_rss_megabytes', 'gauge', 'Peak resident memory of the largest server process', merge='max')
+  metrics.nameProject(rc_refer_apikey, 'referral')
+  metrics.nameProject(rc_data_apikey, 'data')
+  metrics.nameProject(rc_sample_apikey, 'sample')
+  # All routes share one pool of keep-alive connections to the REDCap API. Concurrent calls made by the
+  # async helpers are capped at the same number per host. Transient API failures are retried, and while
+  # REDCap is down calls fail fast (the DET queue retries the job later) instead of piling up
+  NDDdb.configureRCClient(rc_api_url, poolsize=config.rcparams.get('api_poolsize', 4), timeout=config.rcparams.get('api_timeout', 300),
+    retries=config.rcparams.get('api_retries', 4), breakerthreshold=config.rcparams.get('api_breaker_threshold', 5),
+    breakercooldown=config.rcparams.get('api_breaker_cooldown', 30))
+  NDDasync.setHostLimit(NDDasync.redcapHost(rc_api_url), config.rcparams.get('api_poolsize', 4))
+  # The server always pulls live data, but clears the shared export cache (if configured) whenever it
+  # pushes to a project or REDCap tells it a record was saved
+  if 'cache_path' in config.rcparams:
+    NDDdb.setRCCache(NDDdb.RCExportCache(config.rcparams['cache_path'], config.rcparams.get('cache_ttl', 3600), config.rcparams.get('cache_maxbytes', 2*1024**3)), pulls=False)
+  # Create server context where LabKey queries will be executed
+  server_context = create_server_context(labkey_server, project_name, context_path, use_ssl)
+  NDDasync.setHostLimit(NDDasync.labkeyHost(server_context), config.lkparams.get('api_concurrency', 4))
+  # Hand out DC IDs, F#s, individual numbers and LabKey IDs from a local sequence store (if configured),
+  # brought up to date with REDCap & LabKey at startup and then every idalloc_reseed seconds (see
+  # startWorkers). Check it with reconcile_ids.py
+  if 'idalloc_db' in config.rcparams:
+    idalloc = NDDdb.IDAllocator(config.rcparams['idalloc_db'])
+    NDDdb.seedIDAllocator(idalloc, rc_api_url, rc_data_apikey, server_context)
+    NDDdb.setIDAllocator(idalloc)
+  # Pull RedCap metadata that will be used in various routes. The registry keeps the parsed
+  # dictionaries in memory for pushToDC etc. and reloads them on a timer or via /refresh_metadata (POST)
+  NDDdb.metadata.get(rc_api_url, rc_refer_apikey, 'family_members')
+  NDDdb.metadata.get(rc_api_url, rc_data_apikey, 'family_members')
+  # Index of enrolled subjects used by /dupe_check (see NDDdb_dedupe.py). Built from the data collection
+  # project's demographics the first time (or when its keys change), kept up to date as subjects are
+  # enrolled or edited, and rebuilt every dedupe_rebuild seconds to pick up API imports & deletions
+  subjindex = NDDdb.SubjectIndex(config.flaskparams.get('dedupe_db', 'dedupe_index.sqlite'), config.flaskparams.get('dedupe_threshold', 0.88))
+  if subjindex.needsRebuild():
+    subjindex.rebuild(pullDemographics())
+  # ICD-10-CM lookups for /icd10 (see NDDdb_icd10.py). The index is memory-mapped, so opening it before
+  # forking costs nothing and all workers share one copy
+  if 'icd10_index' in config.flaskparams:
+    icd10 = NDDdb.getICD10Index(config.flaskparams['icd10_index'])
+  # DET requests are queued and answered straight away; worker threads run the pipelines, retrying
+  # failed jobs with backoff and one job at a time per record. Triggers for a record that arrive
+  # within det_debounce seconds of each other are merged into one run. See NDDdb_jobqueue.py
+  detqueue = NDDdb.DETJobQueue(config.flaskparams.get('det_queue_db', 'det_queue.sqlite'),
+    {'referral_pipeline':runReferralPipeline, 'data_pipeline':runDataPipeline, 'enroll_batch':runEnrollBatch},
+    workers=config.flaskparams.get('det_workers', 4),
+    maxattempts=config.flaskparams.get('det_maxattempts', 5),
+    retrydelay=config.flaskparams.get('det_retrydelay', 30))
+  startup['seconds'] = time.perf_counter() - start
+  startup['pid'] = os.getpid()
+  print('Shared state loaded in ' + '{:.1f}'.format(startup['seconds']) + 's')
+  sys.stdout.flush()
+
+# Close the connections opened while loading, so forked workers don't share sockets with the master
+def prepareFork():
+  NDDdb.reopenRCClients()
+  metrics.flush()
+
+# Background threads don't survive a fork, so they are started in each worker process
+# (gunicorn's post_fork hook) or by create_app() when running without gunicorn.
+# Each process also gets its own LabKey server context (and so its own HTTP session)
+def startWorkers():
+  global server_context
+  server_context = create_server_context(labkey_server, project_name, context_path, use_ssl)
+  NDDdb.metadata.startTimer(config.flaskparams.get('metadata_refresh', 3600))
+  # Catch up with IDs created outside the server (REDCap UI, API imports) every idalloc_reseed seconds,
+  # and rebuild the duplicate index every dedupe_rebuild seconds. Every worker runs the timers, but
+  # they claim each run in the shared SQLite file, so the work is done by one worker per interval
+  if 'idalloc_db' in config.rcparams:
+    NDDdb.startIDAllocatorReseed(config.rcparams.get('idalloc_reseed', 3600), rc_api_url, rc_data_apikey, server_context)
+  subjindex.startTimer(config.flaskparams.get('dedupe_rebuild', 24*3600), pullDemographics)
+  metrics.startFlusher(config.flaskparams.get('metrics_flush', 5))
+  detqueue.start()
+
+bp = Blueprint('ndddb', __name__)
+
+# Demographics of every enrolled subject, for (re)building the duplicate index
+def pullDemographics():
+  return NDDdb.pullRCRecords(rc_api_url, rc_data_apikey, 'demographics', '', 'redcap_id')
+
+# Add newly enrolled probands to the duplicate index; refs are referral rows, dcids their new family ids
+def indexProbands(refs, dcids):
+  subjindex.update(pd.DataFrame({'dcid':list(dcids), 'rep':'1', 'first':refs['firstname'].values, 'last':refs['lastname'].values, 'dob':refs['dob'].values, 'sex':refs['sex'].values}))
 
 # Relation map for LabKey updates
-reln_map = NDDdb.parseChoiceMap(dd_data.loc['demo_relation','select_choices_or_calculations'], CHOICEPATTERN, ALTPATTERN)
+def getRelnMap():
+  return NDDdb.metadata.get(rc_api_url, rc_data_apikey, 'family_members').choices['demo_relation']
+
+# Called after the data dictionaries change, so they get reloaded without restarting the server.
+# Under gunicorn this asks the master for a graceful reload (SIGHUP): it refreshes its copy of the
+# dictionaries and replaces the workers one by one, so every worker picks up the new ones.
+# Restarting every worker is not something just anyone may trigger: the route only takes a POST
+# carrying flaskparams['refresh_secret'] in an X-Refresh-Secret header (or a 'secret' form field), and
+# is switched off (404) if no secret is configured. On the server, kill -HUP <master pid> does the same
+@bp.route('/refresh_metadata', methods=['POST'])
+def refresh_metadata():
+  secret = config.flaskparams.get('refresh_secret', '')
+  if secret == '':
+    return Response('Not found', status=404)
+  given = request.headers.get('X-Refresh-Secret', request.form.get('secret', ''))
+  if not hmac.compare_digest(given.encode('utf8'), secret.encode('utf8')):
+    return Response('Forbidden', status=403)
+  if 'NDDDB_GUNICORN_MASTER' in os.environ:
+    os.kill(int(os.environ['NDDDB_GUNICORN_MASTER']), signal.SIGHUP)
+  else:
+    NDDdb.metadata.refresh()
+  return ''
+
+# Startup time & memory use of the worker that answers, e.g. for checking a deployment
+@bp.route('/worker_info', methods=methodspermitted)
+@cross_origin(origin=originspermitted)
+def worker_info():
+  return json.dumps({'pid':os.getpid(), 'startup_pid':startup.get('pid'), 'startup_seconds':startup.get('seconds'), 'rss_mb':workerRSS()})
+
+# Prometheus scrape endpoint. Reports the totals of all workers (see NDDdb_metrics.py); counts a
+# worker made in its last few seconds show up once it flushes them
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+  for status, n in detqueue.counts().items():
+    metrics.setGauge('det_queue_jobs', (('status', status),), n)
+  for pipeline, stats in detqueue.mergeStats().items():
+    metrics.setGauge('det_queue_triggers', (('pipeline', pipeline),), stats['triggers'])
+    metrics.setGauge('det_queue_merged', (('pipeline', pipeline),), stats['merged'])
+  metrics.setGauge('process_max_rss_megabytes', (), workerRSS())
+  return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# ICD-10-CM lookups: /icd10?code=G40.001, /icd10?prefix=G40 (the whole code family) or /icd10?q=absence+epil
+# (codes whose description has all these words; the last one may be the start of a word).
+# limit caps the number of codes returned (default 50, at most ICD10MAXLIMIT)
+ICD10MAXLIMIT = 500
+
+@bp.route('/icd10', methods=['GET'])
+@cross_origin(origin=originspermitted)
+def icd10_lookup():
+  if icd10 is None:
+    return json.dumps({'error':'No ICD-10 index configured'}), 404
+  try:
+    limit = int(request.args.get('limit', 50))
+  except ValueError:
+    return json.dumps({'error':'limit must be a whole number'}), 400
+  limit = max(1, min(limit, ICD10MAXLIMIT))
+  if 'code' in request.args:
+    return json.dumps(icd10.lookup(request.args.get('code')))
+  if 'prefix' in request.args:
+    return json.dumps(icd10.prefix(request.args.get('prefix'), limit))
+  return json.dumps(icd10.search(request.args.get('q', ''), limit))
 
 ### ETL/Data manipulation ###
-@app.route('/dupe_check', methods=methodspermitted)
+@bp.route('/dupe_check', methods=methodspermitted)
 @cross_origin(origin=originspermitted)
 def dupe_check():
   checkAll = True
@@ -88,19 +248,14 @@ def dupe_check():
   referral = NDDdb.pullRCRecords(rc_api_url, rc_refer_apikey, instr, refid, '')
   referral = referral.loc[referral['redcap_repeat_instrument']==''] # TODO deprecate this temporary code
   referral.set_index(keys='redcap_id', drop = False, inplace = True, verify_integrity = True)
-  referral['uqid'] = referral['firstname'].str.lower() + referral['lastname'].str.lower() + referral['dob'] + referral['sex']
   referral = referral.loc[referral['verifiedunique']!='1']
   if len(referral) > 0:
-    # Pull all data collection records and make lookup column
-    projdat = NDDdb.pullRCRecords(rc_api_url, rc_data_apikey, 'demographics', '', 'redcap_id')
-    projdat.set_index(keys='redcap_id', drop = False, inplace = True, verify_integrity = False)
-    if len(projdat) > 0:
-      subjs = projdat.loc[projdat['redcap_event_name']=='family_member_arm_1']
-    else:
-      subjs = projdat
-    subjs['uqid'] = subjs['demo_firstname'].str.lower() +subjs['demo_lastname'].str.lower() +subjs['demo_dob']+subjs['demo_sex']
-    # Check uniqueness of referral lookup against the list of subjects already enrolled
-    referral['duplicated'] = referral['uqid'].isin(subjs['uqid'].values)
+    # Check each referral against the index of subjects already enrolled (fuzzy on names, see NDDdb_dedupe.py)
+    matches = subjindex.matchFrame(pd.DataFrame({'first':referral['firstname'], 'last':referral['lastname'], 'dob':referral['dob'], 'sex':referral['sex']}))
+    referral['duplicated'] = matches['dcid'] != ''
+    for refid_, dcid, rep, score in zip(matches.index, matches['dcid'], matches['rep'], matches['score']):
+      if dcid != '':
+        print('Referral ' + refid_ + ' may be subject ' + dcid + '/' + rep + ' (name similarity ' + '{:.2f}'.format(score) + ')')
     # Write pass/fail booleans back to referral project
     update = referral[['redcap_id']].copy()
     update['verifiedunique'] = referral['duplicated'].map({True:'0',False:'1'})
@@ -114,7 +269,7 @@ def dupe_check():
   return redirect(dest, code=302)
 
 # Overwrite proband's contact data w/ contact info recorded in corresponding referral
-@app.route('/copyContactInfo', methods=methodspermitted)
+@bp.route('/copyContactInfo', methods=methodspermitted)
 @cross_origin(origin=originspermitted)
 def copyContactInfo():
   dcid = request.args.get('record') # data collection ID if it was passed
@@ -138,7 +293,7 @@ def copyContactInfo():
   return redirect(dest, code=302)
 
 # Overwrite proband's contact data w/ contact info recorded in corresponding referral
-@app.route('/copyParentsInfoFromDC', methods=methodspermitted)
+@bp.route('/copyParentsInfoFromDC', methods=methodspermitted)
 @cross_origin(origin=originspermitted)
 def copyParentsInfoFromDC():
   refid = request.args.get('record') # data collection ID if it was passed
@@ -184,25 +339,119 @@ def copyParentsInfoFromDC():
   dest = rc_base_url + rc_refer_pid + '&arm=1&id=' + refid
   return redirect(dest, code=302)
 
-####### Routes called by DET
-# Triggered on changes to the referral project
-@app.route('/referral_pipeline', methods=methodspermitted)
+# Enroll many referrals in one pass, e.g. to catch up on a backlog: /enroll_batch?records=12,15,16
+# The batch runs as a DET queue job (retried like any other), which waits for queued or running
+# referral_pipeline jobs of the same referrals and holds up new ones until it's done, so a referral
+# is never enrolled by both at once. Returns the job id; /det_queue?job=<id> shows how it went, and the
+# result per referral is logged
+@bp.route('/enroll_batch', methods=methodspermitted)
 @cross_origin(origin=originspermitted)
-def referral_pipeline():
-  reqdat = dict(request.form)
-  # Check the format returned sent by the REDCap server to determine if the values in the dict are lists or strings
-  if type(reqdat['record']) is str:
-    recordid = reqdat['record']
-    instr = reqdat['instrument']
-  elif type(reqdat['record']) is list:
-    recordid = reqdat['record'][0]
-    instr = reqdat['instrument'][0]
+def enroll_batch():
+  refids = list(dict.fromkeys(r for r in request.values.get('records', '').split(',') if r != ''))
+  if len(refids) == 0:
+    return 'No records given', 400
+  if not NDDdb.hasIDAllocator():
+    return 'Batch enrollment needs an ID allocator (rcparams idalloc_db)', 503
+  jobid = detqueue.enqueue('enroll_batch', ','.join(refids), {'records':refids}, keys=[('referral_pipeline', r) for r in refids])
+  return json.dumps({'job':jobid, 'records':refids})
+
+####### Pipelines run by the DET queue workers
+# Referrals in payload['records'] that are flagged for enrollment & verified unique are pushed to the data
+# collection project with pushToDCBatch; new families also get their LabKey family & proband IDs. Safe to
+# retry: families made by an earlier attempt are reused and probands that already have a LabKey ID keep it
+def runEnrollBatch(payload):
+  refids = payload['records']
+  ctx = NDDdb.newRecordContext()
+  referral = ctx.pullRCRecords(rc_api_url, rc_refer_apikey, 'physician_referral_form', ','.join(refids), 'dataproj_id,idnum')
+  referral = referral.loc[referral['redcap_repeat_instrument']==''] # TODO deprecate this temporary code
+  referral.set_index(keys='redcap_id', drop = False, inplace = True, verify_integrity = True)
+  eligible = referral.loc[(referral['referral_triggerenroll']=='1') & (referral['verifiedunique']=='1'), 'redcap_id']
+  results = NDDdb.pushToDCBatch(rc_api_url, rc_refer_apikey, rc_data_apikey, referral, eligible, ctx=ctx)
+  newfams = results.loc[results['new'] & results['success']]
+  if len(newfams) > 0:
+    indexProbands(referral.loc[newfams['refid']], newfams['dcid'])
+    NDDdb.checkWrite(NDDdb.LabKeyBulkWriter(server_context, 'lists', 'Families', 'id').upsert(pd.DataFrame({'id':newfams['dcid'], 'referralid':newfams['refid']})))
+    # Probands given a LabKey ID by an earlier attempt at this batch are left alone
+    enroll = ctx.pullRCRecords(rc_api_url, rc_data_apikey, 'enrollment', ','.join(newfams['dcid']), 'redcap_id')
+    haslkid = set(enroll.loc[(enroll['redcap_repeat_instance']=='1') & (enroll['labkey_subjid']!=''), 'redcap_id']) if len(enroll) > 0 else set()
+    probands = pd.DataFrame({'dcid':newfams['dcid'], 'rep':'1', 'reln':'Proband', 'dateadded':dt.datetime.today().strftime('%Y-%m-%d')})
+    probands = probands.loc[~probands['dcid'].isin(haslkid)]
+    if len(probands) > 0:
+      NDDdb.assignLabKeyIDBatch(rc_api_url, rc_data_apikey, server_context, probands, ctx=ctx)
+  skipped = [r for r in refids if r not in set(results['refid'])]
+  skipped = pd.DataFrame({'refid':skipped, 'dcid':'', 'idnum':'', 'new':False, 'success':False, 'error':'Not found, not flagged for enrollment or not verified unique'})
+  results = pd.concat([results, skipped], ignore_index=True)
+  print('Batch enrollment: ' + str(int(results['success'].sum())) + ' of ' + str(len(refids)) + ' referrals enrolled')
+  print(results.to_json(orient='records'))
+  sys.stdout.flush()
+
+# Value of key in a DET form. Depending on how the form was read the values are strings or lists
+def triggerValue(reqdat, key):
+  val = reqdat.get(key, '')
+  if type(val) is list:
+    val = val[0] if len(val) > 0 else ''
+  return val
+
+# Distinct values of key across a batch of merged DET triggers, in the order they were saved
+def triggerValues(triggers, key, instrs=None):
+  vals = []
+  for reqdat in triggers:
+    if instrs is not None and triggerValue(reqdat, 'instrument') not in instrs:
+      continue
+    val = triggerValue(reqdat, key)
+    if val not in vals:
+      vals.append(val)
+  return vals
+
+# Enroll a referral in the data collection project. For a new family, the LabKey family row and the
+# proband's LabKey ID are only worked on once the data collection record exists; those two then run
+# together, and the proband's LabKey row is written before the ID goes into REDCap (see NDDdb_async.py).
+# A LabKey row that fails to write raises, so the DET job fails and is retried.
+# Every step can be repeated, so a DET job that failed part-way can simply be retried: the family row
+# is upserted, a proband who already has a LabKey ID keeps it, and a family whose proband has none
+# yet (an earlier run stopped before LabKey) gets its LabKey rows now
+async def enrollReferral(referral, recordid, dcid, idnum, imnewhere, ctx):
+  if not imnewhere and (idnum != '01' or await probandLabKeyID(dcid, ctx) != ''):
+    return await NDDasync.pushToDCAsync(rc_api_url, rc_refer_apikey, rc_data_apikey, referral, recordid, dcid, idnum, imnewhere, ctx=ctx)
+  idnum = await NDDasync.pushToDCAsync(rc_api_url, rc_refer_apikey, rc_data_apikey, referral, recordid, dcid, idnum, imnewhere, ctx=ctx)
+  lkupdate = pd.DataFrame(data={'id':[dcid], 'referralid':[recordid]})
+  upserted, lkid = await asyncio.gather(
+    NDDasync.labkeyAsync(server_context, NDDdb.LabKeyBulkWriter(server_context, 'lists', 'Families', 'id').upsert, lkupdate),
+    probandLabKeyID(dcid, ctx, allocate=True))
+  NDDdb.checkWrite(upserted)
+  await NDDasync.assignLabKeyIDAsync(rc_api_url, rc_data_apikey, server_context, dcid, '1', str(lkid), 'Proband', dt.datetime.today().strftime('%Y-%m-%d'), ctx=ctx)
+  return idnum
+
+# LabKey ID of family dcid's proband in REDCap ('' if it has none). With allocate=True, a proband
+# without one gets the next LabKey ID instead
+async def probandLabKeyID(dcid, ctx, allocate=False):
+  enroll = await NDDasync.pullRCRecordsAsync(rc_api_url, rc_data_apikey, 'enrollment', dcid, 'redcap_id', ctx)
+  lkid = enroll.loc[enroll['redcap_repeat_instance']=='1', 'labkey_subjid'] if len(enroll) > 0 else []
+  if len(lkid) > 0 and lkid.iloc[0] != '':
+    return lkid.iloc[0]
+  return await NDDasync.getNextLabKeyIDAsync(server_context) if allocate else ''
+
+# Write the proband's F-individual# to REDCap & LabKey, then the family's new F#. The family's fnum in
+# the data collection project goes last: the pipeline only assigns an F# to a family without one, so a
+# job that failed part-way is retried from the start
+async def assignFamilyIDs(recordid, dcid, lkid, fnum, idnum, ctx):
+  await NDDasync.assignFindivIDAsync(rc_api_url, rc_refer_apikey, rc_data_apikey, server_context, recordid, dcid, '1', lkid, fnum, idnum, ctx=ctx)
+  await NDDasync.assignFIDAsync(rc_api_url, rc_data_apikey, server_context, dcid, fnum, ctx=ctx)
+
+# Run for changes to one referral record. triggers are the forms REDCap posted to /referral_pipeline
+# for that record, merged by the DET queue
+def runReferralPipeline(triggers):
+  recordid = triggerValue(triggers[0], 'record')
+  instrs = triggerValues(triggers, 'instrument')
+  NDDdb.invalidateRCCache(rc_api_url, rc_refer_apikey)
+  # Records pulled during this run are kept in memory and updated by our own pushes
+  ctx = NDDdb.newRecordContext()
   # Pull record
-  referral = NDDdb.pullRCRecords(rc_api_url, rc_refer_apikey, instr, recordid,'pintoreferral_stat,apptdate,idnum,f_idnum,dataproj_id,physician_referral_form_complete')
+  referral = ctx.pullRCRecords(rc_api_url, rc_refer_apikey, ','.join(instrs), recordid,'pintoreferral_stat,apptdate,idnum,f_idnum,dataproj_id,physician_referral_form_complete')
   referral = referral.loc[referral['redcap_repeat_instrument']==''] # TODO deprecate this temporary code
   referral.set_index(keys='redcap_id', drop = False, inplace = True, verify_integrity = True)
   # Fill in provider email if it hasn't been set already
-  if instr == 'physician_referral_form':
+  if 'physician_referral_form' in instrs:
     if referral.loc[recordid,'provider_email']=='':
       if referral.loc[recordid,'sinaistatus']!='':
         if referral.loc[recordid,'sinaistatus']=='1':
@@ -212,100 +461,142 @@ def referral_pipeline():
         else:
           provider_email = ''
       update = pd.DataFrame(data={'redcap_id':[recordid], 'provider_email':[provider_email]})
-      updatereferreq = NDDdb.pushRCRecord(rc_api_url, rc_refer_apikey, '', update)
+      updatereferreq = ctx.pushRCRecord(rc_api_url, rc_refer_apikey, '', update)
   # Get data collection id
   dcid = referral.loc[recordid,'dataproj_id']
-  # If the data collection id is blank, query RedCap for the next one and set the 'I'm new here' flag
-  imnewhere = False
-  if dcid == '':
-    imnewhere = True
-    dcid = str(NDDdb.getNextDCID(rc_api_url, rc_data_apikey))
+  # If the data collection id is blank, set the 'I'm new here' flag
+  imnewhere = dcid == ''
   # Get individual #
   idnum = referral.loc[recordid,'idnum']
   # then check value of 'referral_triggerenroll' and 'referral_id'
   # finally write new project id back to 'referral_id'
   if referral.loc[recordid,'referral_triggerenroll'] == '1' and referral.loc[recordid,'verifiedunique']=='1':
-    idnum = NDDdb.pushToDC(rc_api_url, rc_refer_apikey, rc_data_apikey, referral, recordid, dcid, idnum, imnewhere)
     if imnewhere:
-      lkupdate = pd.DataFrame(data={'id':[dcid], 'referralid':[recordid]})
-      NDDdb.LKinsertRow(lkupdate.iloc[0], 'Families', 'lists', server_context)
-      lkid = str(NDDdb.getNextLabKeyID(server_context))
-      NDDdb.assignLabKeyID(rc_api_url, rc_data_apikey, server_context, dcid, '1', lkid, 'Proband', dt.datetime.today().strftime('%Y-%m-%d'))
+      # A family may already exist for this referral if an earlier run failed before writing dataproj_id
+      # back; reuse it rather than enrolling the referral twice. Otherwise get the next DC ID
+      dcid = NDDdb.findDCIDForReferral(rc_api_url, rc_data_apikey, recordid, ctx=ctx)
+      if dcid == '':
+        dcid = str(NDDdb.getNextDCID(rc_api_url, rc_data_apikey, ctx=ctx))
+      else:
+        print('Referral ' + recordid + ' is already enrolled as family ' + dcid + '; finishing its enrollment')
+    idnum = asyncio.run(enrollReferral(referral, recordid, dcid, idnum, imnewhere, ctx))
+    if imnewhere:
+      indexProbands(referral.loc[[recordid]], [dcid])
   # Check if this subject was referred to Pinto study and has an appointment date
   # how to check for fam's record here?
   apptdate = referral.loc[recordid,'apptdate']
-  if referral.loc[recordid,'pintoreferral_stat']=='1' and apptdate != '' and idnum == '01':
+  if referral.loc[recordid,'pintoreferral_stat']=='1' and apptdate != '' and idnum == '01' and dcid != '':
     # Assign F# if this subject does not have one already
-    dc = NDDdb.pullRCRecords(rc_api_url, rc_data_apikey, 'family_enrollment', '', '')
+    dc = ctx.pullRCRecords(rc_api_url, rc_data_apikey, 'family_enrollment', '', '')
     if len(dc) > 0:
       dc = dc.loc[dc['redcap_event_name']=='family_data_arm_1']
     dc.set_index(keys='redcap_id', drop = False, inplace = True, verify_integrity = True)
     fnum = dc.loc[str(dcid),'fnum']
     # Assign F# if this subject does not have one already
     if fnum == '':
-      myfam = NDDdb.pullRCRecords(rc_api_url, rc_data_apikey, 'enrollment', dcid, '')
+      myfam = ctx.pullRCRecords(rc_api_url, rc_data_apikey, 'enrollment', dcid, '')
       myfam.set_index(keys='idnum', drop = False, inplace = True, verify_integrity = False)
       lkid = myfam.loc[idnum,'labkey_subjid']
       fnum = NDDdb.getNextFnum(apptdate,dc)
-      NDDdb.assignFID(rc_api_url, rc_data_apikey, server_context, dcid, fnum)
-      NDDdb.assignFindivID(rc_api_url, rc_refer_apikey, rc_data_apikey, server_context, recordid, dcid, '1', lkid, fnum, idnum)
+      asyncio.run(assignFamilyIDs(recordid, dcid, lkid, fnum, idnum, ctx))
+  print('Referral pipeline: ' + str(ctx.pulls) + ' pulls from REDCap, ' + str(ctx.hits) + ' served from memory')
   sys.stdout.flush()
-  return ''
 
-# Triggered on changes to the data collection project
-@app.route('/data_pipeline', methods=methodspermitted)
-@cross_origin(origin=originspermitted)
-def data_pipeline():
-    reqdat = dict(request.form)
-    print(reqdat)
-    print(reqdat['record'])
-    # Check the format returned sent by the REDCap server to determine if the values in the dict are lists or strings
-    if type(reqdat['record']) is str:
-      recordid = reqdat['record']
-      instr = reqdat['instrument']
-    elif type(reqdat['record']) is list:
-      recordid = reqdat['record'][0]
-      instr = reqdat['instrument'][0]
-    if instr == 'demographics' or instr == 'enrollment':
+# Run for changes to one data collection record. triggers are the forms REDCap posted to /data_pipeline
+# for that record, merged by the DET queue. Each table is pulled once for the whole batch.
+def runDataPipeline(triggers):
+    print(triggers)
+    recordid = triggerValue(triggers[0], 'record')
+    print(recordid)
+    NDDdb.invalidateRCCache(rc_api_url, rc_data_apikey)
+    # Records pulled during this run are kept in memory and updated by our own pushes
+    ctx = NDDdb.newRecordContext()
+    # Family members (repeat instances) whose enrollment or demographics were saved
+    reps = triggerValues(triggers, 'redcap_repeat_instance', ['demographics','enrollment'])
+    demoreps = triggerValues(triggers, 'redcap_repeat_instance', ['demographics'])
+    if len(reps) > 0:
       # Check to see if a new family member has been added by pulling the Enrollment table from the Data Collection project
-      rep = reqdat['redcap_repeat_instance'][0]
-      enroll = NDDdb.pullRCRecords(rc_api_url, rc_data_apikey, 'enrollment', recordid, 'redcap_id,demo_dateadded,demo_relation')
+      enroll = ctx.pullRCRecords(rc_api_url, rc_data_apikey, 'enrollment', recordid, 'redcap_id,demo_dateadded,demo_relation')
       enroll.set_index(keys='redcap_repeat_instance', drop = False, inplace = True, verify_integrity = True)
-      lkid = enroll.loc[rep,'labkey_subjid']
-      reln = enroll.loc[rep,'demo_relation']
-      if reln!='':
-        if lkid=='': # Assign LabKey ID by querying LabKey for next available integer
-          lkid = str(NDDdb.getNextLabKeyID(server_context))
-          NDDdb.assignLabKeyID(rc_api_url, rc_data_apikey, server_context, recordid, rep, lkid, reln_map[reln], enroll.loc[rep,'demo_dateadded'])
-        idnum = enroll.loc[rep,'idnum']
-        if idnum=='': # Assign individual number by pulling family record and checking for next available value--or, if relation is one of {Proband, Mother, Father}, assign designated numbers
-          famdat = NDDdb.pullRCRecords(rc_api_url, rc_data_apikey, 'family_enrollment', recordid, '')
-          fnrow = famdat.loc[famdat['redcap_event_name']=='family_data_arm_1',].index
-          fnum = famdat.loc[fnrow,'fnum'].values[0]
-          if fnum != '':
-            print('Checking for next Ind num')
-            idnum = NDDdb.getNextIndNum(reln,enroll['idnum'])
-            print('Assigninf F-idnum')
-            NDDdb.assignFindivID(rc_api_url, rc_refer_apikey, rc_data_apikey, server_context, None, recordid, rep, lkid, fnum, idnum)
+      famdat = None
+      for rep in reps:
+        lkid = enroll.loc[rep,'labkey_subjid']
+        reln = enroll.loc[rep,'demo_relation']
+        if reln!='':
+          if lkid=='': # Assign LabKey ID by querying LabKey for next available integer
+            lkid = str(NDDdb.getNextLabKeyID(server_context))
+            NDDdb.assignLabKeyID(rc_api_url, rc_data_apikey, server_context, recordid, rep, lkid, getRelnMap()[reln], enroll.loc[rep,'demo_dateadded'], ctx=ctx)
+          idnum = enroll.loc[rep,'idnum']
+          if idnum=='': # Assign individual number by pulling family record and checking for next available value--or, if relation is one of {Proband, Mother, Father}, assign designated numbers
+            if famdat is None:
+              famdat = ctx.pullRCRecords(rc_api_url, rc_data_apikey, 'family_enrollment', recordid, '')
+            fnrow = famdat.loc[famdat['redcap_event_name']=='family_data_arm_1',].index
+            fnum = famdat.loc[fnrow,'fnum'].values[0]
+            if fnum != '':
+              print('Checking for next Ind num')
+              idnum = NDDdb.getNextIndNum(reln,enroll['idnum'],recordid)
+              print('Assigninf F-idnum')
+              NDDdb.assignFindivID(rc_api_url, rc_refer_apikey, rc_data_apikey, server_context, None, recordid, rep, lkid, fnum, idnum, ctx=ctx)
+              enroll.loc[rep,'idnum'] = idnum # so the next new member in this batch doesn't get the same number
     # Check to see if 'copy contact from' field has been set
-    if instr == 'demographics':
-      demo = NDDdb.pullRCRecords(rc_api_url, rc_data_apikey, 'demographics', recordid,'redcap_id')
-      reptocopy = demo.loc[demo['redcap_repeat_instance']==rep]['demo_copycontactfrom'].values[0]
-      if reptocopy != '':
-        copyfrom = demo.loc[demo['redcap_repeat_instance']==reptocopy]
-        pasteto = copyfrom[['redcap_id','demo_address1','demo_address2','demo_apt','demo_city','demo_state','demo_zip','demo_email','demo_email2','demo_phone','demo_phone2']]
-        pasteto['demo_copycontactfrom'] = ''
-        pasteto['redcap_event_name'] = 'family_member_arm_1'
-        pasteto['redcap_repeat_instance'] = rep
-        updateres = NDDdb.pushRCRecord(rc_api_url, rc_data_apikey, '', pasteto)
+    if len(demoreps) > 0:
+      demo = ctx.pullRCRecords(rc_api_url, rc_data_apikey, 'demographics', recordid,'redcap_id')
+      subjindex.updateFromDemographics(demo.loc[demo['redcap_repeat_instance'].isin(demoreps)])
+      for rep in demoreps:
+        reptocopy = demo.loc[demo['redcap_repeat_instance']==rep]['demo_copycontactfrom'].values[0]
+        if reptocopy != '':
+          copyfrom = demo.loc[demo['redcap_repeat_instance']==reptocopy]
+          pasteto = copyfrom[['redcap_id','demo_address1','demo_address2','demo_apt','demo_city','demo_state','demo_zip','demo_email','demo_email2','demo_phone','demo_phone2']]
+          pasteto['demo_copycontactfrom'] = ''
+          pasteto['redcap_event_name'] = 'family_member_arm_1'
+          pasteto['redcap_repeat_instance'] = rep
+          updateres = ctx.pushRCRecord(rc_api_url, rc_data_apikey, '', pasteto)
       # If the saved record is the proband's, copy his/her email to the family contact email
-      if rep == '1':
-        NDDdb.setFamEmail(rc_api_url, rc_data_apikey, demo.loc[demo['redcap_repeat_instance']=='1','demo_email'].values[0], recordid)
+      if '1' in demoreps:
+        NDDdb.setFamEmail(rc_api_url, rc_data_apikey, demo.loc[demo['redcap_repeat_instance']=='1','demo_email'].values[0], recordid, ctx=ctx)
+    print('Data pipeline: ' + str(ctx.pulls) + ' pulls from REDCap, ' + str(ctx.hits) + ' served from memory')
     sys.stdout.flush()
-    return
+
+# Queue a DET request for pipeline. Returns the record id, or None if the request is not a DET post
+def enqueueDET(pipeline):
+  reqdat = request.form.to_dict(flat=False)
+  if 'record' not in reqdat or 'instrument' not in reqdat:
+    return None
+  recordid = reqdat['record'][0]
+  detqueue.enqueueDebounced(pipeline, recordid, reqdat, det_debounce, det_maxwait)
+  return recordid
+
+####### Routes called by DET
+# Triggered on changes to the referral project
+@bp.route('/referral_pipeline', methods=methodspermitted)
+@cross_origin(origin=originspermitted)
+def referral_pipeline():
+  if enqueueDET('referral_pipeline') is None:
+    return 'Missing record or instrument', 400
+  return ''
+
+# Triggered on changes to the data collection project
+@bp.route('/data_pipeline', methods=methodspermitted)
+@cross_origin(origin=originspermitted)
+def data_pipeline():
+  if enqueueDET('data_pipeline') is None:
+    return 'Missing record or instrument', 400
+  return ''
+
+# Number of DET jobs in each state (queued/running/done/dead), and triggers received/merged per pipeline.
+# With ?job=<id>, the status of that one job instead
+@bp.route('/det_queue', methods=methodspermitted)
+@cross_origin(origin=originspermitted)
+def det_queue():
+  if 'job' in request.args:
+    job = detqueue.job(int(request.args.get('job')))
+    if job is None:
+      return 'No such job', 404
+    return json.dumps(job)
+  return json.dumps({'jobs':detqueue.counts(), 'triggers':detqueue.mergeStats()})
 
 # Triggered on changes to the sample submission project
-@app.route('/sample_pipeline', methods=methodspermitted)
+@bp.route('/sample_pipeline', methods=methodspermitted)
 @cross_origin(origin=originspermitted)
 def sample_pipeline():
   reqdat = dict(request.form)
@@ -324,7 +615,7 @@ def sample_pipeline():
 ### Redirects ###
 
 # Redirect from referral record to corresponding family record in data collection
-@app.route('/gotoDataCollectRC', methods=methodspermitted)
+@bp.route('/gotoDataCollectRC', methods=methodspermitted)
 @cross_origin(origin=originspermitted)
 def goto_ndd_datacollect_rc():
     refid = request.args.get('record')
@@ -333,7 +624,7 @@ def goto_ndd_datacollect_rc():
     return redirect(dest, code=302)
 
 # Redirect from data collection record to referral
-@app.route('/gotoReferralRC', methods=methodspermitted)
+@bp.route('/gotoReferralRC', methods=methodspermitted)
 @cross_origin(origin=originspermitted)
 def goto_ndd_referral_rc():
     dcid = request.args.get('record')
@@ -342,7 +633,7 @@ def goto_ndd_referral_rc():
     return redirect(dest, code=302)
 
 # Get request from REDCap and redirect to Family page
-@app.route('/viewSubjInLabKey', methods=methodspermitted)
+@bp.route('/viewSubjInLabKey', methods=methodspermitted)
 @cross_origin(origin=originspermitted)
 def view_subj_in_LabKey():
     rcid = request.args.get('record')
@@ -351,8 +642,53 @@ def view_subj_in_LabKey():
 
 #################
 
-#app.run(debug=True) # Uncomment to run in debug mode. This line must come after all routes.
+# Peak resident memory of this process in MB (Linux reports ru_maxrss in KB)
+def workerRSS():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Every request gets a correlation id (the caller's X-Correlation-ID, or a new one) that is logged
+# with each REDCap/LabKey call made while handling it and returned in the response headers
+def startRequest():
+  cid = request.headers.get('X-Correlation-ID')
+  if cid:
+    setCorrelationID(cid)
+  else:
+    cid = newCorrelationID('req-')
+  g.correlation_id = cid
+  g.started = time.perf_counter()
+
+def finishRequest(response):
+  elapsed = time.perf_counter() - g.get('started', time.perf_counter())
+  labels = (('endpoint', request.endpoint or 'unmatched'), ('method', request.method), ('status', str(response.status_code)))
+  metrics.inc('http_requests_total', labels)
+  metrics.observe('http_request_seconds', labels[:2], elapsed)
+  metrics.setGauge('process_max_rss_megabytes', (), workerRSS())
+  if request.endpoint != 'ndddb.metrics_endpoint':
+    metrics.log('http_request', endpoint=request.endpoint, method=request.method, status=response.status_code, seconds=round(elapsed, 4))
+  response.headers['X-Correlation-ID'] = g.get('correlation_id', '')
+  return response
+
+# Build the Flask app. initShared() only does its work the first time, so with gunicorn's
+# preload_app the workers get the state loaded in the master. start_workers=False leaves the
+# background threads to the caller (gunicorn.conf.py starts them after forking)
+def create_app(start_workers=True):
+  initShared()
+  app = Flask(__name__)
+  app.config['SERVER_NAME']=config.flaskparams['servname']
+  app.config['PREFERRRED_URL_SCHEME']='https'
+  # If TLS is terminated by a proxy in front of the server, trust its X-Forwarded-* headers
+  if config.flaskparams.get('behind_proxy', False):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+  CORS(app, resources={r'/*': {'origins': originspermitted}})
+  app.register_blueprint(bp)
+  app.before_request(startRequest)
+  app.after_request(finishRequest)
+  if start_workers:
+    startWorkers()
+  return app
+
+#create_app().run(debug=True) # Uncomment to run in debug mode.
 
 context=(cer,key)
 if __name__ == '__main__':
-  app.run(host='0.0.0.0',ssl_context=context)
+  create_app().run(host='0.0.0.0',ssl_context=context)
@@ -0,0 +1,21 @@
+# Rebuild the DET server's duplicate-check index (see lib/NDDdb_dedupe.py) from the data collection
+# project's demographics. The server rebuilds it every dedupe_rebuild seconds by itself; run this to
+# pick up subjects imported through the API or deleted in REDCap straight away.
+# To run:
+#>  python3 rebuild_dedupe.py
+
+import sys
+sys.path.insert(0,'../conf')
+sys.path.insert(0,'../lib')
+
+import pyserver_etl_config as config
+import NDDdb_py_modules as NDDdb
+
+rc_api_url = config.rcparams['rc_api_url']
+rc_data_apikey = config.rcparams['ndd_rc_data_apikey']
+NDDdb.configureRCClient(rc_api_url, poolsize=config.rcparams.get('api_poolsize', 4), timeout=config.rcparams.get('api_timeout', 300))
+
+subjindex = NDDdb.SubjectIndex(config.flaskparams.get('dedupe_db', 'dedupe_index.sqlite'), config.flaskparams.get('dedupe_threshold', 0.88))
+before = subjindex.count()
+subjindex.rebuild(NDDdb.pullRCRecords(rc_api_url, rc_data_apikey, 'demographics', '', 'redcap_id'))
+print('Duplicate index rebuilt: ' + str(before) + ' subjects before, ' + str(subjindex.count()) + ' now')
@@ -0,0 +1,32 @@
+# Check the DET server's ID allocator against REDCap & LabKey.
+# Lists every sequence that is behind its source (would hand out an ID that's already taken)
+# or ahead of it (IDs were allocated but never written). Pass --fix to move the sequences
+# that are behind up to the highest ID in use.
+# To run:
+#>  python3 reconcile_ids.py [--fix]
+
+import sys
+sys.path.insert(0,'../conf')
+sys.path.insert(0,'../lib')
+
+import pyserver_etl_config as config
+import NDDdb_py_modules as NDDdb
+
+from labkey.utils import create_server_context
+
+fix = '--fix' in sys.argv[1:]
+
+rc_api_url = config.rcparams['rc_api_url']
+rc_data_apikey = config.rcparams['ndd_rc_data_apikey']
+NDDdb.configureRCClient(rc_api_url, poolsize=config.rcparams.get('api_poolsize', 4), timeout=config.rcparams.get('api_timeout', 300))
+server_context = create_server_context(config.lkparams['labkey_server'], config.lkparams['project_name'], config.lkparams['context_path'], config.lkparams['use_ssl'])
+
+if 'idalloc_db' not in config.rcparams:
+  sys.exit('No ID allocator configured (rcparams idalloc_db).')
+idalloc = NDDdb.IDAllocator(config.rcparams['idalloc_db'])
+
+values = NDDdb.idSourceValues(rc_api_url, rc_data_apikey, server_context, families=True)
+report = idalloc.reconcile(values, fix=fix)
+for r in report:
+  print(r['sequence'] + ': allocator ' + str(r['allocator']) + ', source ' + str(r['source']) + ' (' + r['status'] + ')')
+print(str(len(values)) + ' sequences checked, ' + str(sum(r['status'] == 'behind' for r in report)) + ' behind, ' + str(sum(r['status'] == 'ahead' for r in report)) + ' ahead' + (' (behind sequences fixed)' if fix else ''))
@@ -0,0 +1,8 @@
+# WSGI entry point for the DET server, for gunicorn (see gunicorn.conf.py):
+#>  gunicorn -c gunicorn.conf.py wsgi:app
+# The background threads (DET queue workers, metadata refresh timer) are started per worker
+# process by gunicorn.conf.py, so they are not started here.
+
+import pyserver_etl_ssl
+
+app = pyserver_etl_ssl.create_app(start_workers=False)
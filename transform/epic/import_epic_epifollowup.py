@@ -23,7 +23,7 @@ def coerceDateStr(datestr,informat):
 
 ############################################################################
 
-parser = ap.ArgumentParser(description='Read in Epic data dump from EDW report & look for the tages present in the Epilepsy Follow Up Smart Phrase. If found, regex parse the available tags & map them to REDCap fields. Then, pull all the REDCap records for this instrument to check if an identical note already exists (keyed on subject/date/provider combination), and if it does not, add the new note to the next available REDCap instance ID. Then push the new data frame back to REDCap.'')
+parser = ap.ArgumentParser(description='Read in Epic data dump from EDW report & look for the tages present in the Epilepsy Follow Up Smart Phrase. If found, regex parse the available tags & map them to REDCap fields. Then, pull all the REDCap records for this instrument to check if an identical note already exists (keyed on subject/date/provider combination), and if it does not, add the new note to the next available REDCap instance ID. Then push the new data frame back to REDCap.')
 parser.add_argument('epic_xls', metavar='epic_xls', type=str, nargs=1, help='Path to .xls/.xlsx file containing the data report from the EDW')
 
 args = parser.parse_args()
@@ -52,7 +52,9 @@ for var, pattern in queries.items():
 textcols = list(notes_epic.filter(like='epifu', axis=1))
 notes_epic[textcols] = notes_epic[textcols].apply(lambda x: x.str.strip())
 
-# Pull REDCap records
+# Pull REDCap records, reusing a recent export from the on-disk cache if one is configured
+if 'cache_path' in etlconfig.rcparams:
+  NDDdb.setRCCache(NDDdb.RCExportCache(etlconfig.rcparams['cache_path'], etlconfig.rcparams.get('cache_ttl', 3600), etlconfig.rcparams.get('cache_maxbytes', 2*1024**3)))
 rc = NDDdb.pullRCRecords(etlconfig.rcparams['rc_api_url'], etlconfig.rcparams['ndd_rc_data_apikey'],'family_enrollment,demographics,enrollment,epifu','','')
 
 # Extract only rows representing FAMILIES
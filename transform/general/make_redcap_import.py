@@ -1,8 +1,13 @@
 import argparse as ap
 import re
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import sys
+sys.path.insert(0, '../../lib/')
+from NDDdb_translate import TranslationPlan
 
 # Mimic unix tee function to print to log & stdout together
 class Tee:
@@ -15,73 +20,38 @@ class Tee:
         self.out1 = out1
         self.out2 = out2
 
-sys.stdout = Tee(open('/tmp/redcap_transform_log.txt', 'w'), sys.stdout)
-
 parser = ap.ArgumentParser(description='Transforms a spreadsheet into a REDCap import-ready .csv file by translating fields into REDCap dictionary values based on a user supplied REDCap data dictionary.')
 parser.add_argument('datfile', metavar='datfile', type=str, nargs=1, help='Path to .tsv/.csv/.txt/.xls/.xlsx file containing the data to be transformed')
 parser.add_argument('datfile_id', metavar='datfile_id', type=str, nargs=1, help='ID field in datfile that will serve as the record ID in REDCap (and should not be transformed)')
 
 parser.add_argument('ddfile', metavar='ddfile', type=str, nargs=1, help='Path to data dictionary to use for translating values')
-
-args = parser.parse_args()
+parser.add_argument('--chunksize', type=int, default=0, help='Stream delimited input files in chunks of this many rows, appending each to the output, so memory use stays flat (default: read the whole file at once)')
+parser.add_argument('--processes', type=int, default=1, help='With --chunksize, translate chunks in this many worker processes')
+parser.add_argument('--plancache', type=str, default=None, help='Directory to cache compiled data dictionary translation plans in, e.g. ~/.cache/redcap_translation_plans (created 0700; must belong to you). Default: no cache')
 
 # File parser
 FNAMEPATTERN = '(.*)(\.xlsx|\.xls|\.csv|\.tab|\.tsv)$'
-def parseFile(fpath):
+def parseFile(fpath, chunksize=None):
     fname = fpath.split('/').pop()
     result = re.match(FNAMEPATTERN, fname)
     fname = result.group(1)
     ext = result.group(2)
     if ext == '.xlsx' or ext == '.xls':
+        if chunksize:
+            print('Excel files can\'t be streamed; reading ' + fpath + ' in one go')
         df = pd.read_excel(fpath,dtype='str')
+        if chunksize:
+            df = iter([df])
     elif ext == '.csv':
-        df = pd.read_csv(fpath,dtype='str')
+        df = pd.read_csv(fpath,dtype='str',chunksize=chunksize)
     elif ext == '.tab' or ext == '.tsv':
-        df = pd.read_csv(fpath, sep='\t',dtype='str')
+        df = pd.read_csv(fpath, sep='\t',dtype='str',chunksize=chunksize)
     return (df, fname)
 
-# Read & pre-process data & data dictionary
-datfile=args.datfile[0]
-
-(dat, datname) = parseFile(datfile)
-idfield = args.datfile_id[0].lower()
-
 # Convert spaces to '_' and lcase column names
-dat.columns = dat.columns.str.replace(' ','_')
-dat.rename(columns=str.lower,inplace=True)
-
-# REDCap data dictionaries contain non-UTF8 chars, so:
-dd = pd.read_csv(args.ddfile[0],encoding='latin-1')
-
-dd.set_index('Variable / Field Name',inplace=True,drop=False,append=False,verify_integrity=True)
-
-CHOICEPATTERN = re.compile('^\s*([0-9]+),\s*(.*)\s*$')
-ALTPATTERN = re.compile('^\s*(.*),\s*(.*)\s*$')
-def parseChoiceMap(optstr, pattern, altpattern):
-    try:
-        choicesmap = {}
-        optlist = optstr.split('|')
-    except AttributeError:
-        return choicesmap
-    for opt in optlist:
-        #Some options in the Epi25 data dictionary have HTML decoration or tags, so split out any text that falls between [] or <>
-        opt = re.sub('\[.*\]|<(br|div).*>','', opt)
-        opt = opt.rstrip()
-        parsed = re.search(pattern, opt)
-        try:
-            if parsed.groups().__len__()!=2:
-                print('WARNING: Selection choices parsing returned > or < than 2 matches')
-                break
-            else:
-                choicesmap[parsed.group(2)] = parsed.group(1)
-        except AttributeError:
-            parsed = re.search(altpattern, opt)
-            if parsed is None:
-                continue
-            choicesmap[parsed.group(2)] = parsed.group(1)
-    return choicesmap
-
-optmaps = dd.apply(lambda x: parseChoiceMap(x['Choices, Calculations, OR Slider Labels'],CHOICEPATTERN,ALTPATTERN),axis=1)
+def cleanColumns(df):
+    df.columns = df.columns.str.replace(' ','_').str.lower()
+    return df
 
 # Define exceptions to be thrown when cleaning data
 class FieldNotFoundError (Exception):
@@ -90,82 +60,112 @@ class FieldNotFoundError (Exception):
         self.message = message
         super().__init__(self.message)
 
-def report_missing(field):
-    print(field + ' not found')
-    keepme.remove(field)
-
-def report_unmapped(field):
-    print(field + ' not found')
-    keepme.remove(field)
-
-# Initialize list of columns to keep from data dictionary, & add checkbox columns as you go
-keepme = list(optmaps.index)
-keepme.append(idfield)
-
-# Loop over data dictionary and translate values
-for field,meta in dd.iterrows():
-    type = meta['Field Type']
-    if type != 'checkbox':
-        if field not in dat.columns:
+# Decide what to do with each field of the translation plan, given the input's columns. Returns the
+# fields to translate and the output columns
+def selectFields(plan, columns, idfield):
+    # Initialize list of columns to keep from data dictionary, & add checkbox columns as you go
+    keepme = list(plan.fields.keys())
+    keepme.append(idfield)
+    fields = []
+    def report_missing(field):
+        print(field + ' not found')
+        keepme.remove(field)
+    for field, p in plan.fields.items():
+        op = p['op']
+        if op != 'checkbox' and field not in columns:
             #raise FieldNotFoundError(field)
             report_missing(field)
             continue
-    # Values: 'text', 'dropdown', 'radio', 'checkbox', 'notes'
-    if type in ['text','notes']:
-        if meta['Text Validation Type OR Show Slider Number']=='date_mdy':
-            dat[field] = dat[field].str.replace('[0-9]{0,3}:[0-9]{0,3}:[0-9]{0,3}','',regex=True)
-        continue # No further handling required
-    elif type == 'yesno':
-        dat[field] = dat[field].str.lower()
-        dat[field].replace({
-          't':'1','true':'1','y':'1','yes':'1',
-          'f':'0','false':'0','n':'0','no':'0'
-        },inplace=True)
-        # Check to see if any values could not be translated
-        populated = dat[field][dat[field].notna()]
-        if ~populated.isin(['0','1']).all():
-            print('The following rows contain values that cannot be mapped to booleans and have been set to NA:')
-            print(populated.loc[~populated.isin(['0','1'])])
-            dat.loc[~dat[field].isin(['0','1']),field]=''
-            pass # TODO error handling for unmapped values
-    elif type in ['dropdown','radio']:
-        # Need to check if all values are successfully translated!
-        try:
-            #dat[f].isin([x for x in optmaps.loc[f].keys()]).
-            dat[field].replace(optmaps.loc[field],inplace=True)
+        if op == 'text' and p['type'] in ['text','notes']:
+            # Validated text (integer, email, ...) is checked against REDCap's pattern; the rest needs no handling
+            if p['pattern'] is not None:
+                fields.append(field)
+            continue
+        elif op in ['date','yesno']:
+            fields.append(field)
+        elif op == 'choice':
+            # Need to check if all values are successfully translated!
+            fields.append(field)
             keepme.remove(field)
-        except KeyError as FieldNotFoundError:
-            report_missing(field)
-    elif type in ['checkbox']:
-        # Need to check if all values are successfully translated!
-        try:
-            valsplit = dat[field].str.split(';',expand=True).applymap(lambda x: np.nan if pd.isna(x) else x.strip())
-            allvalsinmap = valsplit.apply(lambda x: pd.Series([y in optmaps.loc[field].keys() or pd.isna(y) for y in x]),axis=1).all(axis=1)
-            # Instead check if valnotinmap=TRUE
-            if ~allvalsinmap.all():
-                print(field + ' contains unmappable values!')
-            # From gene translation script: genes = genes.apply(lambda x: [lookup[1].get(y,y) for y in x.loc[~pd.isna(x)]],axis=1)
-            notna = ~pd.isna(valsplit)
-            valsplit[notna]
-            # Loop over labels. For each label, check if it exists in each valsplit() row
-            coded = pd.Series([x for x in optmaps.loc[field].keys()]).apply(
-                lambda x:
-                    valsplit.apply(lambda y: (y==x).any(),axis=1).replace({True:1,False:0})
-            ).transpose()
-            cb_cols = [field + '___' + z for z in optmaps.loc[field].values()]
-            coded.columns = cb_cols
-            dat = dat.join(coded)
-            # Add newly derived checkbox columns to the list of columns to keep & drop original column name
+        elif op == 'checkbox':
+            if field not in columns:
+                report_missing(field)
+                continue
+            # Add the derived checkbox columns to the list of columns to keep & drop original column name
+            fields.append(field)
             keepme.remove(field)
-            keepme.extend(cb_cols)
-        except KeyError:
+            keepme.extend(field + '___' + str(code) for code in dict.fromkeys(p['labels'].values()))
+        else:
             report_missing(field)
+    return fields, keepme
+
+# Translate fields of a frame (the whole input or one chunk of it) with the plan. Returns the output
+# columns and the messages about values that couldn't be translated
+def translate(dat, plan, fields, keepme):
+    coded, messages = plan.toCodes(dat, fields)
+    # All translated & checkbox columns are added with one concat rather than a join per field
+    dat = pd.concat([dat.drop(columns=[c for c in coded.columns if c in dat.columns]), coded], axis=1)
+    return dat[keepme], messages
+
+# Worker process state for --processes: the plan is sent once per worker, not with every chunk
+_workerplan = None
+def initWorker(plan, fields, keepme):
+    global _workerplan
+    _workerplan = (plan, fields, keepme)
+
+def translateChunk(chunk):
+    return translate(cleanColumns(chunk), *_workerplan)
+
+# Translate chunks in a process pool, keeping at most a few chunks per worker in flight so memory
+# stays bounded, and yield the results in input order
+def translatePool(chunks, plan, fields, keepme, processes):
+    with ProcessPoolExecutor(max_workers=processes, initializer=initWorker, initargs=(plan, fields, keepme)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(translateChunk, chunk))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+if __name__ == '__main__':
+    sys.stdout = Tee(open('/tmp/redcap_transform_log.txt', 'w'), sys.stdout)
+    args = parser.parse_args()
+
+    # Read & pre-process data & data dictionary
+    datfile=args.datfile[0]
+    idfield = args.datfile_id[0].lower()
+    outfile = datfile[:-4] + '_redcap_import.csv'
+
+    # REDCap data dictionaries contain non-UTF8 chars, so they're read as latin-1. Every choice list is parsed
+    # into a translation plan (with any HTML decoration in the labels stripped out), which is cached until the dictionary changes
+    plan = TranslationPlan.fromFile(args.ddfile[0], args.plancache, stripmarkup=True)
+
+    if not args.chunksize:
+        (dat, datname) = parseFile(datfile)
+        dat = cleanColumns(dat)
+        fields, keepme = selectFields(plan, set(dat.columns), idfield)
+        transformed_dat, messages = translate(dat, plan, fields, keepme)
+        for msg in messages:
+            print(msg)
+        # Write out transformed data frame
+        transformed_dat.to_csv(outfile,header=True,index=False)# TODO:
     else:
-        report_missing(field)
-
-# Drop all columns not found in keepme list
-transformed_dat = dat[keepme]
-
-# Write out transformed data frame
-transformed_dat.to_csv(datfile[:-4] + '_redcap_import.csv',header=True,index=False)# TODO:
-print('------Done!--------')
+        # Stream the input: the plan is compiled from the first chunk's columns, then every chunk is
+        # translated with it and appended to the output
+        (chunks, datname) = parseFile(datfile, args.chunksize)
+        first = cleanColumns(next(chunks))
+        fields, keepme = selectFields(plan, set(first.columns), idfield)
+        allchunks = itertools.chain([first], chunks)
+        if args.processes > 1:
+            results = translatePool(allchunks, plan, fields, keepme, args.processes)
+        else:
+            results = (translate(cleanColumns(chunk), plan, fields, keepme) for chunk in allchunks)
+        nrows = 0
+        for n, (transformed_dat, messages) in enumerate(results):
+            for msg in messages:
+                print('Chunk ' + str(n + 1) + ': ' + msg)
+            transformed_dat.to_csv(outfile, mode='w' if n == 0 else 'a', header=n == 0, index=False)
+            nrows += len(transformed_dat)
+        print(str(nrows) + ' rows written to ' + outfile)
+    print('------Done!--------')
@@ -1,21 +1,135 @@
 import argparse as ap
 import xml.etree.ElementTree as ET
 import csv
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../lib/'))
+
+# pyarrow is only needed for --format parquet
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 parser = ap.ArgumentParser(description='Parse the CDC\'s XML doc containing the ICD code descriptions to a flat file. These XML are obtained from the CDC FTP here: https://ftp.cdc.gov/pub/health_statistics/nchs/publications/ICD10CM/.')
 parser.add_argument('in_xml', metavar='in_xml', type=str, nargs=1, help='Path to the CDC\'s ICD XML.')
+parser.add_argument('--format', choices=['csv','parquet'], default='csv', help='Output format (parquet needs pyarrow)')
+parser.add_argument('--out', type=str, default=None, help='Output file (default: in_xml with _parsed.csv/_parsed.parquet in place of .xml)')
+parser.add_argument('--index', type=str, default=None, help='Also build the memory-mapped lookup index (see lib/NDDdb_icd10.py) in this directory')
 
-args = parser.parse_args()
+# One row per <diag> element, written in document order (a code before its subcodes)
+COLUMNS = ['code','description','parent','depth','leaf','chapter','chapter_desc','section','section_desc',
+    'inclusion_terms','includes','excludes1','excludes2','code_first','code_also','use_additional_code']
+# Elements holding <note>s, and the column their notes go in
+NOTECOLUMNS = {'inclusionTerm':'inclusion_terms', 'includes':'includes', 'excludes1':'excludes1', 'excludes2':'excludes2',
+    'codeFirst':'code_first', 'codeAlso':'code_also', 'useAdditionalCode':'use_additional_code'}
+NOTESEP = ' | '
+PARQUETBATCH = 10000
 
-in_xml = args.in_xml[0]
-out_csv = in_xml[:-4] + '_parsed.csv'
+# Stream the tabular XML with iterparse, yielding a dict (COLUMNS) per diagnosis. Elements are cleared
+# as soon as they've been read, and each chapter is dropped from the tree when it ends, so memory use
+# doesn't grow with the size of the file. A diagnosis is yielded when its first subcode starts (or when
+# it ends, if it has none), so everything that comes before its subcodes -- name, description & notes --
+# is known by then.
+def iterDiagnoses(in_xml):
+    path = [] # tags of the open elements, root first
+    diags = [] # rows of the open <diag>s, outermost first
+    emitted = [] # whether each of them has been yielded yet
+    chapter = {'chapter':'', 'chapter_desc':''}
+    section = {'section':'', 'section_desc':''}
+    root = None
+    for event, elem in ET.iterparse(in_xml, events=('start','end')):
+        tag = elem.tag
+        if event == 'start':
+            if root is None:
+                root = elem
+            if tag == 'diag':
+                if diags and not emitted[-1]:
+                    emitted[-1] = True
+                    diags[-1]['leaf'] = False
+                    yield diags[-1]
+                row = dict.fromkeys(COLUMNS, '')
+                row.update(chapter)
+                row.update(section)
+                row['parent'] = diags[-1]['code'] if diags else ''
+                row['depth'] = len(diags) + 1
+                row['leaf'] = True
+                diags.append(row)
+                emitted.append(False)
+            elif tag == 'chapter':
+                chapter = {'chapter':'', 'chapter_desc':''}
+                section = {'section':'', 'section_desc':''}
+            elif tag == 'section':
+                section = {'section':elem.get('id', ''), 'section_desc':''}
+            path.append(tag)
+            continue
+        path.pop()
+        parent = path[-1] if path else None
+        text = (elem.text or '').strip()
+        if tag in ['name','desc'] and parent == 'diag':
+            diags[-1]['code' if tag == 'name' else 'description'] = text
+        elif tag == 'name' and parent == 'chapter':
+            chapter['chapter'] = text
+        elif tag == 'desc' and parent == 'chapter':
+            chapter['chapter_desc'] = text
+        elif tag == 'desc' and parent == 'section':
+            section['section_desc'] = text
+        elif tag == 'note' and parent in NOTECOLUMNS and len(path) > 1 and path[-2] == 'diag':
+            col = NOTECOLUMNS[parent]
+            diags[-1][col] = diags[-1][col] + NOTESEP + text if diags[-1][col] else text
+        elif tag == 'diag':
+            row = diags.pop()
+            if not emitted.pop():
+                yield row
+        # Rows already have everything they need from these elements
+        if tag in ['diag','section','chapter'] or parent in ['ICD10CM.tabular', None]:
+            elem.clear()
+        if tag == 'chapter' and root is not None:
+            root.clear()
 
-csvwriter = csv.writer(open(out_csv, 'w'))
+def writeCSV(rows, out_path):
+    n = 0
+    with open(out_path, 'w', newline='') as f:
+        csvwriter = csv.writer(f)
+        csvwriter.writerow(COLUMNS)
+        for row in rows:
+            csvwriter.writerow([row[c] for c in COLUMNS])
+            n += 1
+    return n
 
-tree = ET.parse(in_xml) # This is the XML
-root = tree.getroot()
+# Rows are written as row groups of PARQUETBATCH, so only one batch is held in memory
+def writeParquet(rows, out_path):
+    schema = pa.schema([(c, pa.int32() if c == 'depth' else pa.bool_() if c == 'leaf' else pa.string()) for c in COLUMNS])
+    n = 0
+    batch = []
+    with pq.ParquetWriter(out_path, schema) as writer:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= PARQUETBATCH:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                n += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            n += len(batch)
+    return n
 
-for diag in root.iter('diag'):           # Loop through every diagnostic tree
-   name = diag.find('name').text  # Extract the diag code
-   desc = diag.find('desc').text  # Extract the description
-   csvwriter.writerow((name,desc))       # Write to .csv
+if __name__ == '__main__':
+    args = parser.parse_args()
+    in_xml = args.in_xml[0]
+    if args.format == 'parquet' and pa is None:
+        parser.error('--format parquet needs pyarrow')
+    out_path = args.out or in_xml[:-4] + '_parsed.' + args.format
+    start = time.perf_counter()
+    if args.format == 'parquet':
+        n = writeParquet(iterDiagnoses(in_xml), out_path)
+    else:
+        n = writeCSV(iterDiagnoses(in_xml), out_path)
+    print(str(n) + ' codes written to ' + out_path + ' in ' + '{:.1f}'.format(time.perf_counter() - start) + 's')
+    if args.index:
+        from NDDdb_icd10 import buildICD10Index
+        start = time.perf_counter()
+        buildICD10Index(out_path, args.index)
+        print('Index built in ' + args.index + ' in ' + '{:.1f}'.format(time.perf_counter() - start) + 's')